@@ -1,21 +1,61 @@
 import os
+import copy
 import json
-from openai import OpenAI
+import time
+import asyncio
+import threading
 from datetime import date, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator
+
+from llm_cache import make_cache_key, get_cached_response, put_cached_response, run_cache_io
+from prompt_compactor import compact_exclusion_list, count_tokens
+from plan_validator import PlanValidator, compile_schema, extract_day_list
+from metrics import span, record_usage
+from model_router import (
+    ROUTER, MODEL_CASCADE, REPAIRABLE_MEALS, run_cascade, arun_cascade,
+    day_macro_problems, plan_macro_problems, meal_macro_problems
+)
+import openai_transport
 
 # --- ИНИЦИАЛИЗАЦИЯ OpenAI ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = None
-if OPENAI_API_KEY:
-    try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        print("✅ OpenAI Клиент успешно инициализирован.")
-    except Exception as e:
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось создать клиента OpenAI: {e}")
-else:
+if not OPENAI_API_KEY:
     print("❌ КРИТИЧЕСКАЯ ОШИБКА: OPENAI_API_KEY не найден в переменных окружения.")
 
+# Клиенты создаются при первом запросе, а не при импорте: импорт пакета openai - самая
+# долгая часть холодного старта бота, а до первой генерации он не нужен
+_client = None
+# Асинхронный клиент для параллельной генерации по дням (работает прямо в event loop бота)
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def _create_clients():
+    global _client, _async_client
+    with _client_lock:
+        if _client is not None or not OPENAI_API_KEY:
+            return
+        try:
+            # Оба клиента работают поверх общих пулов keep-alive соединений с явными таймаутами
+            _client, _async_client = openai_transport.create_clients(OPENAI_API_KEY)
+            print("✅ OpenAI Клиент успешно инициализирован.")
+        except Exception as e:
+            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось создать клиента OpenAI: {e}")
+
+
+def get_client():
+    """Синхронный клиент OpenAI (создается при первом вызове) или None, если ключа нет или создать не удалось."""
+    if _client is None:
+        _create_clients()
+    return _client
+
+
+def get_async_client():
+    """Асинхронный клиент OpenAI (создается при первом вызове) или None."""
+    if _async_client is None:
+        _create_clients()
+    return _async_client
+
 
 # --- ВАШИ ПЕРСОНАЛЬНЫЕ ДАННЫЕ ---
 USER_KZHBU = {
@@ -61,98 +101,686 @@ JSON_SCHEMA = {
     }
 }
 
+# Параметры запроса к модели (общие для обычного и потокового режима).
+# Модель выбирает каскад (model_router.py); MODEL_NAME - его первая, самая дешевая модель:
+# с нее начинается потоковый режим и на ней работает пакетная генерация (Batch API)
+MODEL_NAME = MODEL_CASCADE[0]
+TEMPERATURE = 0.7
+SYSTEM_MESSAGE = "Ты - система, которая генерирует JSON-объекты со списком рецептов. Твой ответ должен быть только JSON, без комментариев. Используй СХЕМУ, предоставленную в запросе."
+
+# Максимум одновременных запросов в параллельном режиме
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "5"))
+
+DAY_NAMES = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+MEAL_TYPES = ["Завтрак", "Обед", "Перекус", "Ужин"]
+
+# Валидатор плана, скомпилированный из JSON_SCHEMA один раз при импорте
+PLAN_VALIDATOR = PlanValidator(JSON_SCHEMA, MEAL_TYPES, DAY_NAMES)
+MEAL_VALIDATOR = compile_schema(JSON_SCHEMA["items"]["properties"]["meals"]["items"])
+# Счетчики точечного ремонта планов за время работы процесса
+REPAIR_STATS = {"repaired_days": 0, "repaired_meals": 0, "tokens_spent": 0, "tokens_saved": 0}
+
+# Схемы в компактном виде (без отступов) считаются один раз при импорте, а не на каждый промпт
+SCHEMA_COMPACT = json.dumps(JSON_SCHEMA, ensure_ascii=False, separators=(',', ':'))
+DAY_SCHEMA_COMPACT = json.dumps(JSON_SCHEMA["items"], ensure_ascii=False, separators=(',', ':'))
+MEAL_SCHEMA_COMPACT = json.dumps(JSON_SCHEMA["items"]["properties"]["meals"]["items"], ensure_ascii=False, separators=(',', ':'))
+
 # --- ФУНКЦИЯ СОЗДАНИЯ ПРОМПТА ---
 
-def create_master_prompt(exclusion_list: List[str]) -> str:
-    """Формирует детализированный промпт для OpenAI."""
-    
+def get_plan_dates() -> List[date]:
+    """Возвращает 5 будних дней следующей недели (с понедельника)."""
     today = date.today()
     start_date = today + timedelta(days=(7 - today.weekday()))
-    
-    dates_list = []
-    for i in range(5):
-        current_date = start_date + timedelta(days=i)
-        dates_list.append(current_date.strftime("%Y-%m-%d"))
+    return [start_date + timedelta(days=i) for i in range(5)]
+
 
+def _nutrition_rules_text(exclusion_list: List[str], profile: Dict[str, Any]) -> str:
+    """Общий блок указаний по КЖБУ для промптов на неделю, день и блюдо."""
     exclusions_text = ""
     if exclusion_list:
-        print(f"🔎 Найдено {len(exclusion_list)} уникальных блюд для исключения за последние 21 дней.")
         exclusions_text = f"\nКРАЙНЕ ВАЖНО: Запрещено использовать следующие блюда из истории (последние 3 недели): {', '.join(exclusion_list)}"
-    
-    schema_string = json.dumps(JSON_SCHEMA, indent=2, ensure_ascii=False)
-    
-    prompt = f"""
-    Ты - профессиональный шеф-повар и диетолог. Твоя задача — составить меню на 5 будних дней, деля дневную норму на 4 приема пищи: Завтрак, Обед, Перекус, Ужин.
-    
-    Дни для планирования (строго в формате YYYY-MM-DD): {dates_list}
-    
+    # Частые ингредиенты последних дней (индекс ингредиентов истории, см. db_manager.get_frequent_ingredients)
+    if profile.get('recent_ingredients'):
+        exclusions_text += (
+            f"\nВАЖНО: За последнюю неделю уже часто были ингредиенты: {', '.join(profile['recent_ingredients'])}. "
+            "Используй каждый из них не больше чем в 2 днях плана и не в соседние дни. "
+            "Основной ингредиент (мясо, рыба, крупа) не должен повторяться три дня подряд."
+        )
+
+    return f"""
     Целевые суточные нормы КЖБУ:
-    - Мужчина: {USER_KZHBU['me']}
-    - Женщина: {USER_KZHBU['wife']}
+    - Мужчина: {profile['me']}
+    - Женщина: {profile['wife']}
     
     ЧРЕЗВЫЧАЙНО ВАЖНЫЕ УКАЗАНИЯ ПО КЖБУ:
-    1. ОБЩАЯ ЦЕЛЬ СУММАРНОЙ КАЛОРИЙНОСТИ НА ДВОИХ: **{USER_KZHBU['total_target_kzhbu']}**.
+    1. ОБЩАЯ ЦЕЛЬ СУММАРНОЙ КАЛОРИЙНОСТИ НА ДВОИХ: **{profile['total_target_kzhbu']}**.
     2. КАЛОРИЙНОСТЬ КАЖДОГО БЛЮДА (СУММАРНО НА ДВОИХ) ДОЛЖНА БЫТЬ В СЛЕДУЮЩИХ ПРИМЕРНЫХ ДИАПАЗОНАХ:
-       - Завтрак: **{USER_KZHBU['target_distribution_kzhbu']['Завтрак']}**
-       - Обед: **{USER_KZHBU['target_distribution_kzhbu']['Обед']}**
-       - Перекус: **{USER_KZHBU['target_distribution_kzhbu']['Перекус']}**
-       - Ужин: **{USER_KZHBU['target_distribution_kzhbu']['Ужин']}**
+       - Завтрак: **{profile['target_distribution_kzhbu']['Завтрак']}**
+       - Обед: **{profile['target_distribution_kzhbu']['Обед']}**
+       - Перекус: **{profile['target_distribution_kzhbu']['Перекус']}**
+       - Ужин: **{profile['target_distribution_kzhbu']['Ужин']}**
        
     КРАЙНЕ ВАЖНО:
     1. Сначала составь **реалистичный полный рецепт**, затем **РАССЧИТАЙ** КЖБУ на основе ингредиентов рецепта. Не придумывай цифры.
     2. **Вес порций (weight_m, weight_w) должен быть реалистичным** для готового блюда. **200 грамм каши не могут быть 900 Ккал!** Калорийность должна следовать за реалистичным объемом порции и составом рецепта.
-    3. Суммарная дневная калорийность **ВСЕХ 4-х блюд** должна максимально точно соответствовать общей целевой сумме **3907 Ккал**. Отклонение не должно превышать 100 ккал.
+    3. Суммарная дневная калорийность **ВСЕХ 4-х блюд** должна максимально точно соответствовать общей целевой сумме **{profile['total_target_kzhbu'].split(',')[0]}**. Отклонение не должно превышать 100 ккал.
     4. Распредели дневную норму КЖБУ (для мужчины и женщины) между 4 приемами пищи, стараясь максимально приблизиться к их индивидуальным целям.
     5. ПОЛЕ 'total_kzhbu_for_two' ДОЛЖНО СОДЕРЖАТЬ СТРОКУ С РАСЧЕТОМ (Ккал, Б, Ж, У) И НЕ ДОЛЖНО БЫТЬ ПУСТЫМ. Используй формат: 'Ккал: X, Б: Yг, Ж: Zг, У: Wг'.
     6. Рассчитай **рекомендуемый вес порции в граммах (целое число)** отдельно для мужчины (weight_m) и для женщины (weight_w).
     7. Рецепты должны быть реалистичными (не более 60 минут готовки).
     {exclusions_text}
+    """
+
+
+def create_master_prompt(exclusion_list: List[str], profile: Dict[str, Any] | None = None, report: bool = True) -> str:
+    """
+    Формирует детализированный промпт для OpenAI. Без профиля используются цели USER_KZHBU.
+    Список исключений сжимается до бюджета токенов, схема передается без отступов.
+    report=False отключает печать отчета о сжатии (для оценок стоимости).
+    """
+    profile = profile or USER_KZHBU
     
+    dates_list = [d.strftime("%Y-%m-%d") for d in get_plan_dates()]
+    compacted_exclusions = compact_exclusion_list(exclusion_list)
+    schema_string = SCHEMA_COMPACT
+    
+    prompt = f"""
+    Ты - профессиональный шеф-повар и диетолог. Твоя задача — составить меню на 5 будних дней, деля дневную норму на 4 приема пищи: Завтрак, Обед, Перекус, Ужин.
+    
+    Дни для планирования (строго в формате YYYY-MM-DD): {dates_list}
+    {_nutrition_rules_text(compacted_exclusions, profile)}
     Верни результат СТРОГО в формате JSON, соответствующем предоставленной СХЕМЕ:
     {schema_string}
     """
+    if report:
+        _report_prompt_compaction(prompt, exclusion_list, compacted_exclusions)
+    return prompt
+
+
+def _report_prompt_compaction(prompt: str, full_exclusions: List[str], compacted_exclusions: List[str]):
+    """Печатает размер промпта до и после сжатия (исключения + схема) в токенах."""
+    tokens_after = count_tokens(prompt)
+    tokens_before = (
+        tokens_after
+        + count_tokens(", ".join(full_exclusions)) - count_tokens(", ".join(compacted_exclusions))
+        + _indented_schema_tokens() - count_tokens(SCHEMA_COMPACT)
+    )
+    print(
+        f"📉 Промпт: {tokens_before} → {tokens_after} токенов "
+        f"(исключения: {len(full_exclusions)} → {len(compacted_exclusions)} названий)."
+    )
+
+
+_INDENTED_SCHEMA_TOKENS = None
+
+def _indented_schema_tokens() -> int:
+    """Размер схемы в старом формате (indent=2) - только для отчета о сжатии."""
+    global _INDENTED_SCHEMA_TOKENS
+    if _INDENTED_SCHEMA_TOKENS is None:
+        _INDENTED_SCHEMA_TOKENS = count_tokens(json.dumps(JSON_SCHEMA, indent=2, ensure_ascii=False))
+    return _INDENTED_SCHEMA_TOKENS
+
+
+def create_day_prompt(day_date: date, exclusion_list: List[str], profile: Dict[str, Any] | None = None) -> str:
+    """Промпт на один день: используется в параллельном режиме генерации."""
+    profile = profile or USER_KZHBU
+    schema_string = DAY_SCHEMA_COMPACT
+
+    prompt = f"""
+    Ты - профессиональный шеф-повар и диетолог. Твоя задача — составить меню на ОДИН день, деля дневную норму на 4 приема пищи: Завтрак, Обед, Перекус, Ужин.
+    
+    День для планирования: {DAY_NAMES[day_date.weekday()]}, дата (строго в формате YYYY-MM-DD): {day_date.strftime("%Y-%m-%d")}
+    {_nutrition_rules_text(exclusion_list, profile)}
+    Верни результат СТРОГО в виде ОДНОГО JSON-объекта дня, соответствующего предоставленной СХЕМЕ:
+    {schema_string}
+    """
     return prompt
 
+
+def create_meal_prompt(day_date: date, meal_type: str, exclusion_list: List[str], profile: Dict[str, Any] | None = None) -> str:
+    """Минимальный промпт на одно блюдо: для замены дублей и повторной генерации фрагментов."""
+    profile = profile or USER_KZHBU
+    schema_string = MEAL_SCHEMA_COMPACT
+    exclusion_list = compact_exclusion_list(exclusion_list)
+
+    prompt = f"""
+    Ты - профессиональный шеф-повар и диетолог. Составь ОДНО блюдо типа "{meal_type}" на {day_date.strftime("%Y-%m-%d")}.
+    Калорийность блюда (суммарно на двоих): **{profile['target_distribution_kzhbu'].get(meal_type, '')}**.
+    Целевые суточные нормы: Мужчина: {profile['me']} Женщина: {profile['wife']}
+    Сначала составь реалистичный рецепт, затем РАССЧИТАЙ КЖБУ по ингредиентам. Формат 'total_kzhbu_for_two': 'Ккал: X, Б: Yг, Ж: Zг, У: Wг'.
+    """
+    if exclusion_list:
+        prompt += f"\n    КРАЙНЕ ВАЖНО: Запрещено использовать следующие блюда: {', '.join(exclusion_list)}\n"
+    prompt += f"""
+    Верни результат СТРОГО в виде ОДНОГО JSON-объекта блюда, соответствующего СХЕМЕ:
+    {schema_string}
+    """
+    return prompt
+
+# --- КАСКАД МОДЕЛЕЙ: КЭШ, ЗАПРОС, ПРОВЕРКА ОТВЕТА ---
+
+def _messages(prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def _cached_content(prompt: str) -> str | None:
+    """Принятый ранее ответ на этот промпт от любой модели каскада (от дешевой к сильной)."""
+    for model in MODEL_CASCADE:
+        cached_content = get_cached_response(make_cache_key(model, TEMPERATURE, SYSTEM_MESSAGE, prompt))
+        if cached_content is not None:
+            return cached_content
+    return None
+
+
+def _parse_json(content: str) -> Any:
+    with span("parse"):
+        return json.loads(content)
+
+
+def _schema_problems(report: Dict[str, Any]) -> List[str]:
+    """Ошибки схемы, из-за которых нужна модель сильнее; несколько сломанных блюд чинит ремонт."""
+    broken_meals = len(report['invalid_meals']) + len(report['missing_meals'])
+    if report['missing_dates'] or broken_meals > REPAIRABLE_MEALS:
+        return [f"схема: нет дней {len(report['missing_dates'])}, сломанных блюд {broken_meals}"]
+    return []
+
+
+def weekly_plan_problems(data: Any, profile: Dict[str, Any], expected_dates: List[date]) -> List[str]:
+    """Проверка ответа на недельный промпт: схема и КЖБУ по дням. Пустой список - ответ принят."""
+    plan = extract_day_list(data)
+    if plan is None:
+        return ["в ответе нет списка дней"]
+    # validate() правит план на месте - проверяем копию, ответ модели остается как есть
+    plan = copy.deepcopy(plan)
+    return _schema_problems(PLAN_VALIDATOR.validate(plan, expected_dates)) + plan_macro_problems(plan, profile)
+
+
+def day_plan_problems(data: Any, day_date: date, profile: Dict[str, Any]) -> List[str]:
+    """Проверка ответа на промпт одного дня."""
+    day_plan = _unwrap_object(data, 'meals')
+    if day_plan is None:
+        return ["в ответе нет списка блюд"]
+    plan = [copy.deepcopy(day_plan)]
+    plan[0]['date'] = day_date.strftime("%Y-%m-%d")
+    problems = _schema_problems(PLAN_VALIDATOR.validate(plan, [day_date]))
+    return problems + (day_macro_problems(plan[0], profile) if plan else [])
+
+
+def meal_problems(data: Any, meal_type: str, profile: Dict[str, Any]) -> List[str]:
+    """Проверка ответа на промпт одного блюда: схема блюда и калорийность приема пищи."""
+    meal = _unwrap_object(data, 'meal_name')
+    if meal is None:
+        return ["в ответе нет блюда"]
+    meal = dict(meal, type=meal_type)
+    return MEAL_VALIDATOR(meal, "$") + meal_macro_problems(meal, meal_type, profile)
+
 # --- ГЛАВНАЯ ФУНКЦИЯ ВЫЗОВА API ---
 
-def generate_weekly_plan(exclusion_list: List[str]) -> List[Dict[str, Any]] | None:
+def generate_weekly_plan(exclusion_list: List[str], use_cache: bool = True, profile: Dict[str, Any] | None = None) -> List[Dict[str, Any]] | None:
     """
     Отправляет запрос в OpenAI и возвращает готовый список планов.
+    При use_cache=True сначала ищет ответ на точно такой же запрос в кэше.
+    Запрос идет по каскаду моделей: к более сильной модели - только если ответ не прошел проверку.
     """
+    with span("prompt_build"):
+        prompt = create_master_prompt(exclusion_list, profile)
+
+    if use_cache:
+        cached_content = _cached_content(prompt)
+        if cached_content is not None:
+            return json.loads(cached_content)
+
+    client = get_client()
     if client is None:
         print("❌ Генерация невозможна: Клиент OpenAI не инициализирован.")
         return None
         
-    prompt = create_master_prompt(exclusion_list)
     print("--- 1. Запрос в OpenAI: Начинаем отправку. ---")
-    
+    expected_dates = get_plan_dates()
+
+    def request(model: str):
+        with span("openai_request"):
+            # Повторы временных ошибок и хедж медленного ответа - в openai_transport
+            response = openai_transport.complete(
+                client, "week",
+                model=model,
+                response_format={"type": "json_object"}, 
+                messages=_messages(prompt),
+                temperature=TEMPERATURE 
+            )
+        record_usage(model, response.usage)
+        return response.choices[0].message.content.strip(), response.usage
+
     try:
-        response = client.chat.completions.create(
-            # Используем gpt-4o-mini для скорости. Если проблема сохранится, перейдем на gpt-4o.
-            model="gpt-4o-mini", 
-            response_format={"type": "json_object"}, 
-            messages=[
-                {"role": "system", "content": "Ты - система, которая генерирует JSON-объекты со списком рецептов. Твой ответ должен быть только JSON, без комментариев. Используй СХЕМУ, предоставленную в запросе."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7 
+        result = run_cascade(
+            "week", request, _parse_json,
+            lambda data: weekly_plan_problems(data, profile or USER_KZHBU, expected_dates)
         )
+    except Exception as e:
+        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА ВЫЗОВА OpenAI (Сетевая/API): {e}")
+        return None
+    if result is None:
+        print("❌ ОШИБКА ПАРСИНГА JSON: ИИ не смог вернуть чистый JSON.")
+        return None
 
-        print("--- 2. Запрос в OpenAI: Ответ получен! ---")
-        
-        json_content = response.choices[0].message.content.strip()
-        plan_data = json.loads(json_content)
-        
-        print("✅ План успешно сгенерирован и разобран.")
-        return plan_data
+    model, json_content, plan_data, accepted = result
+    print(f"--- 2. Запрос в OpenAI: Ответ получен ({model})! ---")
+    # В кэш попадает только ответ, прошедший проверку: непринятый план еще будет чиниться
+    if accepted:
+        put_cached_response(make_cache_key(model, TEMPERATURE, SYSTEM_MESSAGE, prompt), model, json_content)
 
+    print("✅ План успешно сгенерирован и разобран.")
+    return plan_data
+
+# --- ПОТОКОВЫЙ РЕЖИМ ---
+
+class DayStreamParser:
+    """
+    Инкрементальный разбор JSON-ответа, приходящего кусками.
+    Отслеживает вложенность скобок и строк и возвращает каждый объект дня
+    сразу, как только закрылась его фигурная скобка.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        # Глубина первого встреченного массива - это список дней
+        self._days_depth = None
+        self._in_string = False
+        self._escape = False
+        self._capturing = False
+        self._buffer: List[str] = []
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Принимает очередной кусок текста и возвращает завершенные в нем дни."""
+        completed_days = []
+        for ch in chunk:
+            if self._capturing:
+                self._buffer.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == '[' or ch == '{':
+                self._depth += 1
+                if ch == '[' and self._days_depth is None:
+                    self._days_depth = self._depth
+                elif ch == '{' and not self._capturing and self._days_depth is not None \
+                        and self._depth == self._days_depth + 1:
+                    self._capturing = True
+                    self._buffer = [ch]
+            elif ch == ']' or ch == '}':
+                if self._capturing and ch == '}' and self._depth == self._days_depth + 1:
+                    day_plan = self._parse_buffer()
+                    if day_plan is not None:
+                        completed_days.append(day_plan)
+                self._depth -= 1
+        return completed_days
+
+    def _parse_buffer(self) -> Dict[str, Any] | None:
+        raw = ''.join(self._buffer)
+        self._capturing = False
+        self._buffer = []
+        try:
+            day_plan = json.loads(raw)
+        except json.JSONDecodeError as e:
+            print(f"❌ ОШИБКА ПАРСИНГА дня из потока: {e}")
+            return None
+        # Если модель вернула один день без списка, первым массивом окажутся блюда - их пропускаем
+        if not isinstance(day_plan, dict) or 'meals' not in day_plan:
+            return None
+        return day_plan
+
+
+def stream_weekly_plan(exclusion_list: List[str], use_cache: bool = True, profile: Dict[str, Any] | None = None) -> Iterator[Dict[str, Any]]:
+    """
+    Потоковая версия generate_weekly_plan: читает ответ OpenAI по мере генерации
+    и отдает каждый день, как только его JSON-объект полностью получен.
+    При обрыве потока уже отданные дни остаются у вызывающего кода.
+    """
+    with span("prompt_build"):
+        prompt = create_master_prompt(exclusion_list, profile)
+    parser = DayStreamParser()
+
+    if use_cache:
+        cached_content = _cached_content(prompt)
+        if cached_content is not None:
+            yield from parser.feed(cached_content)
+            return
+
+    client = get_client()
+    if client is None:
+        print("❌ Генерация невозможна: Клиент OpenAI не инициализирован.")
+        return
+
+    # Отданные пользователю дни не забрать назад, поэтому поток не переходит к другой модели:
+    # модель выбирается по статистике маршрутизатора, а итог проверки пополняет ее статистику
+    model = ROUTER.route("week_stream")[0]
+    print(f"--- 1. Потоковый запрос в OpenAI ({model}): Начинаем отправку. ---")
+
+    days_count = 0
+    content_parts = []
+    streamed_days = []
+    started = time.perf_counter()
+    usage = None
+    try:
+        stream = openai_transport.open_stream(
+            client, "week_stream",
+            model=model,
+            response_format={"type": "json_object"},
+            messages=_messages(prompt),
+            temperature=TEMPERATURE,
+            # Последний кусок потока несет usage - без него токены потока не посчитать
+            stream_options={"include_usage": True}
+        )
+
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            content_parts.append(delta)
+            for day_plan in parser.feed(delta):
+                days_count += 1
+                streamed_days.append(copy.deepcopy(day_plan))
+                print(f"--- 📦 Получен день {days_count}: {day_plan.get('day', '?')} ---")
+                yield day_plan
+
+        record_usage(model, usage)
+        print(f"✅ Поток завершен. Получено дней: {days_count}.")
+        problems = weekly_plan_problems(streamed_days, profile or USER_KZHBU, get_plan_dates())
+        ROUTER.record(model, "week_stream", time.perf_counter() - started, not problems, "validation" if problems else None, usage)
+        # Кэшируем только полностью дочитанный поток, из которого удалось получить дни и который прошел проверку
+        if days_count and not problems:
+            put_cached_response(make_cache_key(model, TEMPERATURE, SYSTEM_MESSAGE, prompt), model, ''.join(content_parts))
+
+    except Exception as e:
+        ROUTER.record(model, "week_stream", time.perf_counter() - started, False, "error", usage)
+        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА ПОТОКА OpenAI (Сетевая/API): {e}. Успели получить дней: {days_count}.")
+
+# --- ПАРАЛЛЕЛЬНЫЙ РЕЖИМ (ПО ДНЯМ) ---
+
+async def _request_json_async(prompt: str, use_cache: bool = True, kind: str = "day", check=None) -> Dict[str, Any] | None:
+    """
+    Один асинхронный запрос к OpenAI (или кэшу) по каскаду моделей, возвращает разобранный JSON-объект.
+    kind - вид запроса (day, meal): по нему отдельно считаются p95 для хеджирования и статистика моделей;
+    check(data) -> список проблем ответа (пустой - ответ принят, иначе запрос уходит модели сильнее).
+    """
+    if use_cache:
+        # Кэш - синхронный SQLite: читается вне event loop, чтобы не задерживать обновления других чатов
+        cached_content = await run_cache_io(_cached_content, prompt)
+        if cached_content is not None:
+            return json.loads(cached_content)
+
+    async_client = get_async_client()
+    if async_client is None:
+        raise RuntimeError("Клиент OpenAI не инициализирован.")
+
+    async def request(model: str):
+        with span("openai_request"):
+            response = await openai_transport.acomplete(
+                async_client, kind,
+                model=model,
+                response_format={"type": "json_object"},
+                messages=_messages(prompt),
+                temperature=TEMPERATURE
+            )
+        record_usage(model, response.usage)
+        return response.choices[0].message.content.strip(), response.usage
+
+    result = await arun_cascade(kind, request, _parse_json, check or (lambda data: []))
+    if result is None:
+        raise ValueError("ни одна модель каскада не вернула разборчивый JSON")
+    model, json_content, data, accepted = result
+    if accepted:
+        await run_cache_io(put_cached_response, make_cache_key(model, TEMPERATURE, SYSTEM_MESSAGE, prompt), model, json_content)
+    return data
+
+
+def _unwrap_object(data: Any, required_key: str) -> Dict[str, Any] | None:
+    """Модель иногда оборачивает объект в словарь или список - достаем объект с нужным ключом."""
+    if isinstance(data, dict):
+        if required_key in data:
+            return data
+        for value in data.values():
+            found = _unwrap_object(value, required_key)
+            if found is not None:
+                return found
+    elif isinstance(data, list) and data:
+        return _unwrap_object(data[0], required_key)
+    return None
+
+
+async def generate_day_plan_async(day_date: date, exclusion_list: List[str], use_cache: bool = True, profile: Dict[str, Any] | None = None) -> Dict[str, Any] | None:
+    """Генерирует план на один день. Возвращает объект дня или None при ошибке."""
+    try:
+        data = await _request_json_async(
+            create_day_prompt(day_date, exclusion_list, profile), use_cache,
+            check=lambda data: day_plan_problems(data, day_date, profile or USER_KZHBU)
+        )
     except json.JSONDecodeError as e:
-        print(f"❌ ОШИБКА ПАРСИНГА JSON: ИИ не смог вернуть чистый JSON. Ошибка: {e}")
+        print(f"❌ ОШИБКА ПАРСИНГА JSON дня {day_date}: {e}")
         return None
     except Exception as e:
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА ВЫЗОВА OpenAI (Сетевая/API): {e}")
+        print(f"❌ ОШИБКА ВЫЗОВА OpenAI для дня {day_date}: {e}")
         return None
 
+    day_plan = _unwrap_object(data, 'meals')
+    if day_plan is None:
+        print(f"❌ Ошибка формата: в ответе для дня {day_date} нет списка блюд.")
+        return None
+
+    # Дату и день недели проставляем сами - модель не должна их менять
+    day_plan['date'] = day_date.strftime("%Y-%m-%d")
+    day_plan['day'] = DAY_NAMES[day_date.weekday()]
+    return day_plan
+
+
+async def generate_meal_async(day_date: date, meal_type: str, exclusion_list: List[str], use_cache: bool = True, profile: Dict[str, Any] | None = None) -> Dict[str, Any] | None:
+    """Генерирует одно блюдо заданного типа. Возвращает объект блюда или None при ошибке."""
+    try:
+        data = await _request_json_async(
+            create_meal_prompt(day_date, meal_type, exclusion_list, profile), use_cache, kind="meal",
+            check=lambda data: meal_problems(data, meal_type, profile or USER_KZHBU)
+        )
+    except Exception as e:
+        print(f"❌ ОШИБКА генерации блюда '{meal_type}' на {day_date}: {e}")
+        return None
+
+    meal = _unwrap_object(data, 'meal_name')
+    if meal is not None:
+        meal['type'] = meal_type
+    return meal
+
+
+def normalize_meal_name(name: str) -> str:
+    return " ".join(str(name).lower().replace('ё', 'е').split())
+
+
+def find_duplicate_meals(weekly_plan: List[Dict[str, Any]]) -> List[tuple]:
+    """Возвращает позиции (индекс дня, индекс блюда) повторных блюд: первое вхождение остается."""
+    seen = set()
+    duplicates = []
+    for day_idx, day_plan in enumerate(weekly_plan):
+        for meal_idx, meal in enumerate(day_plan.get('meals', [])):
+            key = normalize_meal_name(meal.get('meal_name', ''))
+            if not key:
+                continue
+            if key in seen:
+                duplicates.append((day_idx, meal_idx))
+            else:
+                seen.add(key)
+    return duplicates
+
+
+async def generate_weekly_plan_parallel(exclusion_list: List[str], concurrency: int | None = None, use_cache: bool = True, profile: Dict[str, Any] | None = None) -> List[Dict[str, Any]] | None:
+    """
+    Генерирует неделю параллельно: по одному запросу на день, не больше
+    'concurrency' запросов одновременно. Затем убирает повторы блюд между днями,
+    перегенерируя только повторные блюда.
+    """
+    if not use_cache and get_async_client() is None:
+        print("❌ Генерация невозможна: Клиент OpenAI не инициализирован.")
+        return None
+
+    semaphore = asyncio.Semaphore(concurrency or GENERATION_CONCURRENCY)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    plan_dates = get_plan_dates()
+    # Исключения сжимаются один раз на всю неделю, а не в каждом из дневных промптов
+    compacted_exclusions = compact_exclusion_list(exclusion_list)
+    print(f"📉 Исключения для дневных промптов: {len(exclusion_list)} → {len(compacted_exclusions)} названий.")
+    print(f"--- 1. Параллельный запрос в OpenAI: {len(plan_dates)} дней, до {concurrency or GENERATION_CONCURRENCY} одновременно. ---")
+
+    results = await asyncio.gather(*(limited(generate_day_plan_async(d, compacted_exclusions, use_cache, profile)) for d in plan_dates))
+    weekly_plan = [day_plan for day_plan in results if day_plan is not None]
+    if not weekly_plan:
+        return None
+
+    print(f"--- 2. Получено дней: {len(weekly_plan)} из {len(plan_dates)}. ---")
+
+    # Недостающие дни и сломанные блюда перегенерируются точечно
+    weekly_plan = await repair_weekly_plan(weekly_plan, exclusion_list, use_cache, profile, expected_dates=plan_dates)
+
+    # --- УДАЛЕНИЕ ПОВТОРОВ МЕЖДУ ДНЯМИ ---
+    duplicates = find_duplicate_meals(weekly_plan)
+    if duplicates:
+        print(f"🔁 Найдено {len(duplicates)} повторных блюд между днями. Перегенерируем только их.")
+        # Блюда этой недели идут первыми: при сжатии до бюджета токенов они важнее истории
+        used_names = [
+            meal.get('meal_name', '') for day_plan in weekly_plan for meal in day_plan.get('meals', [])
+        ] + list(exclusion_list)
+        replacements = await asyncio.gather(*(
+            limited(generate_meal_async(
+                date.fromisoformat(weekly_plan[day_idx]['date']),
+                weekly_plan[day_idx]['meals'][meal_idx].get('type', 'Прием пищи'),
+                used_names,
+                use_cache,
+                profile
+            ))
+            for day_idx, meal_idx in duplicates
+        ))
+        for (day_idx, meal_idx), meal in zip(duplicates, replacements):
+            if meal is not None:
+                weekly_plan[day_idx]['meals'][meal_idx] = meal
+            else:
+                print(f"⚠️ Не удалось заменить повтор в дне {weekly_plan[day_idx]['date']}, оставляем как есть.")
+
+    print("✅ План успешно сгенерирован параллельно.")
+    return weekly_plan
+
+# --- ТОЧЕЧНЫЙ РЕМОНТ ПЛАНА ---
+
+def _estimate_full_regeneration_tokens(plan: List[Dict[str, Any]], exclusion_list: List[str], profile: Dict[str, Any] | None) -> int:
+    """Оценка стоимости полной перегенерации недели: мастер-промпт плюс ответ на все блюда недели."""
+    meals_count = sum(len(day_plan.get('meals', [])) for day_plan in plan)
+    tokens_per_meal = count_tokens(json.dumps(plan, ensure_ascii=False)) / meals_count if meals_count else 0
+    full_meals_count = len(get_plan_dates()) * len(MEAL_TYPES)
+    return count_tokens(create_master_prompt(exclusion_list, profile, report=False)) + int(tokens_per_meal * full_meals_count)
+
+
+async def repair_weekly_plan(plan: List[Any], exclusion_list: List[str], use_cache: bool = True, profile: Dict[str, Any] | None = None, expected_dates: List[date] | None = None) -> List[Dict[str, Any]]:
+    """
+    Проверяет план по схеме и перегенерирует только сломанные фрагменты:
+    отсутствующие или непригодные дни (если задан expected_dates) и отдельные блюда.
+    Исправленные фрагменты вставляются в план на свои места. Возвращает исправленный план.
+    """
+    report = PLAN_VALIDATOR.validate(plan, expected_dates)
+    if PlanValidator.is_clean(report):
+        return plan
+
+    print(f"🩹 План не прошел проверку схемы ({len(report['errors'])} ошибок): {'; '.join(report['errors'][:5])}")
+    print(
+        f"🩹 Ремонт: дней {len(report['missing_dates'])}, блюд "
+        f"{len(report['invalid_meals']) + len(report['missing_meals'])} (вместо перегенерации всей недели)."
+    )
+
+    # Блюда этого плана идут первыми: при сжатии до бюджета токенов они важнее истории
+    used_names = [
+        meal.get('meal_name', '') for day_plan in plan for meal in day_plan['meals'] if isinstance(meal, dict)
+    ] + list(exclusion_list)
+    compacted_exclusions = compact_exclusion_list(used_names)
+    semaphore = asyncio.Semaphore(GENERATION_CONCURRENCY)
+    tokens_spent = 0
+
+    async def repair_day(day_date: date):
+        nonlocal tokens_spent
+        async with semaphore:
+            day_plan = await generate_day_plan_async(day_date, compacted_exclusions, use_cache, profile)
+        tokens_spent += count_tokens(create_day_prompt(day_date, compacted_exclusions, profile))
+        if day_plan is not None:
+            tokens_spent += count_tokens(json.dumps(day_plan, ensure_ascii=False))
+        return day_plan
+
+    async def repair_meal(day_idx: int, meal_type: str):
+        nonlocal tokens_spent
+        day_date = date.fromisoformat(plan[day_idx]['date'])
+        async with semaphore:
+            meal = await generate_meal_async(day_date, meal_type, compacted_exclusions, use_cache, profile)
+        tokens_spent += count_tokens(create_meal_prompt(day_date, meal_type, compacted_exclusions, profile))
+        if meal is not None:
+            tokens_spent += count_tokens(json.dumps(meal, ensure_ascii=False))
+        return meal
+
+    meal_slots = [(day_idx, meal_type) for day_idx, _, meal_type, _ in report['invalid_meals']] + report['missing_meals']
+    day_results, meal_results = await asyncio.gather(
+        asyncio.gather(*(repair_day(d) for d in report['missing_dates'])),
+        asyncio.gather(*(repair_meal(day_idx, meal_type) for day_idx, meal_type in meal_slots)),
+    )
+
+    # Вставка блюд: по типу приема пищи, в порядке MEAL_TYPES
+    repaired_meals = 0
+    for (day_idx, meal_type), meal in zip(meal_slots, meal_results):
+        if meal is None:
+            print(f"⚠️ Не удалось перегенерировать '{meal_type}' на {plan[day_idx]['date']}.")
+            continue
+        meals = [m for m in plan[day_idx]['meals'] if not (isinstance(m, dict) and m.get('type') == meal_type)]
+        meals.append(meal)
+        meals.sort(key=lambda m: MEAL_TYPES.index(m['type']) if isinstance(m, dict) and m.get('type') in MEAL_TYPES else len(MEAL_TYPES))
+        plan[day_idx]['meals'] = meals
+        repaired_meals += 1
+
+    repaired_days = 0
+    for day_date, day_plan in zip(report['missing_dates'], day_results):
+        if day_plan is None:
+            print(f"⚠️ Не удалось перегенерировать день {day_date}.")
+            continue
+        plan.append(day_plan)
+        repaired_days += 1
+    plan.sort(key=lambda day_plan: day_plan['date'])
+
+    # Повторная проверка без нового ремонта: только для лога, чтобы ремонт не зациклился
+    leftover = PLAN_VALIDATOR.validate(plan, expected_dates)
+    if not PlanValidator.is_clean(leftover):
+        print(f"⚠️ После ремонта остались ошибки: {'; '.join(leftover['errors'][:5])}")
+
+    tokens_saved = max(0, _estimate_full_regeneration_tokens(plan, exclusion_list, profile) - tokens_spent)
+    REPAIR_STATS["repaired_days"] += repaired_days
+    REPAIR_STATS["repaired_meals"] += repaired_meals
+    REPAIR_STATS["tokens_spent"] += tokens_spent
+    REPAIR_STATS["tokens_saved"] += tokens_saved
+    print(
+        f"🩹 Ремонт завершен: дней {repaired_days}, блюд {repaired_meals}; "
+        f"~{tokens_spent} токенов вместо полной перегенерации (экономия ~{tokens_saved})."
+    )
+    return plan
+
 # --- ТЕСТОВЫЙ ЗАПУСК ---
 if __name__ == '__main__':
     print("--- Тестовый запуск ai_generator.py ---")
@@ -0,0 +1,552 @@
+# Офлайн-бенчмарки бота: все запросы к OpenAI и Telegram идут в локальные заглушки (stub_servers.py).
+#
+# Запуск:
+#     python benchmark.py                      # полный прогон, JSON в stdout
+#     python benchmark.py --sizes 1000,100000 --output bench.json
+#     python benchmark.py --llm-latency 0.5 --repeat 3
+#     python benchmark.py --cold-start-only   # только холодный старт (импорт main и время до первого опроса)
+#
+# Результат - JSON с медианой и p95 (мс) по каждому сценарию, чтобы регрессии были видны в diff.
+# Если импорт main дольше --cold-start-budget-ms, процесс завершается с кодом 1.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import asyncio
+import datetime
+import sqlite3
+import tempfile
+import platform
+import statistics
+import subprocess
+
+from stub_servers import StubOpenAIServer, StubBotAPIServer, VALID, MALFORMED_JSON, BROKEN_MEAL
+
+BENCH_CHAT_ID = 1001
+# Сколько чатов в "чужой" истории при наполнении БД
+SEED_CHATS = 100
+# Чаты для сценария пакетной генерации (на каждый исполнитель)
+BULK_FIRST_CHAT = 50000
+BULK_CHATS = 20
+# Хвост задержек OpenAI для сценария хеджирования: каждый N-й запрос отвечает в SLOW_FACTOR раз дольше
+TAIL_SLOW_EVERY = 50
+TAIL_SLOW_FACTOR = 15
+TAIL_REQUESTS = 200
+# Сценарий каскада моделей: сильная модель в STRONG_LATENCY_FACTOR раз медленнее дешевой
+CASCADE_PLANS = 20
+STRONG_LATENCY_FACTOR = 3
+# Бюджет времени импорта main (мс, медиана), по умолчанию для холодного старта
+COLD_START_BUDGET_MS = 800
+# Сколько ждать первого опроса getUpdates от запущенного бота, секунды
+FIRST_POLL_TIMEOUT = 60
+
+
+def _summary(samples_ms: list) -> dict:
+    ordered = sorted(samples_ms)
+    return {
+        "n": len(ordered),
+        "p50_ms": round(statistics.median(ordered), 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+async def _timed(coro_factory, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await coro_factory()
+        samples.append((time.perf_counter() - started) * 1000)
+    return _summary(samples)
+
+
+async def run_transport(args) -> dict:
+    """
+    Хвост задержек и повторы транспорта OpenAI на запросах одного дня: без хеджа и с хеджем
+    при редких медленных ответах заглушки, затем повторы при 503 на каждом четвертом запросе.
+    """
+    import ai_generator
+    import openai_transport
+
+    results = {}
+    stub = args.openai_stub
+    day = datetime.date.today()
+    semaphore = asyncio.Semaphore(ai_generator.GENERATION_CONCURRENCY)
+
+    async def one_request(samples: list, failures: list):
+        async with semaphore:
+            started = time.perf_counter()
+            day_plan = await ai_generator.generate_day_plan_async(day, [], use_cache=False)
+            samples.append((time.perf_counter() - started) * 1000)
+            if day_plan is None:
+                failures.append(1)
+
+    stub.slow_every, stub.slow_latency = TAIL_SLOW_EVERY, args.llm_latency * TAIL_SLOW_FACTOR
+    hedging_before = openai_transport.OPENAI_HEDGING
+    # Прогон без хеджа заодно наполняет окно задержек, по которому считается p95 для хеджа
+    for hedging in (False, True):
+        openai_transport.OPENAI_HEDGING = hedging
+        samples, failures = [], []
+        llm_before = stub.requests
+        await asyncio.gather(*(one_request(samples, failures) for _ in range(TAIL_REQUESTS)))
+        ordered = sorted(samples)
+        results[f"transport.tail.hedging_{'on' if hedging else 'off'}"] = {
+            **_summary(samples),
+            "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+            "mean_ms": round(statistics.mean(ordered), 3),
+            "failed": len(failures),
+            "llm_requests_per_call": round((stub.requests - llm_before) / TAIL_REQUESTS, 3),
+        }
+    openai_transport.OPENAI_HEDGING = hedging_before
+    stub.slow_every = 0
+
+    retry_delay_before = openai_transport.OPENAI_RETRY_BASE_DELAY
+    openai_transport.OPENAI_RETRY_BASE_DELAY = 0.05
+    stub.fail_every = 4
+    samples, failures = [], []
+    llm_before = stub.requests
+    await asyncio.gather(*(one_request(samples, failures) for _ in range(TAIL_REQUESTS // 4)))
+    results["transport.retry_503"] = {
+        **_summary(samples),
+        "failed": len(failures),
+        "llm_requests_per_call": round((stub.requests - llm_before) / (TAIL_REQUESTS // 4), 3),
+    }
+    stub.fail_every = 0
+    openai_transport.OPENAI_RETRY_BASE_DELAY = retry_delay_before
+    results["transport.latency_window"] = openai_transport.transport_stats()
+    return results
+
+
+async def run_cascade(args) -> dict:
+    """
+    Каскад моделей на недельных планах: дешевая модель иногда (и затем всегда) промахивается
+    мимо целей КЖБУ. Сколько запросов уходит сильной модели, задержка и доля принятых планов.
+    """
+    import ai_generator
+    import model_router
+    import metrics
+
+    results = {}
+    stub = args.openai_stub
+    cheap, strong = model_router.MODEL_CASCADE[0], model_router.MODEL_CASCADE[-1]
+    stub.model_latency = {strong: args.llm_latency * STRONG_LATENCY_FACTOR}
+    stub.weak_model = cheap
+    profile = ai_generator.USER_KZHBU
+
+    def strong_requests() -> float:
+        return metrics.summary()["requests"].get(strong, 0)
+
+    # weak_every: 5 - промах в 20% ответов, 1 - дешевая модель не справляется никогда (ее пора пропускать)
+    for label, weak_every, plans in (("off_target_20pct", 5, CASCADE_PLANS), ("off_target_100pct", 1, CASCADE_PLANS * 2)):
+        stub.weak_every = weak_every
+        samples, accepted = [], 0
+        llm_before, strong_before = stub.requests, strong_requests()
+        for _ in range(plans):
+            started = time.perf_counter()
+            plan_data = await asyncio.to_thread(ai_generator.generate_weekly_plan, [], False, profile)
+            samples.append((time.perf_counter() - started) * 1000)
+            if plan_data is not None and not ai_generator.weekly_plan_problems(plan_data, profile, ai_generator.get_plan_dates()):
+                accepted += 1
+        results[f"cascade.week.{label}"] = {
+            **_summary(samples),
+            "accepted_plans": accepted,
+            "llm_requests_per_plan": round((stub.requests - llm_before) / plans, 2),
+            "strong_model_share": round((strong_requests() - strong_before) / (stub.requests - llm_before), 3),
+            "route_now": model_router.ROUTER.route("week"),
+        }
+
+    stub.weak_every = 0
+    stub.model_latency = {}
+    results["cascade.router_stats"] = model_router.ROUTER.stats()
+    return results
+
+
+async def run_llm_cache(args, command, main) -> dict:
+    """
+    Кэш ответов LLM включается только здесь (в остальных сценариях LLM_CACHE_DISABLED=1):
+    первая генерация недели - промах и запрос к OpenAI, повтор той же недели - попадание без запросов.
+    """
+    import llm_cache
+
+    results = {}
+    main.GENERATION_MODE = "batch"
+    llm_cache.CACHE_ENABLED = True
+    try:
+        for label in ("first_run", "retry"):
+            llm_before, hits_before = args.openai_stub.requests, llm_cache.CACHE_STATS["hits"]
+            started = time.perf_counter()
+            await command("/generate_test")
+            await main.generation_queue.join()
+            results[f"llm_cache.{label}"] = {
+                "ms": round((time.perf_counter() - started) * 1000, 3),
+                "llm_requests": args.openai_stub.requests - llm_before,
+                "cache_hits": llm_cache.CACHE_STATS["hits"] - hits_before,
+            }
+    finally:
+        llm_cache.CACHE_ENABLED = False
+    return results
+
+
+def _plan_rows(database_file: str, plan_dates: list) -> tuple[int, int]:
+    """(всего записей, различных (дата, прием пищи)) чата бенчмарка на даты плана."""
+    with sqlite3.connect(database_file) as connection:
+        placeholders = ",".join("?" * len(plan_dates))
+        return connection.execute(
+            f"SELECT COUNT(*), COUNT(DISTINCT meal_date || meal_type) FROM recipes_history "
+            f"WHERE chat_id = ? AND meal_date IN ({placeholders})",
+            [BENCH_CHAT_ID, *(d.isoformat() for d in plan_dates)]
+        ).fetchone()
+
+
+async def run_single_flight(args, command, main, db_manager) -> dict:
+    """
+    Повторные /generate_test на ту же неделю: сколько генераций и запросов к OpenAI они вызывают,
+    не появляются ли в истории повторные записи. /cancel: сколько проходит до остановки генерации.
+    """
+    results = {}
+    stub = args.openai_stub
+    plan_dates = main.get_plan_dates()
+    main.GENERATION_MODE = "stream"
+    queue_before = main.generation_queue.stats()
+
+    # Три нажатия подряд, пока первая генерация еще идет
+    llm_before = stub.requests
+    started = time.perf_counter()
+    await asyncio.gather(*(command("/generate_test fresh") for _ in range(3)))
+    await main.generation_queue.join()
+    total_rows, unique_slots = _plan_rows(db_manager.DATABASE_FILE, plan_dates)
+    queue_after = main.generation_queue.stats()
+    results["single_flight.triple_tap"] = {
+        "seconds": round(time.perf_counter() - started, 3),
+        "llm_requests": stub.requests - llm_before,
+        "attached_requests": queue_after["attached"] - queue_before["attached"],
+        "plan_rows": total_rows,
+        "duplicate_rows": total_rows - unique_slots,
+    }
+
+    # Отмена посреди генерации: медленная заглушка, /cancel через долю ее задержки
+    latency_before = stub.latency
+    stub.latency = max(args.llm_latency, 0.2) * 5
+    await command("/generate_test fresh")
+    await asyncio.sleep(stub.latency / 4)
+    cancel_started = time.perf_counter()
+    await command("/cancel")
+    await main.generation_queue.join()
+    results["single_flight.cancel"] = {
+        "cancel_to_idle_ms": round((time.perf_counter() - cancel_started) * 1000, 3),
+        "cancelled": main.generation_queue.stats()["cancelled"] - queue_before["cancelled"],
+    }
+    stub.latency = latency_before
+    return results
+
+
+def _command_update(update_id: int, text: str) -> dict:
+    """Сырое обновление Telegram с командой от чата бенчмарка."""
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": BENCH_CHAT_ID, "type": "private"},
+            "from": {"id": BENCH_CHAT_ID, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def seed_history(database_file: str, target_rows: int):
+    """Дополняет recipes_history до target_rows строк (быстрой вставкой через sqlite3, минуя ORM)."""
+    connection = sqlite3.connect(database_file)
+    current = connection.execute("SELECT COUNT(*) FROM recipes_history").fetchone()[0]
+    missing = target_rows - current
+    if missing > 0:
+        today = datetime.date.today()
+        rng = random.Random(current)
+        batch = []
+        for i in range(current, target_rows):
+            chat_id = BENCH_CHAT_ID if i % SEED_CHATS == 0 else 2000 + i % SEED_CHATS
+            batch.append((
+                chat_id, (today - datetime.timedelta(days=rng.randrange(730))).isoformat(),
+                f"Блюдо истории {rng.randrange(5000)}", "Обед", 1000.0, 75.0, 30.0, 110.0, 400, 300,
+                "Ингредиенты:\n- Рис — 150 г\nПриготовление:\n1. Отварить.",
+            ))
+            if len(batch) == 50000:
+                connection.executemany(_SEED_SQL, batch)
+                batch = []
+        if batch:
+            connection.executemany(_SEED_SQL, batch)
+        connection.commit()
+    connection.close()
+
+
+_SEED_SQL = (
+    "INSERT INTO recipes_history (chat_id, meal_date, meal_name, meal_type, kcal, protein, fat, carbs, "
+    "weight_m, weight_w, recipe_full) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def _import_time_ms(env: dict) -> tuple[float, list]:
+    """
+    Время импорта main в новом процессе по python -X importtime (мс, накопительно)
+    и самые тяжелые модули верхнего уровня: [(модуль, мс), ...].
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+    )
+    total_ms, top_level = None, []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        # Модули, импортированные напрямую из main, идут с отступом в 2 пробела
+        if name.startswith("   ") and not name.startswith("    "):
+            top_level.append((name.strip(), int(cumulative) / 1000))
+        if name.strip() == "main":
+            total_ms = int(cumulative) / 1000
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return total_ms, [(module, round(ms, 1)) for module, ms in top_level[:5]]
+
+
+def _first_poll_ms(env: dict, bot_stub) -> float | None:
+    """Время от запуска python main.py до первого запроса getUpdates к заглушке Bot API (мс)."""
+    bot_stub.first_poll_at = None
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "main.py"], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while bot_stub.first_poll_at is None and process.poll() is None:
+            if time.perf_counter() - started > FIRST_POLL_TIMEOUT:
+                break
+            time.sleep(0.005)
+        return (bot_stub.first_poll_at - started) * 1000 if bot_stub.first_poll_at is not None else None
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_cold_start(args, bot_stub, workdir: str) -> dict:
+    """Холодный старт: импорт main (python -X importtime) и время до первого опроса Telegram."""
+    results = {}
+    import_samples, top_imports = [], []
+    poll_samples = []
+    for attempt in range(args.repeat):
+        env = dict(os.environ, DATABASE_FILE=os.path.join(workdir, f"cold_start_{attempt}.db"), BOT_MODE="polling")
+        total_ms, top_imports = _import_time_ms(env)
+        if total_ms is not None:
+            import_samples.append(total_ms)
+        poll_ms = _first_poll_ms(env, bot_stub)
+        if poll_ms is not None:
+            poll_samples.append(poll_ms)
+
+    if import_samples:
+        results["cold_start.import_main"] = {**_summary(import_samples), "top_imports": top_imports}
+    if poll_samples:
+        results["cold_start.first_poll"] = _summary(poll_samples)
+    import_p50 = statistics.median(import_samples) if import_samples else None
+    results["cold_start.budget"] = {
+        "budget_ms": args.cold_start_budget_ms,
+        "import_p50_ms": round(import_p50, 3) if import_p50 is not None else None,
+        "within_budget": import_p50 is not None and import_p50 <= args.cold_start_budget_ms,
+    }
+    return results
+
+
+async def run_benchmarks(args) -> dict:
+    # Импорт после настройки окружения: клиенты и движок БД создаются при импорте модулей
+    from telegram import Update
+    from telegram.ext import Application
+    import main
+    import db_manager
+
+    results = {}
+    application = (
+        Application.builder()
+        .token("0:bench")
+        .base_url(os.environ["TELEGRAM_BASE_URL"])
+        .concurrent_updates(True)
+        .build()
+    )
+    main.register_handlers(application)
+    await db_manager.init_db(default_chat_id=BENCH_CHAT_ID)
+    await application.initialize()
+    await main.generation_queue.start()
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def command(text: str):
+        await application.process_update(Update.de_json(_command_update(next(update_ids), text), application.bot))
+
+    # --- 1. КОМАНДЫ ЦЕЛИКОМ (через обработчики приложения, заглушки OpenAI и Bot API) ---
+    for mode in ("stream", "batch", "parallel", "library"):
+        for payload_mode in (VALID, BROKEN_MEAL, MALFORMED_JSON):
+            if mode != "batch" and payload_mode != VALID:
+                continue
+            main.GENERATION_MODE = mode
+            args.openai_stub.mode = payload_mode
+            llm_before = args.openai_stub.requests
+
+            async def generate():
+                await command("/generate_test fresh")
+                await main.generation_queue.join()
+
+            summary = await _timed(generate, args.repeat)
+            summary["llm_requests_per_run"] = round((args.openai_stub.requests - llm_before) / args.repeat, 2)
+            results[f"generate_test.{mode}.{payload_mode}"] = summary
+    args.openai_stub.mode = VALID
+
+    # --- КЭШ ОТВЕТОВ LLM: ПОВТОР ГЕНЕРАЦИИ ТОЙ ЖЕ НЕДЕЛИ (например, после сбоя доставки) ---
+    results.update(await run_llm_cache(args, command, main))
+
+    # --- ПОВТОРНЫЕ ЗАПРОСЫ НА ТУ ЖЕ НЕДЕЛЮ (single-flight) И ОТМЕНА ---
+    results.update(await run_single_flight(args, command, main, db_manager))
+
+    # --- ПАКЕТНАЯ ГЕНЕРАЦИЯ ДЛЯ МНОГИХ ЧАТОВ (bulk_pipeline.py, пропускная способность в планах/мин) ---
+    from bulk_pipeline import BulkPipeline
+    workdir = os.path.dirname(db_manager.DATABASE_FILE)
+    for offset, runner in enumerate(("concurrent", "batch")):
+        for chat_id in range(BULK_FIRST_CHAT + offset * BULK_CHATS, BULK_FIRST_CHAT + (offset + 1) * BULK_CHATS):
+            await db_manager.save_profile(chat_id, main.USER_KZHBU)
+        report = await BulkPipeline(os.path.join(workdir, f"bulk_{runner}.jsonl"), runner).run()
+        results[f"bulk.{runner}"] = {key: report[key] for key in ("jobs", "completed", "failed", "seconds", "plans_per_minute")}
+
+    # --- ТРАНСПОРТ OpenAI: ХВОСТ ЗАДЕРЖЕК С ХЕДЖЕМ И БЕЗ, ПОВТОРЫ ПРИ 503 ---
+    results.update(await run_transport(args))
+
+    # --- КАСКАД МОДЕЛЕЙ: ПЕРЕХОД К СИЛЬНОЙ МОДЕЛИ ТОЛЬКО ПРИ НЕПРОШЕДШЕЙ ПРОВЕРКЕ ---
+    results.update(await run_cascade(args))
+
+    # Меню на сегодня, чтобы /today отправлял настоящий день
+    today = datetime.date.today()
+    await main.save_plan_recipes([
+        {'meal_date': today, 'meal_name': f'Блюдо дня {t}', 'meal_type': t, 'kcal': 1000, 'protein': 75,
+         'fat': 30, 'carbs': 110, 'weight_m': 400, 'weight_w': 300, 'recipe_full': 'Ингредиенты:\n- Рис — 150 г\n' * 20}
+        for t in ("Завтрак", "Обед", "Перекус", "Ужин")
+    ], BENCH_CHAT_ID)
+    results["today.cached"] = await _timed(lambda: command("/today"), args.repeat * 10)
+
+    results["clear_history"] = await _timed(lambda: command("/clear_history"), 1)
+
+    # --- 2. ЗАПРОСЫ К БД НА РАЗНЫХ ОБЪЕМАХ ИСТОРИИ ---
+    sample_day = [
+        {'meal_date': today + datetime.timedelta(days=30), 'meal_name': f'Новое блюдо {i}', 'meal_type': 'Обед',
+         'kcal': 1000, 'protein': 75, 'fat': 30, 'carbs': 110, 'weight_m': 400, 'weight_w': 300, 'recipe_full': '...'}
+        for i in range(4)
+    ]
+    for size in args.sizes:
+        seed_started = time.perf_counter()
+        seed_history(db_manager.DATABASE_FILE, size)
+        results[f"db.{size}.seed_seconds"] = round(time.perf_counter() - seed_started, 2)
+        results[f"db.{size}.get_exclusion_list"] = await _timed(
+            lambda: db_manager.get_exclusion_list(days=21, chat_id=BENCH_CHAT_ID), args.repeat * 4
+        )
+        results[f"db.{size}.save_recipes"] = await _timed(
+            lambda: db_manager.save_recipes(sample_day, chat_id=BENCH_CHAT_ID), args.repeat * 4
+        )
+
+    # Уплотнение наполненной истории (как в работающем боте): тексты без повторов, архив старых записей, incremental_vacuum
+    compact_started = time.perf_counter()
+    report = await db_manager.compact_history()
+    results["db.compact"] = {"seconds": round(time.perf_counter() - compact_started, 2), **report}
+    results["db.compact.get_exclusion_list"] = await _timed(
+        lambda: db_manager.get_exclusion_list(days=21, chat_id=BENCH_CHAT_ID), args.repeat * 4
+    )
+
+    # Разбивка по фазам и токены за весь прогон (из metrics.py)
+    import metrics
+    results["metrics"] = metrics.summary()
+
+    await main.generation_queue.stop()
+    await application.shutdown()
+    await db_manager.dispose_db()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота рецептов.")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="Объемы истории (строк), через запятую.")
+    parser.add_argument("--repeat", type=int, default=3, help="Повторов каждого сценария.")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Задержка заглушки OpenAI, секунды.")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="Задержка заглушки Bot API, секунды.")
+    parser.add_argument("--output", help="Файл для JSON-результата (по умолчанию stdout).")
+    parser.add_argument("--cold-start-budget-ms", type=float, default=COLD_START_BUDGET_MS,
+                        help="Бюджет времени импорта main, мс (медиана).")
+    parser.add_argument("--cold-start-only", action="store_true", help="Только сценарии холодного старта.")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+    return args
+
+
+def main():
+    args = parse_args()
+    args.openai_stub = StubOpenAIServer(latency=args.llm_latency).start()
+    bot_stub = StubBotAPIServer(latency=args.bot_latency).start()
+    workdir = tempfile.mkdtemp(prefix="recipes-bench-")
+
+    # Окружение задается до импорта модулей бота
+    os.environ.update({
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": args.openai_stub.base_url,
+        "TELEGRAM_TOKEN": "0:bench",
+        "TELEGRAM_BASE_URL": bot_stub.base_url,
+        "YOUR_CHAT_ID": str(BENCH_CHAT_ID),
+        "DATABASE_FILE": os.path.join(workdir, "recipes.db"),
+        "LLM_CACHE_DISABLED": "1",
+        "BATCH_POLL_SECONDS": "0.05",
+    })
+
+    # Логи бота - в stderr, чтобы stdout оставался чистым JSON
+    real_stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        started = time.perf_counter()
+        # Холодный старт - первым, в отдельных процессах (до импорта модулей бота в этом процессе)
+        results = run_cold_start(args, bot_stub, workdir)
+        if not args.cold_start_only:
+            results.update(asyncio.run(run_benchmarks(args)))
+        total_seconds = round(time.perf_counter() - started, 2)
+    finally:
+        sys.stdout = real_stdout
+        args.openai_stub.stop()
+        bot_stub.stop()
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "llm_latency_s": args.llm_latency,
+            "bot_latency_s": args.bot_latency,
+            "repeat": args.repeat,
+            "sizes": args.sizes,
+            "total_seconds": total_seconds,
+            "telegram_messages_sent": len(bot_stub.sent_messages),
+        },
+        "results": dict(sorted(results.items())),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    budget = results["cold_start.budget"]
+    if not budget["within_budget"]:
+        print(
+            f"❌ Холодный старт вне бюджета: импорт main {budget['import_p50_ms']} мс > {budget['budget_ms']} мс.",
+            file=sys.stderr
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
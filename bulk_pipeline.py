@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import types
+import asyncio
+import argparse
+import datetime
+import traceback
+from typing import Any, Dict, List
+
+from db_manager import (
+    DATABASE_FILE, init_db, dispose_db, list_profile_chat_ids, get_profile,
+    get_prepared_plan
+)
+from ai_generator import (
+    create_master_prompt, repair_weekly_plan, get_plan_dates, get_async_client,
+    MODEL_NAME, TEMPERATURE, SYSTEM_MESSAGE, USER_KZHBU
+)
+from plan_validator import extract_day_list
+from plan_service import build_weekly_message, save_weekly_plan, load_exclusions
+from portion_optimizer import optimize_plan_portions
+from metrics import span, record_usage
+from openai_transport import acomplete
+
+# --- НАСТРОЙКИ ПАКЕТНОЙ ГЕНЕРАЦИИ ---
+# Файл заданий в формате входного файла OpenAI Batch API (одна строка - один запрос)
+BULK_JOBS_FILE = os.getenv(
+    "BULK_JOBS_FILE", os.path.join(os.path.dirname(DATABASE_FILE), "generation_jobs.jsonl")
+)
+# "concurrent" - параллельные запросы с ограничением, "batch" - OpenAI Batch API (дешевле, но дольше)
+BULK_RUNNER = os.getenv("BULK_RUNNER", "concurrent").lower()
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+# Как часто опрашивать статус пакета в Batch API (секунды)
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "10"))
+
+_BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def _custom_id(chat_id: int, week_start: datetime.date) -> str:
+    return f"plan-{chat_id}-{week_start.isoformat()}"
+
+
+def _parse_custom_id(custom_id: str) -> tuple[int, datetime.date]:
+    _, chat_id, week_start = custom_id.split("-", 2)
+    return int(chat_id), datetime.date.fromisoformat(week_start)
+
+
+def read_jsonl(path: str) -> List[Dict[str, Any]]:
+    """Строки JSONL-файла; оборванная последняя строка (сбой во время записи) пропускается."""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def append_checkpoint(path: str, record: Dict[str, Any]):
+    """Дописывает результат в файл контрольных точек и сбрасывает его на диск сразу."""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class BulkPipeline:
+    """
+    Пакетная генерация недельных планов для всех чатов, у которых еще нет плана на следующую неделю.
+
+    Файлы рядом с БД:
+      generation_jobs.jsonl          - задания (формат входного файла Batch API);
+      generation_jobs.results.jsonl  - контрольные точки: сырой ответ модели на каждое задание;
+      generation_jobs.state.json     - id отправленного пакета Batch API (чтобы не отправлять его повторно).
+    После перезапуска уже полученные ответы не запрашиваются снова, а готовые планы (prepared_plans) не пересобираются.
+    """
+
+    def __init__(self, jobs_file: str = BULK_JOBS_FILE, runner: str = BULK_RUNNER, concurrency: int = BULK_CONCURRENCY):
+        self.jobs_file = jobs_file
+        base = jobs_file[:-len(".jsonl")] if jobs_file.endswith(".jsonl") else jobs_file
+        self.results_file = base + ".results.jsonl"
+        self.state_file = base + ".state.json"
+        self.runner = runner
+        self.concurrency = concurrency
+        self._report = {}
+
+    # --- ЗАДАНИЯ ---
+
+    async def _build_jobs(self, week_start: datetime.date) -> List[Dict[str, Any]]:
+        """Задания для всех зарегистрированных чатов без подготовленного плана на неделю."""
+        jobs = []
+        for chat_id in await list_profile_chat_ids():
+            if await get_prepared_plan(chat_id, week_start, include_delivered=True) is not None:
+                continue
+            profile = await get_profile(chat_id) or USER_KZHBU
+            exclusion_list, profile = await load_exclusions(chat_id, profile)
+            jobs.append({
+                "custom_id": _custom_id(chat_id, week_start),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL_NAME,
+                    "response_format": {"type": "json_object"},
+                    "messages": [
+                        {"role": "system", "content": SYSTEM_MESSAGE},
+                        {"role": "user", "content": create_master_prompt(exclusion_list, profile, report=False)},
+                    ],
+                    "temperature": TEMPERATURE,
+                },
+            })
+        return jobs
+
+    async def _load_or_create_jobs(self, week_start: datetime.date) -> List[Dict[str, Any]]:
+        """Задания текущей недели из файла (продолжение после сбоя) или новый файл заданий."""
+        jobs = read_jsonl(self.jobs_file)
+        if jobs and all(_parse_custom_id(job["custom_id"])[1] == week_start for job in jobs):
+            print(f"📦 Продолжаем пакет из {self.jobs_file}: заданий {len(jobs)}.")
+            return jobs
+
+        jobs = await self._build_jobs(week_start)
+        # Новая неделя - старые контрольные точки и пакет больше не нужны
+        for path in (self.results_file, self.state_file):
+            if os.path.exists(path):
+                os.remove(path)
+        _write_atomic(self.jobs_file, "".join(json.dumps(job, ensure_ascii=False) + "\n" for job in jobs))
+        print(f"📦 Файл заданий {self.jobs_file}: заданий {len(jobs)}.")
+        return jobs
+
+    # --- ПРИМЕНЕНИЕ РЕЗУЛЬТАТА ---
+
+    async def _apply(self, custom_id: str, content: str) -> bool:
+        """Ответ модели -> проверка и ремонт, подбор порций, сохранение рецептов и готового плана. Идемпотентно."""
+        chat_id, week_start = _parse_custom_id(custom_id)
+        if await get_prepared_plan(chat_id, week_start, include_delivered=True) is not None:
+            return True
+        try:
+            with span("parse"):
+                weekly_plan = extract_day_list(json.loads(content))
+            if weekly_plan is None:
+                print(f"❌ {custom_id}: в ответе нет списка дней.")
+                return False
+
+            profile = await get_profile(chat_id) or USER_KZHBU
+            exclusion_list, profile = await load_exclusions(chat_id, profile)
+            with span("validate_repair"):
+                weekly_plan = await repair_weekly_plan(weekly_plan, exclusion_list, profile=profile, expected_dates=get_plan_dates())
+            if not weekly_plan:
+                return False
+            with span("portion_optimization"):
+                optimize_plan_portions(weekly_plan, profile)
+            telegram_message, recipes_to_save = build_weekly_message(weekly_plan)
+            # Готовый план (prepared_plans) - признак завершенного задания (его отправит еженедельная рассылка)
+            return await save_weekly_plan(chat_id, telegram_message, recipes_to_save)
+        except Exception:
+            print(f"❌ {custom_id}: ошибка обработки ответа:\n{traceback.format_exc()}")
+            return False
+
+    async def _checkpoint_and_apply(self, custom_id: str, content: str, usage: Dict[str, Any] | None):
+        append_checkpoint(self.results_file, {"custom_id": custom_id, "content": content, "usage": usage})
+        record_usage(MODEL_NAME, types.SimpleNamespace(**usage) if usage else None)
+        if await self._apply(custom_id, content):
+            self._report["completed"] += 1
+        else:
+            self._report["failed"] += 1
+
+    # --- ИСПОЛНИТЕЛИ ---
+
+    async def _run_concurrent(self, jobs: List[Dict[str, Any]]):
+        """Обычные запросы chat.completions, не больше concurrency одновременно."""
+        client = get_async_client()
+        if client is None:
+            raise RuntimeError("Клиент OpenAI не инициализирован.")
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_job(job: Dict[str, Any]):
+            async with semaphore:
+                try:
+                    with span("openai_request"):
+                        # Повторы временных ошибок без хеджа: здесь важна пропускная способность, а не хвост задержек
+                        response = await acomplete(client, "bulk_week", hedge=False, **job["body"])
+                except Exception as e:
+                    # Без контрольной точки: задание повторится при следующем запуске
+                    print(f"❌ {job['custom_id']}: ошибка запроса: {e}")
+                    self._report["failed"] += 1
+                    return
+            usage = response.usage.model_dump() if response.usage else None
+            await self._checkpoint_and_apply(job["custom_id"], response.choices[0].message.content, usage)
+
+        await asyncio.gather(*(run_job(job) for job in jobs))
+
+    async def _run_batch(self, jobs: List[Dict[str, Any]]):
+        """OpenAI Batch API: один файл заданий, ожидание пакета, разбор файла результатов."""
+        client = get_async_client()
+        if client is None:
+            raise RuntimeError("Клиент OpenAI не инициализирован.")
+
+        state = None
+        if os.path.exists(self.state_file):
+            with open(self.state_file, encoding="utf-8") as f:
+                state = json.load(f)
+        if state is None:
+            payload = "".join(json.dumps(job, ensure_ascii=False) + "\n" for job in jobs).encode("utf-8")
+            input_file = await client.files.create(file=("generation_jobs.jsonl", payload), purpose="batch")
+            batch = await client.batches.create(
+                input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h"
+            )
+            state = {"batch_id": batch.id, "input_file_id": input_file.id}
+            _write_atomic(self.state_file, json.dumps(state))
+            print(f"📦 Пакет {batch.id} отправлен: заданий {len(jobs)}.")
+        else:
+            print(f"📦 Продолжаем ожидание пакета {state['batch_id']}.")
+
+        while True:
+            batch = await client.batches.retrieve(state["batch_id"])
+            if batch.status in _BATCH_FINAL_STATUSES:
+                break
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            pending_ids = {job["custom_id"] for job in jobs}
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if item["custom_id"] not in pending_ids:
+                    continue
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    print(f"❌ {item['custom_id']}: ошибка в пакете: {item.get('error') or response.get('status_code')}")
+                    self._report["failed"] += 1
+                    continue
+                body = response["body"]
+                await self._checkpoint_and_apply(item["custom_id"], body["choices"][0]["message"]["content"], body.get("usage"))
+        else:
+            print(f"❌ Пакет {batch.id} завершился со статусом {batch.status} без файла результатов.")
+            self._report["failed"] += len(jobs)
+
+        # Пакет обработан: следующий запуск отправит новый пакет для оставшихся заданий
+        os.remove(self.state_file)
+
+    # --- ЗАПУСК ---
+
+    async def run(self) -> Dict[str, Any]:
+        """Выполняет (или продолжает) пакет на следующую неделю. Возвращает отчет с пропускной способностью."""
+        started = time.perf_counter()
+        week_start = get_plan_dates()[0]
+        self._report = {"runner": self.runner, "week_start": week_start.isoformat(), "completed": 0, "failed": 0}
+
+        jobs = await self._load_or_create_jobs(week_start)
+
+        # Ответы, полученные до сбоя, применяются без повторного запроса
+        checkpointed = {}
+        for record in read_jsonl(self.results_file):
+            checkpointed[record["custom_id"]] = record["content"]
+        for custom_id, content in checkpointed.items():
+            if await self._apply(custom_id, content):
+                self._report["completed"] += 1
+            else:
+                self._report["failed"] += 1
+        pending = [job for job in jobs if job["custom_id"] not in checkpointed]
+
+        self._report.update(jobs=len(jobs), resumed=len(checkpointed), submitted=len(pending))
+        if pending:
+            if self.runner == "batch":
+                await self._run_batch(pending)
+            else:
+                await self._run_concurrent(pending)
+
+        seconds = time.perf_counter() - started
+        self._report["seconds"] = round(seconds, 2)
+        self._report["plans_per_minute"] = round(self._report["completed"] / seconds * 60, 1) if seconds else 0.0
+        print(
+            f"📦 Пакет завершен: планов {self._report['completed']} из {len(jobs)}, ошибок {self._report['failed']}, "
+            f"{self._report['plans_per_minute']} планов/мин."
+        )
+        return self._report
+
+
+# --- ЗАПУСК ИЗ КОМАНДНОЙ СТРОКИ ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Пакетная генерация планов на следующую неделю для всех чатов.")
+    parser.add_argument("--runner", choices=("concurrent", "batch"), default=BULK_RUNNER)
+    parser.add_argument("--concurrency", type=int, default=BULK_CONCURRENCY)
+    parser.add_argument("--jobs-file", default=BULK_JOBS_FILE)
+    args = parser.parse_args()
+
+    async def _main():
+        await init_db()
+        try:
+            report = await BulkPipeline(args.jobs_file, args.runner, args.concurrency).run()
+        finally:
+            await dispose_db()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    asyncio.run(_main())
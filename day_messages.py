@@ -0,0 +1,137 @@
+import os
+import datetime
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from db_manager import get_recipes_for_date, save_rendered_days, get_rendered_day
+
+# --- НАСТРОЙКИ ---
+# Лимит Telegram - 4096 символов; берем с запасом на разметку
+TELEGRAM_MESSAGE_LIMIT = 4000
+# Сколько дней (чат, дата) держать в памяти процесса
+MESSAGE_CACHE_MAX_ENTRIES = int(os.getenv("MESSAGE_CACHE_MAX_ENTRIES", "1000"))
+
+# (chat_id, дата) -> готовые части сообщения; порядок - для LRU-вытеснения
+_message_cache: "OrderedDict[tuple, List[str]]" = OrderedDict()
+
+
+# --- 1. ФОРМАТИРОВАНИЕ ---
+
+def format_kzhbu(kcal, protein, fat, carbs) -> str:
+    """Строка КЖБУ из чисел; если калорийность неизвестна - пометка об отсутствии расчета."""
+    if kcal is None:
+        return "КЖБУ: Расчет отсутствует ❌"
+    def fmt(value):
+        return "?" if value is None else f"{value:g}"
+    return f"Ккал: {fmt(kcal)}, Б: {fmt(protein)}г, Ж: {fmt(fat)}г, У: {fmt(carbs)}г"
+
+
+def render_recipe_markdown(recipe) -> str:
+    """Полный рецепт в Markdown из структурированных полей записи Recipe."""
+    return (
+        f"**Суммарное КЖБУ (на двоих):** {format_kzhbu(recipe.kcal, recipe.protein, recipe.fat, recipe.carbs)}\n\n"
+        f"**--- РЕЦЕПТ ---**\n"
+        f"{recipe.recipe_full}"
+    )
+
+
+def split_message(blocks: List[str], limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """
+    Собирает блоки (заголовок, рецепты) в сообщения не длиннее limit.
+    Блоки не разрываются без необходимости; слишком длинный блок делится по строкам,
+    а совсем длинная строка - по limit символов.
+    """
+    pieces = []
+    for block in blocks:
+        if len(block) <= limit:
+            pieces.append(block)
+            continue
+        for line in block.split("\n"):
+            pieces.extend(line[i:i + limit] for i in range(0, max(len(line), 1), limit))
+
+    chunks, current = [], []
+    current_len = 0
+    for piece in pieces:
+        separator_len = 1 if current else 0
+        if current and current_len + separator_len + len(piece) > limit:
+            chunks.append("\n".join(current).strip())
+            current, current_len = [], 0
+            separator_len = 0
+        current.append(piece)
+        current_len += separator_len + len(piece)
+    if current:
+        chunks.append("\n".join(current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+def render_day_chunks(meal_date: datetime.date, recipes: Iterable) -> List[str]:
+    """Сообщение с меню на день (записи Recipe), разбитое на части под лимит Telegram."""
+    blocks = [f"🔔 **Ваше меню на сегодня, {meal_date.strftime('%d.%m.%Y')}!** 🔔\n"]
+    for recipe in recipes:
+        blocks.append(
+            f"🍽️ **{recipe.meal_type or 'Блюдо'}: {recipe.meal_name}**\n"
+            f"_Порции:_ (М: {recipe.weight_m or 'N/A'}г, Ж: {recipe.weight_w or 'N/A'}г)\n\n"
+            f"{render_recipe_markdown(recipe)}\n\n---\n"
+        )
+    return split_message(blocks)
+
+
+# --- 2. КЭШ ---
+
+def _cache_put(chat_id: int, meal_date: datetime.date, chunks: List[str]):
+    key = (chat_id, meal_date)
+    _message_cache[key] = chunks
+    _message_cache.move_to_end(key)
+    while len(_message_cache) > MESSAGE_CACHE_MAX_ENTRIES:
+        _message_cache.popitem(last=False)
+
+
+def invalidate_day_messages(chat_id: int, meal_dates: Iterable[datetime.date] | None = None):
+    """Сбрасывает кэш сообщений чата: для указанных дат или для всех дат чата."""
+    if meal_dates is None:
+        for key in [key for key in _message_cache if key[0] == chat_id]:
+            del _message_cache[key]
+    else:
+        for meal_date in meal_dates:
+            _message_cache.pop((chat_id, meal_date), None)
+
+
+async def refresh_day_messages(chat_id: int, meal_dates: Iterable[datetime.date]) -> Dict[datetime.date, List[str]]:
+    """
+    Перерисовывает сообщения для дат после сохранения рецептов: сбрасывает кэш,
+    рендерит день по всем его рецептам в БД, сохраняет результат в таблицу и кладет в кэш.
+    """
+    meal_dates = sorted(set(meal_dates))
+    invalidate_day_messages(chat_id, meal_dates)
+
+    rendered = {}
+    for meal_date in meal_dates:
+        recipes = await get_recipes_for_date(meal_date, chat_id)
+        if recipes:
+            rendered[meal_date] = render_day_chunks(meal_date, recipes)
+
+    if rendered and await save_rendered_days(chat_id, rendered):
+        for meal_date, chunks in rendered.items():
+            _cache_put(chat_id, meal_date, chunks)
+    return rendered
+
+
+async def get_day_messages(chat_id: int, meal_date: datetime.date) -> List[str] | None:
+    """
+    Готовые части сообщения на дату: из памяти, затем из таблицы rendered_days.
+    Дни, сгенерированные до появления таблицы, рендерятся один раз из истории.
+    None - меню на эту дату нет.
+    """
+    key = (chat_id, meal_date)
+    chunks = _message_cache.get(key)
+    if chunks is not None:
+        _message_cache.move_to_end(key)
+        return chunks
+
+    chunks = await get_rendered_day(chat_id, meal_date)
+    if chunks is not None:
+        _cache_put(chat_id, meal_date, chunks)
+        return chunks
+
+    rendered = await refresh_day_messages(chat_id, [meal_date])
+    return rendered.get(meal_date)
@@ -1,116 +1,1150 @@
+import os
+import re
+import json
+import zlib
+import asyncio
+import hashlib
 import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
+import itertools
+from sqlalchemy import (
+    Column, Integer, BigInteger, String, Date, DateTime, Text, Float, Index, LargeBinary,
+    event, inspect, text, select, delete, func, true
+)
+from sqlalchemy.orm import column_property, declarative_base
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from metrics import instrument_engine
 
 # --- 1. ОПРЕДЕЛЕНИЕ БАЗЫ ---
 # Базовый класс для объявления моделей
 Base = declarative_base()
 
 # Имя файла базы данных SQLite. Этот файл будет создан автоматически.
-DATABASE_FILE = "recipes.db"
-# Создаем движок SQLAlchemy для SQLite
-engine = create_engine(f"sqlite:///{DATABASE_FILE}")
-# Создаем класс сессий, через который мы будем общаться с БД
-Session = sessionmaker(bind=engine)
+DATABASE_FILE = os.getenv("DATABASE_FILE", "recipes.db")
+# Записи истории старше стольких дней переносятся в сжатый архив (recipes_archive) при уплотнении БД
+HISTORY_ARCHIVE_DAYS = int(os.getenv("HISTORY_ARCHIVE_DAYS", "180"))
+# Минимальный срок: архив не должен задевать историю, по которой строится список исключений (21 день)
+MIN_ARCHIVE_DAYS = 22
+# Сколько свободных страниц возвращает ОС один шаг incremental_vacuum (шаг - короткая отдельная запись)
+INCREMENTAL_VACUUM_PAGES = int(os.getenv("INCREMENTAL_VACUUM_PAGES", "2000"))
+# Размер общего пула соединений (каждое соединение aiosqlite - один поток, а не поток на запрос)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+
+# Асинхронный движок SQLAlchemy для SQLite (драйвер aiosqlite) и фабрика сессий.
+# Создаются при первом обращении (get_engine / Session), а не при импорте: модулю, которому нужны
+# только модели или parse_kzhbu, не приходится загружать драйвер и строить пул
+_engine = None
+_sessionmaker = None
+
+
+def get_engine():
+    """Асинхронный движок БД (создается при первом вызове)."""
+    global _engine, _sessionmaker
+    if _engine is None:
+        _engine = create_async_engine(
+            f"sqlite+aiosqlite:///{DATABASE_FILE}",
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_POOL_SIZE,
+        )
+        event.listen(_engine.sync_engine, "connect", _set_sqlite_pragmas)
+        # Длительность каждого SQL-запроса попадает в гистограмму db_query_duration_seconds
+        instrument_engine(_engine.sync_engine, "recipes")
+        _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+    return _engine
+
+
+def Session():
+    """Новая асинхронная сессия, через которую мы общаемся с БД: async with Session() as session."""
+    if _sessionmaker is None:
+        get_engine()
+    return _sessionmaker()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Настройки SQLite для каждого нового соединения пула:
+    WAL позволяет читать во время записи, busy_timeout - ждать блокировку вместо ошибки.
+    auto_vacuum=INCREMENTAL действует для нового файла БД (до создания таблиц); существующий файл
+    переводится в этот режим полным VACUUM из офлайн-команды (python db_manager.py --compact).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    # Журнал WAL после уплотнения урезается до 4 МБ (размер автоматического checkpoint), а не остается максимальным
+    cursor.execute("PRAGMA journal_size_limit=4194304")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-16000")
+    cursor.execute("PRAGMA mmap_size=134217728")
+    cursor.close()
+
+
+# --- 2. МОДЕЛИ ДАННЫХ ИСТОРИИ (ТАБЛИЦЫ 'recipe_bodies', 'recipes_history', 'recipe_ingredients', 'recipes_fts') ---
+class RecipeBody(Base):
+    """Текст рецепта, хранящийся один раз: повторно сгенерированное блюдо с тем же текстом ссылается на ту же запись."""
+    __tablename__ = 'recipe_bodies'
+
+    id = Column(Integer, primary_key=True)
+    # sha256 от названия и текста рецепта
+    content_hash = Column(String, nullable=False, unique=True)
+    meal_name = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return f"<RecipeBody(id={self.id}, meal_name='{self.meal_name}')>"
+
 
-# --- 2. МОДЕЛЬ ДАННЫХ (ТАБЛИЦА 'recipes_history') ---
 class Recipe(Base):
     """Модель для хранения истории сгенерированных блюд."""
     __tablename__ = 'recipes_history'
 
     id = Column(Integer, primary_key=True)
+    # Чат (домохозяйство), которому принадлежит блюдо
+    chat_id = Column(BigInteger)
     # Дата потребления блюда (обязательное поле)
     meal_date = Column(Date, nullable=False)
     # Название блюда (для проверки на повторы, обязательное поле)
     meal_name = Column(String, nullable=False)
-    # Полный текст рецепта (ингредиенты, шаги, КЖБУ)
-    recipe_full = Column(String)
+    # Тип приема пищи: Завтрак, Обед, Перекус, Ужин
+    meal_type = Column(String)
+    # Суммарное КЖБУ блюда на двоих (числа, чтобы по ним можно было считать и фильтровать)
+    kcal = Column(Float)
+    protein = Column(Float)
+    fat = Column(Float)
+    carbs = Column(Float)
+    # Вес порций в граммах
+    weight_m = Column(Integer)
+    weight_w = Column(Integer)
+    # Текст рецепта (ингредиенты и шаги) без служебного Markdown - в recipe_bodies.
+    # inline_recipe - текст прямо в строке истории (записи до схемы 4, переносятся при уплотнении)
+    body_id = Column(Integer)
+    inline_recipe = Column('recipe_full', String)
+    recipe_full = column_property(func.coalesce(
+        inline_recipe,
+        select(RecipeBody.body).where(RecipeBody.id == body_id).correlate_except(RecipeBody).scalar_subquery()
+    ))
     # Дата и время, когда запись была добавлена в базу
     generated_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        # Диапазон дат + DISTINCT по названию (список исключений) и точная дата (/today)
+        Index('ix_recipes_chat_date_name', 'chat_id', 'meal_date', 'meal_name'),
+        # Поиск по названию блюда
+        Index('ix_recipes_chat_name_date', 'chat_id', 'meal_name', 'meal_date'),
+        # Записи с данным текстом (поиск и удаление текстов, на которые больше никто не ссылается)
+        Index('ix_recipes_body', 'body_id'),
+    )
+
     def __repr__(self):
         return f"<Recipe(meal_name='{self.meal_name}', meal_date='{self.meal_date}')>"
 
-# --- 3. ФУНКЦИИ УПРАВЛЕНИЯ БД ---
 
-def init_db():
-    """Создает базу данных и таблицу, если они не существуют."""
+class RecipeIngredient(Base):
+    """Обратный индекс: распознанный ингредиент (ключ таблицы nutrition.py) -> рецепты истории."""
+    __tablename__ = 'recipe_ingredients'
+
+    recipe_id = Column(Integer, primary_key=True, autoincrement=False)
+    ingredient = Column(String, primary_key=True)
+    # Копии полей рецепта, чтобы частота ингредиентов за период считалась по одному индексу
+    chat_id = Column(BigInteger)
+    meal_date = Column(Date, nullable=False)
+
+    __table_args__ = (
+        # Ингредиенты чата за последние дни
+        Index('ix_recipe_ingredients_chat_date', 'chat_id', 'meal_date', 'ingredient'),
+        # Рецепты с данным ингредиентом
+        Index('ix_recipe_ingredients_ingredient', 'ingredient', 'recipe_id'),
+    )
+
+
+class ArchivedRecipes(Base):
+    """
+    Сжатый архив старой истории: часть записей одного чата за один месяц.
+    payload - zlib от JSON-списка записей (поля recipes_history и полный текст рецепта).
+    """
+    __tablename__ = 'recipes_archive'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger)
+    # Первое число месяца, к которому относятся записи
+    month = Column(Date, nullable=False)
+    rows_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_recipes_archive_chat_month', 'chat_id', 'month'),
+    )
+
+# Полнотекстовый индекс по текстам рецептов (FTS5 над recipe_bodies, rowid = recipe_bodies.id; создается миграцией).
+# Триггеры обновляют его при добавлении и удалении текстов. remove_diacritics 2 - поиск по "е" находит и "ё"
+FTS_SCHEMA_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipes_fts USING fts5(meal_name, body, content='recipe_bodies', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS recipe_bodies_fts_insert AFTER INSERT ON recipe_bodies BEGIN "
+    "INSERT INTO recipes_fts (rowid, meal_name, body) VALUES (new.id, new.meal_name, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_bodies_fts_delete AFTER DELETE ON recipe_bodies BEGIN "
+    "INSERT INTO recipes_fts (recipes_fts, rowid, meal_name, body) VALUES ('delete', old.id, old.meal_name, old.body); END",
+)
+
+# --- 3. МОДЕЛЬ ДАННЫХ (ТАБЛИЦА 'household_profiles') ---
+class HouseholdProfile(Base):
+    """Профиль домохозяйства (чата): цели КЖБУ двух человек и распределение по приемам пищи."""
+    __tablename__ = 'household_profiles'
+
+    chat_id = Column(BigInteger, primary_key=True)
+    # Цели КЖБУ в формате USER_KZHBU (me, wife, total_target_kzhbu, target_distribution_kzhbu)
+    kzhbu_json = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def to_dict(self) -> dict:
+        """Профиль в виде словаря, который понимают функции генерации промптов."""
+        return json.loads(self.kzhbu_json)
+
+    def __repr__(self):
+        return f"<HouseholdProfile(chat_id={self.chat_id})>"
+
+# --- 4. МОДЕЛЬ ДАННЫХ (ТАБЛИЦА 'rendered_days') ---
+class RenderedDay(Base):
+    """Готовые сообщения меню на день (уже разбитые на части под лимит Telegram)."""
+    __tablename__ = 'rendered_days'
+
+    chat_id = Column(BigInteger, primary_key=True)
+    meal_date = Column(Date, primary_key=True)
+    # JSON-список частей сообщения в Markdown
+    chunks_json = Column(Text, nullable=False)
+    rendered_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<RenderedDay(chat_id={self.chat_id}, meal_date='{self.meal_date}')>"
+
+# --- 5. МОДЕЛИ ДАННЫХ ПЛАНИРОВЩИКА (ТАБЛИЦЫ 'scheduled_runs', 'prepared_plans') ---
+class ScheduledRun(Base):
+    """Время последнего запуска задания планировщика (для догоняющего запуска после рестарта)."""
+    __tablename__ = 'scheduled_runs'
+
+    job_name = Column(String, primary_key=True)
+    # UTC
+    last_run_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ScheduledRun(job_name='{self.job_name}', last_run_at='{self.last_run_at}')>"
+
+
+class PreparedPlan(Base):
+    """Заранее сгенерированный план недели, ожидающий отправки в воскресенье."""
+    __tablename__ = 'prepared_plans'
+
+    chat_id = Column(BigInteger, primary_key=True)
+    # Понедельник недели, на которую составлен план
+    week_start = Column(Date, primary_key=True)
+    # JSON-список частей сообщения с планом недели
+    chunks_json = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    delivered_at = Column(DateTime)
+
+    def __repr__(self):
+        return f"<PreparedPlan(chat_id={self.chat_id}, week_start='{self.week_start}')>"
+
+# --- 6. МОДЕЛЬ ДАННЫХ (ТАБЛИЦА 'outbox') ---
+OUTBOX_PENDING = "pending"
+OUTBOX_SENT = "sent"
+OUTBOX_FAILED = "failed"
+
+class OutboxMessage(Base):
+    """Исходящее сообщение рассылки: пишется до отправки, чтобы пережить перезапуск бота."""
+    __tablename__ = 'outbox'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String)
+    # pending / sent / failed
+    status = Column(String, nullable=False, default=OUTBOX_PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        # Выборка неотправленных сообщений при старте, в порядке постановки
+        Index('ix_outbox_status_id', 'status', 'id'),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, chat_id={self.chat_id}, status='{self.status}')>"
+
+# --- 7. МОДЕЛЬ ДАННЫХ (ТАБЛИЦА 'processed_updates') ---
+class ProcessedUpdate(Base):
+    """update_id уже обработанных обновлений Telegram (защита от повторной доставки вебхука)."""
+    __tablename__ = 'processed_updates'
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+# --- 8. РАЗБОР КЖБУ ---
+
+_NUMBER = r'(\d+(?:[.,]\d+)?)'
+_KZHBU_PATTERNS = {
+    'kcal': [re.compile(r'(?i)(?:ккал|калори\w*)\s*[:=]\s*' + _NUMBER), re.compile(r'(?i)' + _NUMBER + r'\s*ккал')],
+    'protein': [re.compile(r'(?i)(?<![а-яё])(?:б|белк\w*)\s*[:=]\s*' + _NUMBER), re.compile(r'(?i)' + _NUMBER + r'\s*г\s*белк')],
+    'fat': [re.compile(r'(?i)(?<![а-яё])(?:ж|жир\w*)\s*[:=]\s*' + _NUMBER), re.compile(r'(?i)' + _NUMBER + r'\s*г\s*жир')],
+    'carbs': [re.compile(r'(?i)(?<![а-яё])(?:у|углевод\w*)\s*[:=]\s*' + _NUMBER), re.compile(r'(?i)' + _NUMBER + r'\s*г\s*углевод')],
+}
+
+def parse_kzhbu(kzhbu_text: str | None) -> dict:
+    """
+    Достает числа из строки вида 'Ккал: 1000, Б: 60г, Ж: 30г, У: 120г'.
+    Возвращает словарь kcal/protein/fat/carbs (None для того, что не найдено).
+    """
+    result = {key: None for key in _KZHBU_PATTERNS}
+    if not kzhbu_text:
+        return result
+    for key, patterns in _KZHBU_PATTERNS.items():
+        for pattern in patterns:
+            match = pattern.search(kzhbu_text)
+            if match:
+                result[key] = float(match.group(1).replace(',', '.'))
+                break
+    return result
+
+# Формат recipe_full, в котором старые версии бота сохраняли рецепт целиком в Markdown
+_LEGACY_RECIPE_RE = re.compile(
+    r'^\*\*Суммарное КЖБУ \(на двоих\):\*\*\s*(?P<kzhbu>.*?)\n\n\*\*--- РЕЦЕПТ ---\*\*\n(?P<body>.*)$',
+    re.DOTALL
+)
+
+# --- 9. ФУНКЦИИ УПРАВЛЕНИЯ БД (АСИНХРОННЫЕ) ---
+
+# Версия схемы хранится в PRAGMA user_version
+SCHEMA_VERSION = 5
+
+def _migrate_schema(connection):
+    """Приводит существующий файл БД к текущей схеме (выполняется через run_sync)."""
+    version = connection.execute(text("PRAGMA user_version")).scalar()
+    if version >= SCHEMA_VERSION:
+        return
+    if version < 2:
+        _migrate_to_v2(connection)
+    if version < 3:
+        _migrate_to_v3(connection)
+    if version < 4:
+        _migrate_to_v4(connection)
+    if version < 5:
+        _migrate_to_v5(connection)
+    connection.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+
+def _migrate_to_v2(connection):
+    """Версия 2: chat_id, структурированные колонки КЖБУ и составные индексы."""
+    columns = {column['name'] for column in inspect(connection).get_columns('recipes_history')}
+    if 'chat_id' not in columns:
+        connection.execute(text("ALTER TABLE recipes_history ADD COLUMN chat_id BIGINT"))
+        print("🛠️ Миграция: в 'recipes_history' добавлена колонка chat_id.")
+
+    # Версия 2: структурированные колонки вместо Markdown-блоба
+    new_columns = {
+        'meal_type': 'VARCHAR', 'kcal': 'FLOAT', 'protein': 'FLOAT', 'fat': 'FLOAT',
+        'carbs': 'FLOAT', 'weight_m': 'INTEGER', 'weight_w': 'INTEGER',
+    }
+    for name, column_type in new_columns.items():
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE recipes_history ADD COLUMN {name} {column_type}"))
+
+    # Старые записи: разбираем Markdown на КЖБУ и чистый текст рецепта
+    legacy_rows = connection.execute(text(
+        "SELECT id, recipe_full FROM recipes_history WHERE kcal IS NULL AND recipe_full LIKE '**Суммарное КЖБУ%'"
+    )).fetchall()
+    updates = []
+    for row_id, recipe_full in legacy_rows:
+        match = _LEGACY_RECIPE_RE.match(recipe_full)
+        if not match:
+            continue
+        updates.append({"id": row_id, "body": match.group('body'), **parse_kzhbu(match.group('kzhbu'))})
+    if updates:
+        connection.execute(text(
+            "UPDATE recipes_history SET recipe_full = :body, kcal = :kcal, protein = :protein, "
+            "fat = :fat, carbs = :carbs WHERE id = :id"
+        ), updates)
+
+    connection.execute(text("DROP INDEX IF EXISTS ix_recipes_history_chat_id"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_recipes_chat_date_name ON recipes_history (chat_id, meal_date, meal_name)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_recipes_chat_name_date ON recipes_history (chat_id, meal_name, meal_date)"
+    ))
+    print(f"🛠️ Миграция схемы до версии 2: разобрано старых записей - {len(updates)}.")
+
+def _migrate_to_v3(connection, batch_size: int = 5000):
+    """Версия 3: индекс ингредиентов по всей существующей истории."""
+    # nutrition импортирует db_manager, поэтому импорт здесь, а не в начале модуля
+    from nutrition import recipe_ingredient_keys
+
+    connection.execute(text("DELETE FROM recipe_ingredients"))
+    last_id, indexed = 0, 0
+    while True:
+        rows = connection.execute(text(
+            "SELECT id, chat_id, meal_date, recipe_full FROM recipes_history WHERE id > :last_id ORDER BY id LIMIT :limit"
+        ), {"last_id": last_id, "limit": batch_size}).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        index_rows = [
+            {"recipe_id": row_id, "ingredient": key, "chat_id": chat_id, "meal_date": meal_date}
+            for row_id, chat_id, meal_date, recipe_full in rows
+            for key in recipe_ingredient_keys(recipe_full)
+        ]
+        if index_rows:
+            connection.execute(text(
+                "INSERT OR IGNORE INTO recipe_ingredients (recipe_id, ingredient, chat_id, meal_date) "
+                "VALUES (:recipe_id, :ingredient, :chat_id, :meal_date)"
+            ), index_rows)
+        indexed += len(rows)
+    print(f"🛠️ Миграция схемы до версии 3: в индекс ингредиентов добавлено рецептов - {indexed}.")
+
+def _migrate_to_v4(connection):
+    """Версия 4: тексты рецептов без повторов в recipe_bodies и полнотекстовый индекс по ним."""
+    columns = {column['name'] for column in inspect(connection).get_columns('recipes_history')}
+    if 'body_id' not in columns:
+        connection.execute(text("ALTER TABLE recipes_history ADD COLUMN body_id INTEGER"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_recipes_body ON recipes_history (body_id)"))
+
+    # Индекс версии 3 строился по строкам истории - заменяется индексом по текстам
+    connection.execute(text("DROP TABLE IF EXISTS recipes_fts"))
+    for statement in FTS_SCHEMA_SQL:
+        connection.execute(text(statement))
+
+    last_id, moved = 0, 0
+    while last_id is not None:
+        last_id, batch_moved = _move_inline_bodies(connection, last_id)
+        moved += batch_moved
+    print(f"🛠️ Миграция схемы до версии 4: тексты {moved} записей перенесены в recipe_bodies.")
+
+def _migrate_to_v5(connection):
+    """Версия 5: колонка people профилей удалена - план всегда на двоих (me/wife, weight_m/weight_w)."""
+    columns = {column['name'] for column in inspect(connection).get_columns('household_profiles')}
+    if 'people' in columns:
+        connection.execute(text("ALTER TABLE household_profiles DROP COLUMN people"))
+        print("🛠️ Миграция схемы до версии 5: из 'household_profiles' удалена колонка people.")
+
+def _content_hash(meal_name: str, body: str) -> str:
+    return hashlib.sha256(f"{meal_name}\n{body}".encode("utf-8")).hexdigest()
+
+def _store_bodies(executor, items: list[tuple[str, str]]) -> list[int]:
+    """
+    Сохраняет тексты рецептов (название, текст) без повторов и возвращает их id в том же порядке.
+    executor - синхронные Connection или Session (вызывается из миграции и через run_sync).
+    """
+    hashes = [_content_hash(meal_name, body) for meal_name, body in items]
+    unique = {}
+    for content_hash, (meal_name, body) in zip(hashes, items):
+        unique.setdefault(content_hash, {"content_hash": content_hash, "meal_name": meal_name, "body": body})
+    if not unique:
+        return []
+    executor.execute(text(
+        "INSERT OR IGNORE INTO recipe_bodies (content_hash, meal_name, body) VALUES (:content_hash, :meal_name, :body)"
+    ), list(unique.values()))
+    ids = dict(executor.execute(
+        select(RecipeBody.content_hash, RecipeBody.id).where(RecipeBody.content_hash.in_(list(unique)))
+    ).all())
+    return [ids[content_hash] for content_hash in hashes]
+
+def _move_inline_bodies(connection, after_id: int, batch_size: int = 5000) -> tuple[int | None, int]:
+    """
+    Одна порция переноса текстов из строк истории в recipe_bodies.
+    Возвращает (id последней просмотренной записи или None, если записей больше нет; сколько перенесено).
+    """
+    rows = connection.execute(text(
+        "SELECT id, meal_name, recipe_full, body_id FROM recipes_history WHERE id > :after_id ORDER BY id LIMIT :limit"
+    ), {"after_id": after_id, "limit": batch_size}).fetchall()
+    if not rows:
+        return None, 0
+    inline = [(row_id, meal_name, recipe_full) for row_id, meal_name, recipe_full, body_id in rows
+              if recipe_full is not None and body_id is None]
+    if inline:
+        body_ids = _store_bodies(connection, [(meal_name, recipe_full) for _, meal_name, recipe_full in inline])
+        connection.execute(
+            text("UPDATE recipes_history SET body_id = :body_id, recipe_full = NULL WHERE id = :id"),
+            [{"id": row_id, "body_id": body_id} for (row_id, _, _), body_id in zip(inline, body_ids)]
+        )
+    return rows[-1][0], len(inline)
+
+def _delete_orphan_bodies(executor, body_ids) -> int:
+    """Удаляет тексты из body_ids, на которые больше не ссылается ни одна запись истории (и их строки FTS - триггером)."""
+    deleted = 0
+    body_ids = [body_id for body_id in set(body_ids) if body_id is not None]
+    for start in range(0, len(body_ids), 500):
+        chunk = body_ids[start:start + 500]
+        result = executor.execute(
+            delete(RecipeBody)
+            .where(RecipeBody.id.in_(chunk))
+            .where(~select(Recipe.id).where(Recipe.body_id == RecipeBody.id).exists())
+        )
+        deleted += result.rowcount
+    return deleted
+
+def _ingredient_index_rows(recipes: list, texts: list[str]) -> list[dict]:
+    """Строки индекса ингредиентов для только что сохраненных рецептов (id уже есть)."""
+    from nutrition import recipe_ingredient_keys
+
+    return [
+        {"recipe_id": r.id, "ingredient": key, "chat_id": r.chat_id, "meal_date": r.meal_date}
+        for r, recipe_text in zip(recipes, texts)
+        for key in recipe_ingredient_keys(recipe_text)
+    ]
+
+async def init_db(default_chat_id: int | None = None):
+    """
+    Создает базу данных и таблицы, если они не существуют.
+    Записи истории без чата (из однопользовательской версии) привязываются к default_chat_id.
+    """
     try:
-        # Создает все таблицы, определенные через Base (в нашем случае - Recipe)
-        Base.metadata.create_all(engine)
-        print(f"База данных {DATABASE_FILE} и таблица 'recipes_history' инициализированы.")
+        async with get_engine().begin() as connection:
+            # Создает все таблицы, определенные через Base (история, профили, готовые сообщения, планировщик)
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.run_sync(_migrate_schema)
+
+            if default_chat_id is not None:
+                result = await connection.execute(
+                    text("UPDATE recipes_history SET chat_id = :chat_id WHERE chat_id IS NULL"),
+                    {"chat_id": default_chat_id}
+                )
+                if result.rowcount:
+                    await connection.execute(
+                        text("UPDATE recipe_ingredients SET chat_id = :chat_id WHERE chat_id IS NULL"),
+                        {"chat_id": default_chat_id}
+                    )
+                    print(f"🛠️ {result.rowcount} записей истории без чата привязаны к чату {default_chat_id}.")
+
+        print(f"База данных {DATABASE_FILE} и таблицы инициализированы (WAL).")
     except Exception as e:
         print(f"Критическая ошибка при инициализации БД: {e}")
 
-def save_recipes(recipes_data: list):
+async def dispose_db():
+    """Закрывает все соединения пула (при остановке бота)."""
+    if _engine is not None:
+        await _engine.dispose()
+
+async def get_profile(chat_id: int) -> dict | None:
+    """Возвращает профиль чата в виде словаря или None, если чат не зарегистрирован."""
+    try:
+        async with Session() as session:
+            profile = await session.get(HouseholdProfile, chat_id)
+            return profile.to_dict() if profile else None
+    except Exception as e:
+        print(f"❌ Ошибка при чтении профиля чата {chat_id}: {e}")
+        return None
+
+async def save_profile(chat_id: int, kzhbu: dict) -> bool:
+    """Создает или обновляет профиль чата."""
+    async with Session() as session:
+        try:
+            profile = await session.get(HouseholdProfile, chat_id)
+            if profile is None:
+                profile = HouseholdProfile(chat_id=chat_id)
+                session.add(profile)
+            profile.kzhbu_json = json.dumps(kzhbu, ensure_ascii=False)
+            await session.commit()
+            return True
+        except Exception as e:
+            await session.rollback()
+            print(f"❌ Ошибка при сохранении профиля чата {chat_id}: {e}")
+            return False
+
+async def list_profile_chat_ids() -> list[int]:
+    """Возвращает ID всех зарегистрированных чатов."""
+    try:
+        async with Session() as session:
+            result = await session.execute(select(HouseholdProfile.chat_id))
+            return list(result.scalars().all())
+    except Exception as e:
+        print(f"❌ Ошибка при получении списка профилей: {e}")
+        return []
+
+async def _replaced_recipes(session, recipes_data: list, chat_id: int | None) -> list:
+    """Уже сохраненные записи чата с теми же (дата, прием пищи), что и в recipes_data (без типа приема - не заменяются)."""
+    slots = {(data['meal_date'], data.get('meal_type')) for data in recipes_data if data.get('meal_type')}
+    if not slots:
+        return []
+    query = select(Recipe.id, Recipe.meal_date, Recipe.meal_type, Recipe.body_id).where(
+        Recipe.meal_date.in_({meal_date for meal_date, _ in slots})
+    )
+    query = query.where(Recipe.chat_id == chat_id) if chat_id is not None else query.where(Recipe.chat_id.is_(None))
+    rows = (await session.execute(query)).all()
+    return [row for row in rows if (row.meal_date, row.meal_type) in slots]
+
+async def save_recipes(recipes_data: list, chat_id: int | None = None):
     """
     Сохраняет список рецептов в базу данных.
-    Ожидает список словарей, где каждый словарь содержит: 
-    'meal_date' (объект datetime.date), 'meal_name' (str), 'recipe_full' (str).
+    Записи чата с теми же датой и приемом пищи заменяются (повторная генерация недели не дублирует историю).
+    Ожидает список словарей, где каждый словарь содержит:
+    'meal_date' (объект datetime.date), 'meal_name' (str), 'recipe_full' (str)
+    и, по возможности, 'meal_type', 'kcal', 'protein', 'fat', 'carbs', 'weight_m', 'weight_w'.
     """
-    session = Session()
-    try:
-        new_recipes = []
-        for data in recipes_data:
-            recipe = Recipe(
-                meal_date=data['meal_date'],
-                meal_name=data['meal_name'],
-                recipe_full=data['recipe_full']
+    async with Session() as session:
+        try:
+            # Повторное сохранение того же дня (повторный запуск генерации) заменяет блюда, а не дублирует их
+            replaced = await _replaced_recipes(session, recipes_data, chat_id)
+            if replaced:
+                replaced_ids = [row.id for row in replaced]
+                await session.execute(delete(RecipeIngredient).where(RecipeIngredient.recipe_id.in_(replaced_ids)))
+                await session.execute(delete(Recipe).where(Recipe.id.in_(replaced_ids)))
+
+            # Одинаковые тексты (то же блюдо, сгенерированное заново) хранятся один раз
+            texts = [data['recipe_full'] for data in recipes_data]
+            body_ids = await session.run_sync(
+                _store_bodies, [(data['meal_name'], recipe_text) for data, recipe_text in zip(recipes_data, texts)]
             )
-            new_recipes.append(recipe)
-        
-        session.add_all(new_recipes)
-        session.commit()
-        print(f"✅ Успешно сохранено {len(new_recipes)} новых рецептов.")
-        return True
-    except Exception as e:
-        session.rollback()
-        print(f"❌ Ошибка при сохранении рецептов: {e}")
-        return False
-    finally:
-        session.close()
+            new_recipes = []
+            for data, body_id in zip(recipes_data, body_ids):
+                recipe = Recipe(
+                    chat_id=chat_id,
+                    meal_date=data['meal_date'],
+                    meal_name=data['meal_name'],
+                    meal_type=data.get('meal_type'),
+                    kcal=data.get('kcal'),
+                    protein=data.get('protein'),
+                    fat=data.get('fat'),
+                    carbs=data.get('carbs'),
+                    weight_m=data.get('weight_m'),
+                    weight_w=data.get('weight_w'),
+                    body_id=body_id
+                )
+                new_recipes.append(recipe)
 
-def get_exclusion_list(days: int = 21) -> list[str]:
+            session.add_all(new_recipes)
+            # id записей нужны индексу ингредиентов: он обновляется в той же транзакции
+            await session.flush()
+            ingredient_rows = _ingredient_index_rows(new_recipes, texts)
+            if ingredient_rows:
+                await session.execute(sqlite_insert(RecipeIngredient).on_conflict_do_nothing(), ingredient_rows)
+            if replaced:
+                # Тексты замененных блюд, которые больше никому не нужны
+                await session.run_sync(_delete_orphan_bodies, [row.body_id for row in replaced])
+                print(f"♻️ Заменено {len(replaced)} ранее сохраненных рецептов тех же дней.")
+            await session.commit()
+            print(f"✅ Успешно сохранено {len(new_recipes)} новых рецептов.")
+            return True
+        except Exception as e:
+            await session.rollback()
+            print(f"❌ Ошибка при сохранении рецептов: {e}")
+            return False
+
+async def get_exclusion_list(days: int = 21, chat_id: int | None = None, before: datetime.date | None = None) -> list[str]:
     """
     Возвращает список уникальных названий блюд, запланированных
     за последние 'days' дней, для использования в качестве исключений для ИИ.
+    Список отсортирован по свежести: сначала блюда с самой поздней датой.
+    Если указан chat_id, учитывается только история этого чата.
+    Если указан before (первый день плана), окно - 'days' дней до этой даты: блюда самой
+    планируемой недели не попадают в исключения, и промпт повторной генерации не меняется.
     """
-    session = Session()
     try:
         # Вычисляем дату, которая была 21 день назад (или days дней назад)
-        start_date = datetime.date.today() - datetime.timedelta(days=days)
-        
-        # Выбираем уникальные названия блюд, запланированных с этой даты
-        exclusion_list = session.query(Recipe.meal_name).filter(
-            Recipe.meal_date >= start_date
-        ).distinct().all()
-        
-        # Преобразуем результат из списка кортежей в простой список строк
-        result = [item[0] for item in exclusion_list]
-        
-        print(f"🔎 Найдено {len(result)} уникальных блюд для исключения за последние {days} дней.")
-        return result
+        start_date = (before or datetime.date.today()) - datetime.timedelta(days=days)
+
+        # Выбираем уникальные названия блюд, запланированных с этой даты, от самых недавних
+        last_date = func.max(Recipe.meal_date)
+        query = select(Recipe.meal_name).where(Recipe.meal_date >= start_date)
+        if before is not None:
+            query = query.where(Recipe.meal_date < before)
+        if chat_id is not None:
+            query = query.where(Recipe.chat_id == chat_id)
+        query = query.group_by(Recipe.meal_name).order_by(last_date.desc(), Recipe.meal_name)
+
+        async with Session() as session:
+            result = await session.execute(query)
+            exclusion_list = list(result.scalars().all())
+
+        print(f"🔎 Найдено {len(exclusion_list)} уникальных блюд для исключения за последние {days} дней.")
+        return exclusion_list
     except Exception as e:
         print(f"❌ Ошибка при получении списка исключений: {e}")
         return []
-    finally:
-        session.close()
 
-# Тестовый запуск: если вы запустите этот файл напрямую, он создаст базу и проверит функции.
+async def get_recipes_for_date(meal_date: datetime.date, chat_id: int | None = None) -> list:
+    """Возвращает рецепты на указанную дату (для /today и ежедневного напоминания)."""
+    query = select(Recipe).where(Recipe.meal_date == meal_date)
+    if chat_id is not None:
+        query = query.where(Recipe.chat_id == chat_id)
+    query = query.order_by(Recipe.id)
+
+    async with Session() as session:
+        result = await session.execute(query)
+        return list(result.scalars().all())
+
+async def get_recipe_library(chat_id: int, after_id: int = 0) -> list[dict]:
+    """
+    Сводка истории чата для режима библиотеки: последняя версия каждого блюда (тип + название)
+    с КЖБУ и весами порций, без текста рецепта. after_id - только записи новее этого id
+    (для дозагрузки библиотеки). uses - сколько раз блюдо встречается в этих записях.
+    """
+    # В SQLite голые колонки рядом с max() берутся из той же строки, что и максимум
+    query = (
+        select(
+            func.max(Recipe.id), Recipe.meal_type, Recipe.meal_name, Recipe.kcal, Recipe.protein,
+            Recipe.fat, Recipe.carbs, Recipe.weight_m, Recipe.weight_w, func.count()
+        )
+        .where(
+            Recipe.chat_id == chat_id,
+            Recipe.id > after_id,
+            Recipe.kcal.is_not(None),
+            Recipe.meal_type.is_not(None),
+            Recipe.weight_m.is_not(None),
+            Recipe.weight_w.is_not(None),
+        )
+        .group_by(Recipe.meal_type, Recipe.meal_name)
+    )
+    try:
+        async with Session() as session:
+            result = await session.execute(query)
+            return [
+                {
+                    'id': row[0], 'meal_type': row[1], 'meal_name': row[2], 'kcal': row[3], 'protein': row[4],
+                    'fat': row[5], 'carbs': row[6], 'weight_m': row[7], 'weight_w': row[8], 'uses': row[9],
+                }
+                for row in result.all()
+            ]
+    except Exception as e:
+        print(f"❌ Ошибка при загрузке библиотеки рецептов: {e}")
+        return []
+
+async def get_recipe_texts(recipe_ids: list[int]) -> dict[int, str]:
+    """Тексты рецептов по id записей истории: {id: recipe_full}."""
+    if not recipe_ids:
+        return {}
+    async with Session() as session:
+        result = await session.execute(select(Recipe.id, Recipe.recipe_full).where(Recipe.id.in_(recipe_ids)))
+        return {row_id: recipe_full for row_id, recipe_full in result.all() if recipe_full}
+
+# Слово запроса -> префикс основы: "курицей" -> "куриц*" (находит "курица", "куриный" не находит)
+_SEARCH_WORD_RE = re.compile(r"[a-zа-яё0-9]+", re.IGNORECASE)
+SEARCH_STEM_LENGTH = 5
+
+def _fts_match_query(query: str) -> str | None:
+    """Запрос пользователя в выражение FTS5 MATCH: все слова (по основе) должны встретиться."""
+    terms = []
+    for word in _SEARCH_WORD_RE.findall(query.lower()):
+        if len(word) < 2:
+            continue
+        stem = word[:SEARCH_STEM_LENGTH] if len(word) > SEARCH_STEM_LENGTH else word
+        terms.append(f'"{stem}"*')
+    return " ".join(terms) or None
+
+async def search_recipes(chat_id: int, query: str, limit: int = 10, ingredient: str | None = None) -> list:
+    """
+    Полнотекстовый поиск по истории чата (название и текст рецепта), лучшие совпадения первыми.
+    Название весит больше текста. Повторы одного блюда схлопываются до самой свежей записи.
+    ingredient - ключ индекса ингредиентов (nutrition.normalize_ingredient): рецепты с ним, которые
+    не нашлись по тексту ('семга' в запросе, 'лосось' в рецепте), идут после текстовых совпадений, свежие первыми.
+    """
+    match_query = _fts_match_query(query)
+    if match_query is None and ingredient is None:
+        return []
+    # Индекс строится по текстам рецептов; записи чата находятся по body_id (архивные записи в поиск не попадают)
+    statement = text(
+        "SELECT r.id FROM recipes_fts JOIN recipes_history r ON r.body_id = recipes_fts.rowid "
+        "WHERE recipes_fts MATCH :match AND r.chat_id = :chat_id "
+        "ORDER BY bm25(recipes_fts, 5.0, 1.0), r.meal_date DESC LIMIT :limit"
+    )
+    try:
+        async with Session() as session:
+            # Берем с запасом: одно и то же блюдо могло готовиться много раз
+            ids = []
+            if match_query is not None:
+                ids = list((await session.execute(
+                    statement, {"match": match_query, "chat_id": chat_id, "limit": limit * 5}
+                )).scalars().all())
+            if ingredient is not None:
+                ingredient_query = (
+                    select(RecipeIngredient.recipe_id)
+                    .where(RecipeIngredient.chat_id == chat_id, RecipeIngredient.ingredient == ingredient)
+                    .order_by(RecipeIngredient.meal_date.desc())
+                    .limit(limit * 5)
+                )
+                text_ids = set(ids)
+                ids += [rid for rid in (await session.execute(ingredient_query)).scalars() if rid not in text_ids]
+            if not ids:
+                return []
+            recipes = {r.id: r for r in (await session.execute(select(Recipe).where(Recipe.id.in_(ids)))).scalars()}
+    except Exception as e:
+        print(f"❌ Ошибка полнотекстового поиска '{query}': {e}")
+        return []
+
+    found, seen_names = [], set()
+    for recipe_id in ids:
+        recipe = recipes.get(recipe_id)
+        if recipe is None or recipe.meal_name.lower() in seen_names:
+            continue
+        seen_names.add(recipe.meal_name.lower())
+        found.append(recipe)
+        if len(found) >= limit:
+            break
+    return found
+
+async def get_frequent_ingredients(chat_id: int, days: int = 7, min_days: int = 3,
+                                   before: datetime.date | None = None) -> list[str]:
+    """
+    Ингредиенты, которые за последние days дней попадали в меню чата не меньше чем в min_days разных днях.
+    before - как в get_exclusion_list: окно заканчивается перед первым днем плана.
+    """
+    start_date = (before or datetime.date.today()) - datetime.timedelta(days=days)
+    query = (
+        select(RecipeIngredient.ingredient)
+        .where(RecipeIngredient.chat_id == chat_id, RecipeIngredient.meal_date >= start_date)
+        .where(RecipeIngredient.meal_date < before if before is not None else true())
+        .group_by(RecipeIngredient.ingredient)
+        .having(func.count(RecipeIngredient.meal_date.distinct()) >= min_days)
+        .order_by(func.count(RecipeIngredient.meal_date.distinct()).desc(), RecipeIngredient.ingredient)
+    )
+    try:
+        async with Session() as session:
+            return list((await session.execute(query)).scalars().all())
+    except Exception as e:
+        print(f"❌ Ошибка при подсчете частых ингредиентов чата {chat_id}: {e}")
+        return []
+
+async def get_recipe_ids_with_ingredients(chat_id: int, ingredients: list[str]) -> set[int]:
+    """id рецептов истории чата, в которых есть хотя бы один из ингредиентов (ключи nutrition.py)."""
+    if not ingredients:
+        return set()
+    query = (
+        select(RecipeIngredient.recipe_id).distinct()
+        .where(RecipeIngredient.chat_id == chat_id, RecipeIngredient.ingredient.in_(ingredients))
+    )
+    try:
+        async with Session() as session:
+            return set((await session.execute(query)).scalars().all())
+    except Exception as e:
+        print(f"❌ Ошибка поиска рецептов чата {chat_id} по ингредиентам: {e}")
+        return set()
+
+async def save_rendered_days(chat_id: int, rendered: dict) -> bool:
+    """Сохраняет готовые сообщения по дням: {дата: [части сообщения]}."""
+    async with Session() as session:
+        try:
+            for meal_date, chunks in rendered.items():
+                await session.merge(RenderedDay(
+                    chat_id=chat_id,
+                    meal_date=meal_date,
+                    chunks_json=json.dumps(chunks, ensure_ascii=False),
+                    rendered_at=datetime.datetime.utcnow()
+                ))
+            await session.commit()
+            return True
+        except Exception as e:
+            await session.rollback()
+            print(f"❌ Ошибка при сохранении готовых сообщений: {e}")
+            return False
+
+async def get_rendered_day(chat_id: int, meal_date: datetime.date) -> list[str] | None:
+    """Возвращает готовые части сообщения на дату или None, если день еще не подготовлен."""
+    async with Session() as session:
+        rendered = await session.get(RenderedDay, (chat_id, meal_date))
+        return json.loads(rendered.chunks_json) if rendered else None
+
+async def get_job_last_run(job_name: str) -> datetime.datetime | None:
+    """Время (UTC) последнего запуска задания или None, если задание еще не запускалось."""
+    async with Session() as session:
+        run = await session.get(ScheduledRun, job_name)
+        return run.last_run_at if run else None
+
+async def mark_job_run(job_name: str, run_at: datetime.datetime | None = None):
+    """Запоминает время (UTC) запуска задания."""
+    async with Session() as session:
+        try:
+            await session.merge(ScheduledRun(job_name=job_name, last_run_at=run_at or datetime.datetime.utcnow()))
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            print(f"❌ Ошибка при сохранении запуска задания {job_name}: {e}")
+
+async def save_prepared_plan(chat_id: int, week_start: datetime.date, chunks: list[str]) -> bool:
+    """
+    Сохраняет план недели (части сообщения), который отправит воскресная рассылка.
+    Новый план той же недели заменяет прежний; отметка об отправке сохраняется - уже отправленная
+    неделя не уходит повторно (новый план чат и так получил от генерации).
+    """
+    async with Session() as session:
+        try:
+            plan = await session.get(PreparedPlan, (chat_id, week_start))
+            if plan is None:
+                plan = PreparedPlan(chat_id=chat_id, week_start=week_start)
+                session.add(plan)
+            plan.chunks_json = json.dumps(chunks, ensure_ascii=False)
+            plan.created_at = datetime.datetime.utcnow()
+            await session.commit()
+            return True
+        except Exception as e:
+            await session.rollback()
+            print(f"❌ Ошибка при сохранении подготовленного плана чата {chat_id}: {e}")
+            return False
+
+async def delete_prepared_plan(chat_id: int, week_start: datetime.date):
+    """Удаляет план недели (например, история недели изменилась частично и он ей больше не соответствует)."""
+    async with Session() as session:
+        try:
+            await session.execute(
+                delete(PreparedPlan).where(PreparedPlan.chat_id == chat_id, PreparedPlan.week_start == week_start)
+            )
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            print(f"❌ Ошибка при удалении подготовленного плана чата {chat_id}: {e}")
+
+async def get_prepared_plan(chat_id: int, week_start: datetime.date, include_delivered: bool = False) -> list[str] | None:
+    """Части сообщения подготовленного плана недели или None (плана нет или он уже отправлен)."""
+    async with Session() as session:
+        plan = await session.get(PreparedPlan, (chat_id, week_start))
+        if plan is None or (plan.delivered_at is not None and not include_delivered):
+            return None
+        return json.loads(plan.chunks_json)
+
+async def mark_prepared_plan_delivered(chat_id: int, week_start: datetime.date):
+    """Отмечает подготовленный план как отправленный, чтобы догоняющий запуск не прислал его повторно."""
+    async with Session() as session:
+        plan = await session.get(PreparedPlan, (chat_id, week_start))
+        if plan is not None:
+            plan.delivered_at = datetime.datetime.utcnow()
+            await session.commit()
+
+async def add_outbox_messages(chat_id: int, texts: list[str], parse_mode: str | None = None) -> list[dict]:
+    """Записывает сообщения в outbox (статус pending). Возвращает их в виде словарей с id."""
+    async with Session() as session:
+        messages = [OutboxMessage(chat_id=chat_id, text=text_, parse_mode=parse_mode) for text_ in texts]
+        session.add_all(messages)
+        await session.commit()
+        return [
+            {'id': m.id, 'chat_id': m.chat_id, 'text': m.text, 'parse_mode': m.parse_mode, 'attempts': 0}
+            for m in messages
+        ]
+
+async def get_pending_outbox() -> list[dict]:
+    """Все неотправленные сообщения outbox в порядке постановки (для восстановления после рестарта)."""
+    async with Session() as session:
+        result = await session.execute(
+            select(OutboxMessage).where(OutboxMessage.status == OUTBOX_PENDING).order_by(OutboxMessage.id)
+        )
+        return [
+            {'id': m.id, 'chat_id': m.chat_id, 'text': m.text, 'parse_mode': m.parse_mode, 'attempts': m.attempts}
+            for m in result.scalars().all()
+        ]
+
+async def update_outbox_message(message_id: int, status: str, attempts: int, last_error: str | None = None):
+    """Обновляет статус сообщения outbox после попытки отправки."""
+    values = {'status': status, 'attempts': attempts, 'last_error': last_error}
+    if status == OUTBOX_SENT:
+        values['sent_at'] = datetime.datetime.utcnow()
+    async with Session() as session:
+        await session.execute(
+            OutboxMessage.__table__.update().where(OutboxMessage.id == message_id).values(**values)
+        )
+        await session.commit()
+
+async def purge_outbox(days: int = 7) -> int:
+    """Удаляет отправленные и окончательно неотправленные сообщения старше 'days' дней."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    async with Session() as session:
+        result = await session.execute(
+            delete(OutboxMessage)
+            .where(OutboxMessage.status != OUTBOX_PENDING)
+            .where(OutboxMessage.created_at < cutoff)
+        )
+        await session.commit()
+        return result.rowcount
+
+async def register_update(update_id: int) -> bool:
+    """
+    Атомарно отмечает обновление как полученное. Возвращает False, если его уже обработал
+    этот или другой процесс-воркер (общая БД), и True для нового обновления.
+    """
+    async with Session() as session:
+        result = await session.execute(
+            sqlite_insert(ProcessedUpdate).values(update_id=update_id).on_conflict_do_nothing()
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+async def purge_processed_updates(hours: int = 24) -> int:
+    """Удаляет отметки обработанных обновлений старше 'hours' часов (Telegram не повторяет их так долго)."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    async with Session() as session:
+        result = await session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.received_at < cutoff))
+        await session.commit()
+        return result.rowcount
+
+async def clear_history(chat_id: int | None = None) -> int:
+    """Удаляет историю рецептов чата (или всю историю, если chat_id не указан). Возвращает число удаленных записей."""
+    query = delete(Recipe)
+    rendered_query = delete(RenderedDay)
+    prepared_query = delete(PreparedPlan)
+    ingredients_query = delete(RecipeIngredient)
+    archive_query = delete(ArchivedRecipes)
+    body_ids_query = select(Recipe.body_id).distinct()
+    if chat_id is not None:
+        query = query.where(Recipe.chat_id == chat_id)
+        rendered_query = rendered_query.where(RenderedDay.chat_id == chat_id)
+        prepared_query = prepared_query.where(PreparedPlan.chat_id == chat_id)
+        ingredients_query = ingredients_query.where(RecipeIngredient.chat_id == chat_id)
+        archive_query = archive_query.where(ArchivedRecipes.chat_id == chat_id)
+        body_ids_query = body_ids_query.where(Recipe.chat_id == chat_id)
+
+    async with Session() as session:
+        try:
+            body_ids = (await session.execute(body_ids_query)).scalars().all()
+            await session.execute(ingredients_query)
+            result = await session.execute(query)
+            await session.execute(rendered_query)
+            await session.execute(prepared_query)
+            await session.execute(archive_query)
+            # Тексты, общие с историей других чатов, остаются
+            await session.run_sync(_delete_orphan_bodies, body_ids)
+            await session.commit()
+            return result.rowcount
+        except Exception:
+            await session.rollback()
+            raise
+
+def _archive_old_rows(connection, cutoff: datetime.date, after_id: int, batch_size: int = 5000) -> tuple[int | None, int, int]:
+    """
+    Одна порция архивации: записи истории до cutoff сжимаются в recipes_archive (по чату и месяцу)
+    и удаляются из горячей таблицы вместе со строками индекса ингредиентов и ненужными больше текстами.
+    Возвращает (id последней просмотренной записи или None; записей в архиве; удалено текстов).
+    """
+    rows = connection.execute(text(
+        "SELECT h.id, h.chat_id, h.meal_date, h.meal_name, h.meal_type, h.kcal, h.protein, h.fat, h.carbs, "
+        "h.weight_m, h.weight_w, coalesce(h.recipe_full, b.body) AS recipe_full, h.generated_at, h.body_id "
+        "FROM recipes_history h LEFT JOIN recipe_bodies b ON b.id = h.body_id "
+        "WHERE h.id > :after_id ORDER BY h.id LIMIT :limit"
+    ), {"after_id": after_id, "limit": batch_size}).mappings().all()
+    if not rows:
+        return None, 0, 0
+    old_rows = [row for row in rows if datetime.date.fromisoformat(str(row['meal_date'])) < cutoff]
+    if not old_rows:
+        return rows[-1]['id'], 0, 0
+
+    def group_key(row):
+        return row['chat_id'] or 0, str(row['meal_date'])[:7]
+
+    archive_rows = []
+    for (chat_id, month), group in itertools.groupby(sorted(old_rows, key=group_key), key=group_key):
+        records = [
+            {key: (str(value) if isinstance(value, (datetime.date, datetime.datetime)) else value)
+             for key, value in row.items() if key not in ('id', 'body_id')}
+            for row in group
+        ]
+        payload = zlib.compress(json.dumps(records, ensure_ascii=False).encode("utf-8"), 9)
+        archive_rows.append({
+            "chat_id": chat_id or None, "month": datetime.date.fromisoformat(f"{month}-01"),
+            "rows_count": len(records), "payload": payload, "created_at": datetime.datetime.utcnow(),
+        })
+    connection.execute(ArchivedRecipes.__table__.insert(), archive_rows)
+
+    old_ids = [row['id'] for row in old_rows]
+    connection.execute(delete(RecipeIngredient).where(RecipeIngredient.recipe_id.in_(old_ids)))
+    connection.execute(delete(Recipe).where(Recipe.id.in_(old_ids)))
+    bodies_deleted = _delete_orphan_bodies(connection, [row['body_id'] for row in old_rows])
+    return rows[-1]['id'], len(old_ids), bodies_deleted
+
+async def _database_size() -> int:
+    """
+    Размер БД в байтах (page_count * page_size, вместе со свободными страницами). Не зависит от того,
+    какая часть изменений еще в журнале WAL, поэтому размеры до и после уплотнения сравнимы.
+    """
+    async with get_engine().connect() as connection:
+        page_count = (await connection.exec_driver_sql("PRAGMA page_count")).scalar()
+        page_size = (await connection.exec_driver_sql("PRAGMA page_size")).scalar()
+    return page_count * page_size
+
+async def compact_history(archive_days: int = HISTORY_ARCHIVE_DAYS, full_vacuum: bool = False) -> dict:
+    """
+    Уплотнение БД: тексты старых записей переносятся в recipe_bodies (без повторов), записи старше
+    archive_days дней - в сжатый архив. Каждая порция - отдельная транзакция, чтобы не держать блокировку записи.
+    Освободившиеся страницы возвращаются ОС шагами incremental_vacuum (работающий бот пишет между шагами).
+    full_vacuum=True - полный VACUUM, только для офлайн-запуска (python db_manager.py --compact):
+    он держит блокировку записи всё время перестройки файла. Возвращает отчет с освобожденным местом.
+    """
+    archive_days = max(archive_days, MIN_ARCHIVE_DAYS)
+    size_before = await _database_size()
+    report = {'archive_days': archive_days, 'moved_bodies': 0, 'archived_rows': 0, 'deleted_bodies': 0}
+
+    last_id = 0
+    while last_id is not None:
+        async with get_engine().begin() as connection:
+            last_id, moved = await connection.run_sync(_move_inline_bodies, last_id)
+        report['moved_bodies'] += moved
+
+    cutoff = datetime.date.today() - datetime.timedelta(days=archive_days)
+    last_id = 0
+    while last_id is not None:
+        async with get_engine().begin() as connection:
+            last_id, archived, bodies_deleted = await connection.run_sync(_archive_old_rows, cutoff, last_id)
+        report['archived_rows'] += archived
+        report['deleted_bodies'] += bodies_deleted
+
+    # VACUUM и incremental_vacuum нельзя выполнять внутри транзакции
+    async with get_engine().connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        if full_vacuum:
+            await connection.exec_driver_sql("VACUUM")
+            # После VACUUM WAL сбрасывается в основной файл
+            await connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        elif (await connection.exec_driver_sql("PRAGMA auto_vacuum")).scalar() == 2:
+            # executescript доводит PRAGMA до конца (через execute модуль sqlite3 освобождает одну страницу)
+            driver_connection = (await connection.get_raw_connection()).driver_connection
+            while (await connection.exec_driver_sql("PRAGMA freelist_count")).scalar():
+                await driver_connection.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})")
+            # PASSIVE не ждет читателей и писателей: файл уменьшится при этом или следующем checkpoint
+            await connection.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")
+        else:
+            print("ℹ️ БД создана без auto_vacuum=INCREMENTAL: место вернет офлайн-команда python db_manager.py --compact.")
+
+    report['bytes_before'] = size_before
+    report['bytes_after'] = await _database_size()
+    report['reclaimed_bytes'] = size_before - report['bytes_after']
+    print(
+        f"🗜️ Уплотнение БД: текстов перенесено {report['moved_bodies']}, записей в архиве {report['archived_rows']}, "
+        f"освобождено {report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ."
+    )
+    return report
+
+# Запуск напрямую: без аргументов - создает базу и проверяет функции;
+# --compact - офлайн-уплотнение с полным VACUUM (бот в это время должен быть остановлен).
 if __name__ == '__main__':
+    import argparse
     from datetime import date
-    
-    print("--- Тест БД ---")
-    init_db()
-    
-    # 1. Тест сохранения: сохраним завтрашнее и послезавтрашнее блюда
-    test_data = [
-        {'meal_date': date.today() + datetime.timedelta(days=1), 'meal_name': 'Омлет со шпинатом', 'recipe_full': '...'},
-        {'meal_date': date.today() + datetime.timedelta(days=2), 'meal_name': 'Курица в соусе терияки', 'recipe_full': '...'},
-    ]
-    save_recipes(test_data)
-    
-    # 2. Тест списка исключений
-    exclusions = get_exclusion_list(days=3)
-    print("\nПолученный список исключений:", exclusions)
+
+    parser = argparse.ArgumentParser(description="Самопроверка и офлайн-обслуживание БД рецептов.")
+    parser.add_argument("--compact", action="store_true", help="уплотнить БД с полным VACUUM")
+    parser.add_argument("--archive-days", type=int, default=HISTORY_ARCHIVE_DAYS)
+    args = parser.parse_args()
+
+    async def _compact():
+        await init_db()
+        try:
+            report = await compact_history(args.archive_days, full_vacuum=True)
+        finally:
+            await dispose_db()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    async def _self_test():
+        print("--- Тест БД ---")
+        await init_db()
+
+        # 1. Тест сохранения: сохраним завтрашнее и послезавтрашнее блюда
+        test_data = [
+            {'meal_date': date.today() + datetime.timedelta(days=1), 'meal_name': 'Омлет со шпинатом', 'recipe_full': '...'},
+            {'meal_date': date.today() + datetime.timedelta(days=2), 'meal_name': 'Курица в соусе терияки', 'recipe_full': '...'},
+        ]
+        await save_recipes(test_data)
+
+        # 2. Тест списка исключений
+        exclusions = await get_exclusion_list(days=3)
+        print("\nПолученный список исключений:", exclusions)
+        await dispose_db()
+
+    asyncio.run(_compact() if args.compact else _self_test())
@@ -0,0 +1,267 @@
+import os
+import time
+import asyncio
+import datetime
+import traceback
+from collections import deque
+from typing import Callable, Dict, List
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, Forbidden, BadRequest
+
+from db_manager import (
+    add_outbox_messages, get_pending_outbox, update_outbox_message, purge_outbox,
+    OUTBOX_SENT, OUTBOX_FAILED, OUTBOX_PENDING
+)
+
+# --- НАСТРОЙКИ РАССЫЛКИ ---
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "30"))
+DELIVERY_GLOBAL_BURST = int(os.getenv("DELIVERY_GLOBAL_BURST", "5"))
+DELIVERY_CHAT_RATE = float(os.getenv("DELIVERY_CHAT_RATE", "1"))
+# Короткая серия в один чат (части одного длинного сообщения) допускается
+DELIVERY_CHAT_BURST = int(os.getenv("DELIVERY_CHAT_BURST", "3"))
+# Сколько чатов обслуживается одновременно
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "32"))
+# Попыток на сообщение при сетевых ошибках (ожидание по RetryAfter попыткой не считается)
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "5"))
+# Базовая задержка экспоненциального ожидания между попытками (секунды)
+DELIVERY_BACKOFF_SECONDS = 1.0
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate событий в секунду в среднем и не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def block(self, seconds: float):
+        """Запрещает выдачу токенов на seconds секунд (ответ Telegram RetryAfter)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    @property
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+
+class DeliveryEngine:
+    """
+    Рассылка сообщений по многим чатам с соблюдением лимитов Telegram.
+
+    Сообщения сначала записываются в таблицу outbox, поэтому неотправленное переживает
+    перезапуск. Чаты обслуживаются по кругу пулом воркеров; сообщения одного чата уходят
+    строго по порядку (части длинного сообщения не перемешиваются). Скорость ограничена
+    общим ведром токенов и ведром каждого чата; на RetryAfter воркер ждет указанное время,
+    на сетевые ошибки - повторяет с экспоненциальной задержкой.
+    """
+
+    def __init__(
+        self,
+        workers: int = DELIVERY_WORKERS,
+        global_rate: float = DELIVERY_GLOBAL_RATE,
+        global_burst: int = DELIVERY_GLOBAL_BURST,
+        chat_rate: float = DELIVERY_CHAT_RATE,
+        chat_burst: int = DELIVERY_CHAT_BURST,
+        max_attempts: int = DELIVERY_MAX_ATTEMPTS,
+    ):
+        self._workers_count = workers
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._max_attempts = max_attempts
+
+        self._bot = None
+        self._pending: Dict[int, deque] = {}
+        self._ready_chats: deque = deque()
+        self._running_chats: set = set()
+        self._condition: asyncio.Condition | None = None
+        self._workers: list = []
+        self._stats = {"sent": 0, "failed": 0, "retry_after": 0, "retries": 0}
+
+    # --- ЖИЗНЕННЫЙ ЦИКЛ ---
+
+    async def start(self, bot, chat_filter: Callable[[int], bool] | None = None):
+        """
+        Запускает воркеры и возвращает в очередь сообщения, не отправленные до перезапуска.
+        chat_filter(chat_id) - восстанавливать только сообщения этих чатов (остальные отправит их воркер).
+        """
+        self._bot = bot
+        self._condition = asyncio.Condition()
+        purged = await purge_outbox()
+        restored = await get_pending_outbox()
+        if chat_filter is not None:
+            restored = [message for message in restored if chat_filter(message['chat_id'])]
+        async with self._condition:
+            for message in restored:
+                self._enqueue_locked(message)
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"delivery-worker-{i}")
+            for i in range(self._workers_count)
+        ]
+        print(
+            f"📬 Рассылка запущена: воркеров {self._workers_count}, восстановлено из outbox {len(restored)}, "
+            f"удалено старых записей {purged}."
+        )
+
+    async def stop(self):
+        """Останавливает воркеры. Неотправленное остается в outbox до следующего запуска."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        print("📬 Рассылка остановлена.")
+
+    # --- ПУБЛИЧНЫЙ API ---
+
+    async def send(self, chat_id: int, texts: List[str], parse_mode: str | None = 'Markdown') -> int:
+        """Ставит сообщения в очередь рассылки (с записью в outbox). Возвращает число поставленных сообщений."""
+        messages = await add_outbox_messages(chat_id, texts, parse_mode)
+        async with self._condition:
+            for message in messages:
+                self._enqueue_locked(message)
+        return len(messages)
+
+    async def join(self):
+        """Ждет, пока очередь рассылки опустеет (для тестов и бенчмарков)."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._pending and not self._running_chats)
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "pending": sum(len(queue) for queue in self._pending.values()),
+            "chats_running": len(self._running_chats),
+        }
+
+    # --- ВОРКЕРЫ ---
+
+    def _enqueue_locked(self, message: dict):
+        chat_id = message['chat_id']
+        self._pending.setdefault(chat_id, deque()).append(message)
+        if chat_id not in self._ready_chats and chat_id not in self._running_chats:
+            self._ready_chats.append(chat_id)
+        self._condition.notify_all()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Полные ведра ничего не помнят - их можно выбросить
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_full}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def _next_chat(self) -> int:
+        async with self._condition:
+            await self._condition.wait_for(lambda: bool(self._ready_chats))
+            chat_id = self._ready_chats.popleft()
+            self._running_chats.add(chat_id)
+            return chat_id
+
+    async def _next_message(self, chat_id: int) -> dict | None:
+        async with self._condition:
+            queue = self._pending.get(chat_id)
+            if queue:
+                return queue.popleft()
+            self._pending.pop(chat_id, None)
+            self._running_chats.discard(chat_id)
+            self._condition.notify_all()
+            return None
+
+    async def _drop_chat(self, chat_id: int, error: str):
+        """Чат недоступен (бот заблокирован, чат удален): остальные его сообщения тоже не будут доставлены."""
+        async with self._condition:
+            dropped = list(self._pending.get(chat_id, []))
+            self._pending[chat_id] = deque()
+        for message in dropped:
+            await update_outbox_message(message['id'], OUTBOX_FAILED, message['attempts'], error)
+            self._stats["failed"] += 1
+
+    async def _worker(self, worker_id: int):
+        while True:
+            chat_id = await self._next_chat()
+            try:
+                while (message := await self._next_message(chat_id)) is not None:
+                    await self._deliver(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"❌ Ошибка воркера рассылки {worker_id} (чат {chat_id}):\n{traceback.format_exc()}")
+                async with self._condition:
+                    self._running_chats.discard(chat_id)
+                    if self._pending.get(chat_id):
+                        self._ready_chats.append(chat_id)
+                    self._condition.notify_all()
+
+    async def _deliver(self, message: dict):
+        """Отправляет одно сообщение с повторами; итог записывается в outbox."""
+        chat_id = message['chat_id']
+        parse_mode = message['parse_mode']
+        chat_bucket = self._chat_bucket(chat_id)
+
+        while True:
+            await chat_bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=message['text'], parse_mode=parse_mode)
+                message['attempts'] += 1
+                await update_outbox_message(message['id'], OUTBOX_SENT, message['attempts'])
+                self._stats["sent"] += 1
+                return
+            except RetryAfter as e:
+                # Флуд-контроль действует на весь бот: останавливаем общую выдачу токенов
+                delay = e.retry_after
+                delay = delay.total_seconds() if isinstance(delay, datetime.timedelta) else float(delay)
+                self._stats["retry_after"] += 1
+                print(f"⏳ Telegram RetryAfter {delay:.0f} с (чат {chat_id}).")
+                self._global_bucket.block(delay)
+                chat_bucket.block(delay)
+            except Forbidden as e:
+                print(f"🚫 Чат {chat_id} недоступен: {e}. Сообщения чата сняты с рассылки.")
+                await update_outbox_message(message['id'], OUTBOX_FAILED, message['attempts'] + 1, str(e))
+                self._stats["failed"] += 1
+                await self._drop_chat(chat_id, str(e))
+                return
+            except BadRequest as e:
+                message['attempts'] += 1
+                if parse_mode and "parse" in str(e).lower():
+                    # Сломанная разметка: отправляем тот же текст без Markdown
+                    print(f"⚠️ Ошибка разметки в сообщении {message['id']}: отправляем без форматирования.")
+                    parse_mode = None
+                    continue
+                print(f"❌ Сообщение {message['id']} отклонено Telegram: {e}")
+                await update_outbox_message(message['id'], OUTBOX_FAILED, message['attempts'], str(e))
+                self._stats["failed"] += 1
+                return
+            except (TimedOut, NetworkError) as e:
+                message['attempts'] += 1
+                if message['attempts'] >= self._max_attempts:
+                    print(f"❌ Сообщение {message['id']} не доставлено после {message['attempts']} попыток: {e}")
+                    await update_outbox_message(message['id'], OUTBOX_FAILED, message['attempts'], str(e))
+                    self._stats["failed"] += 1
+                    return
+                self._stats["retries"] += 1
+                await update_outbox_message(message['id'], OUTBOX_PENDING, message['attempts'], str(e))
+                await asyncio.sleep(DELIVERY_BACKOFF_SECONDS * 2 ** (message['attempts'] - 1))
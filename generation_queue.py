@@ -0,0 +1,276 @@
+import os
+import time
+import asyncio
+import datetime
+import traceback
+import contextvars
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+# --- НАСТРОЙКИ ОЧЕРЕДИ ГЕНЕРАЦИИ ---
+# Число воркеров, разбирающих очередь
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+# Глобальный лимит одновременно выполняемых генераций (на весь процесс)
+GENERATION_MAX_CONCURRENT = int(os.getenv("GENERATION_MAX_CONCURRENT", "4"))
+# Максимум заданий, ожидающих в очереди (по всем чатам)
+GENERATION_MAX_PENDING = int(os.getenv("GENERATION_MAX_PENDING", "100"))
+# Максимум ожидающих заданий одного чата
+GENERATION_MAX_PENDING_PER_CHAT = int(os.getenv("GENERATION_MAX_PENDING_PER_CHAT", "1"))
+# Сообщение о ходе генерации редактируется не чаще раза в столько секунд (лимиты Telegram)
+PROGRESS_MIN_INTERVAL = float(os.getenv("GENERATION_PROGRESS_INTERVAL", "1.5"))
+
+# Результаты submit()
+QUEUED = "queued"
+# Для этого чата и недели задание уже в очереди или выполняется - новый запрос присоединен к нему
+ATTACHED = "attached"
+DUPLICATE = "duplicate"
+FULL = "full"
+
+# Задание, которое выполняется в текущей задаче asyncio (для report_progress)
+_current_job: contextvars.ContextVar = contextvars.ContextVar("generation_job", default=None)
+
+
+@dataclass
+class GenerationJob:
+    """
+    Задание генерации плана чата на неделю. Одно на (чат, неделя): повторные запросы
+    присоединяются к нему. Ход генерации показывается правкой одного сообщения статуса.
+    """
+    chat_id: int
+    week_start: datetime.date
+    kwargs: Dict[str, Any]
+    # Сколько запросов обслуживает задание (первый плюс присоединенные)
+    requests: int = 1
+    stage: str = "🚀 Генерация поставлена в очередь."
+    status_message_id: int | None = None
+    cancelled: bool = False
+    task: asyncio.Task | None = field(default=None, repr=False)
+    _last_edit: float = 0.0
+
+    @property
+    def key(self) -> Tuple[int, datetime.date]:
+        return self.chat_id, self.week_start
+
+    async def set_stage(self, text: str, force: bool = False):
+        """Запоминает этап и правит сообщение статуса (промежуточные этапы - не чаще PROGRESS_MIN_INTERVAL)."""
+        self.stage = text
+        bot = self.kwargs.get("bot")
+        if bot is None or self.status_message_id is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_edit < PROGRESS_MIN_INTERVAL:
+            return
+        self._last_edit = now
+        try:
+            await bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.status_message_id)
+        except Exception as e:
+            # Например, "message is not modified" или сообщение удалено - на генерацию не влияет
+            print(f"⚠️ Не удалось обновить статус генерации для чата {self.chat_id}: {e}")
+
+
+async def report_progress(text: str):
+    """Сообщает этап генерации заданию, которое выполняется сейчас (вне очереди - ничего не делает)."""
+    job = _current_job.get()
+    if job is not None:
+        await job.set_stage(text)
+
+
+class GenerationQueue:
+    """
+    Ограниченная очередь заданий генерации с пулом воркеров.
+
+    Справедливость между чатами: задания выбираются по кругу (round-robin) по чатам,
+    и у одного чата одновременно выполняется не больше одного задания. Поэтому чат,
+    поставивший много заданий, не блокирует остальных. Общее число одновременно
+    выполняемых генераций ограничено семафором.
+
+    Single-flight: пока задание (чат, неделя) ждет или выполняется, повторные запросы на ту же
+    неделю не создают новых заданий - ни лишних запросов к OpenAI, ни повторных записей в БД.
+    Задание можно отменить (cancel): ожидающее убирается из очереди, выполняемое прерывается.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        workers: int = GENERATION_WORKERS,
+        max_concurrent: int = GENERATION_MAX_CONCURRENT,
+        max_pending: int = GENERATION_MAX_PENDING,
+        max_pending_per_chat: int = GENERATION_MAX_PENDING_PER_CHAT,
+    ):
+        self._handler = handler
+        self._workers_count = workers
+        self._max_concurrent = max_concurrent
+        self._max_pending = max_pending
+        self._max_pending_per_chat = max_pending_per_chat
+
+        # chat_id -> очередь ожидающих заданий этого чата
+        self._pending: Dict[int, deque] = {}
+        # Порядок обхода чатов, у которых есть ожидающие задания
+        self._ready_chats: deque = deque()
+        self._running_chats: set = set()
+        self._pending_count = 0
+        # (чат, неделя) -> ожидающее или выполняемое задание
+        self._jobs: Dict[Tuple[int, datetime.date], GenerationJob] = {}
+        self._counters = {"attached": 0, "cancelled": 0}
+
+        self._condition: asyncio.Condition | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._workers: list = []
+
+    # --- ЖИЗНЕННЫЙ ЦИКЛ ---
+
+    async def start(self):
+        """Запускает воркеры. Вызывается из уже работающего event loop."""
+        self._condition = asyncio.Condition()
+        self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        self._workers = [
+            asyncio.create_task(self._worker(i), name=f"generation-worker-{i}")
+            for i in range(self._workers_count)
+        ]
+        print(f"🧵 Очередь генерации запущена: воркеров {self._workers_count}, одновременно не больше {self._max_concurrent}.")
+
+    async def stop(self):
+        """Останавливает воркеры. Ожидающие задания отбрасываются."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        print("🧵 Очередь генерации остановлена.")
+
+    # --- ПУБЛИЧНЫЙ API ---
+
+    async def submit(self, chat_id: int, week_start: datetime.date, **kwargs) -> str:
+        """
+        Ставит задание генерации плана чата на неделю week_start в очередь.
+        Возвращает QUEUED, ATTACHED (задание на эту неделю уже есть - запрос присоединен к нему),
+        DUPLICATE (у чата уже максимум ожидающих заданий) или FULL (очередь переполнена).
+        """
+        async with self._condition:
+            job = self._jobs.get((chat_id, week_start))
+            if job is not None and not job.cancelled:
+                job.requests += 1
+                self._counters["attached"] += 1
+                return ATTACHED
+
+            chat_queue = self._pending.setdefault(chat_id, deque())
+            if len(chat_queue) >= self._max_pending_per_chat:
+                return DUPLICATE
+            if self._pending_count >= self._max_pending:
+                return FULL
+
+            job = GenerationJob(chat_id, week_start, kwargs)
+            chat_queue.append(job)
+            self._jobs[job.key] = job
+            self._pending_count += 1
+            if chat_id not in self._ready_chats and chat_id not in self._running_chats:
+                self._ready_chats.append(chat_id)
+            self._condition.notify_all()
+            return QUEUED
+
+    def find(self, chat_id: int, week_start: datetime.date) -> GenerationJob | None:
+        """Ожидающее или выполняемое задание чата на неделю (None, если его нет)."""
+        return self._jobs.get((chat_id, week_start))
+
+    async def cancel(self, chat_id: int) -> int:
+        """Отменяет все задания чата: ожидающие убираются из очереди, выполняемое прерывается. Возвращает их число."""
+        async with self._condition:
+            jobs = [job for job in self._jobs.values() if job.chat_id == chat_id and not job.cancelled]
+            for job in jobs:
+                job.cancelled = True
+            chat_queue = self._pending.get(chat_id)
+            if chat_queue:
+                self._pending_count -= len(chat_queue)
+                for job in chat_queue:
+                    self._jobs.pop(job.key, None)
+                chat_queue.clear()
+                if chat_id in self._ready_chats:
+                    self._ready_chats.remove(chat_id)
+            self._counters["cancelled"] += len(jobs)
+            self._condition.notify_all()
+
+        for job in jobs:
+            if job.task is not None:
+                job.task.cancel()
+            else:
+                await job.set_stage("🛑 Генерация отменена.", force=True)
+        return len(jobs)
+
+    async def join(self):
+        """Ждет, пока не останется ни ожидающих, ни выполняемых заданий (для бенчмарков)."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._pending_count and not self._running_chats)
+
+    def position(self, chat_id: int) -> int:
+        """Сколько чатов стоит в очереди перед данным (0 - выполняется или следующий)."""
+        try:
+            return list(self._ready_chats).index(chat_id)
+        except ValueError:
+            return 0
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending_count,
+            "running": len(self._running_chats),
+            "workers": len(self._workers),
+            **self._counters,
+        }
+
+    # --- ВОРКЕРЫ ---
+
+    async def _next_job(self) -> GenerationJob:
+        async with self._condition:
+            await self._condition.wait_for(lambda: bool(self._ready_chats))
+            chat_id = self._ready_chats.popleft()
+            job = self._pending[chat_id].popleft()
+            self._pending_count -= 1
+            self._running_chats.add(chat_id)
+            return job
+
+    async def _finish_job(self, job: GenerationJob):
+        async with self._condition:
+            chat_id = job.chat_id
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            self._running_chats.discard(chat_id)
+            if self._pending.get(chat_id):
+                # У чата остались задания - в конец круга, чтобы не обгонять другие чаты
+                self._ready_chats.append(chat_id)
+                self._condition.notify_all()
+            else:
+                self._pending.pop(chat_id, None)
+                self._condition.notify_all()
+
+    async def _run(self, job: GenerationJob):
+        _current_job.set(job)
+        await job.set_stage("⚙️ Генерация началась.", force=True)
+        await self._handler(chat_id=job.chat_id, **job.kwargs)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await self._next_job()
+            try:
+                async with self._semaphore:
+                    if job.cancelled:
+                        # Отменено, пока задание ждало свободного места
+                        continue
+                    print(f"--- 🧵 Воркер {worker_id}: генерация для чата {job.chat_id} (запросов: {job.requests}). ---")
+                    # Задание - отдельная задача: ее отмена (/cancel) не останавливает воркер
+                    job.task = asyncio.create_task(self._run(job), name=f"generation-{job.chat_id}")
+                    try:
+                        await job.task
+                        await job.set_stage("✅ Генерация завершена.", force=True)
+                    except asyncio.CancelledError:
+                        if not job.cancelled:
+                            # Останавливается сам воркер (stop) - задание прерывается вместе с ним
+                            job.task.cancel()
+                            raise
+                        print(f"🛑 Генерация для чата {job.chat_id} отменена.")
+                        await job.set_stage("🛑 Генерация отменена.", force=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"❌ Ошибка задания генерации для чата {job.chat_id}:\n{traceback.format_exc()}")
+                await job.set_stage("❌ Ошибка генерации. Подробности в логах.", force=True)
+            finally:
+                await self._finish_job(job)
@@ -0,0 +1,318 @@
+import os
+import re
+import random
+import datetime
+import itertools
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from db_manager import get_recipe_library, get_recipe_texts, get_recipe_ids_with_ingredients
+from day_messages import format_kzhbu
+from ai_generator import MEAL_TYPES, DAY_NAMES, USER_KZHBU, normalize_meal_name
+from metrics import increment
+
+# --- НАСТРОЙКИ РЕЖИМА БИБЛИОТЕКИ ---
+# Сколько кандидатов на прием пищи перебирается для одного дня (K^4 комбинаций)
+LIBRARY_CANDIDATES_PER_SLOT = int(os.getenv("LIBRARY_CANDIDATES_PER_SLOT", "16"))
+# Допустимое отклонение дневной калорийности от цели (как в промпте для ИИ)
+DAILY_KCAL_TOLERANCE = 100
+# Насколько можно выйти за диапазон калорийности приема пищи (доля от границы)
+SLOT_RANGE_SLACK = 0.05
+# Если библиотека покрывает меньшую долю блюд недели, план генерируется ИИ целиком
+LIBRARY_MIN_COVERAGE = float(os.getenv("LIBRARY_MIN_COVERAGE", "0.5"))
+# Библиотеки скольких чатов держать в памяти процесса (давно не нужные вытесняются)
+LIBRARY_CACHE_MAX_CHATS = int(os.getenv("LIBRARY_CACHE_MAX_CHATS", "100"))
+
+# Веса целевой функции: отклонение по калориям (в долях допуска), по белку,
+# повтор основы названия в дне, повтор с предыдущим днем, частота блюда в истории
+_PROTEIN_WEIGHT = 0.5
+_SAME_DAY_OVERLAP_WEIGHT = 1.0
+_PREVIOUS_DAY_OVERLAP_WEIGHT = 0.5
+_USES_WEIGHT = 0.1
+
+_RANGE_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(?:[-–]\s*(\d+(?:[.,]\d+)?))?")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+_NAME_WORD_RE = re.compile(r"[a-zа-я]{3,}")
+_NAME_STOP_WORDS = {"для", "под", "без", "или", "над", "при"}
+
+
+def _name_stems(name: str) -> frozenset:
+    """Основы значимых слов названия: 'Курица с рисом' и 'Курица терияки' пересекаются по 'куриц'."""
+    words = _NAME_WORD_RE.findall(name.lower().replace("ё", "е"))
+    return frozenset(word[:5] for word in words if word not in _NAME_STOP_WORDS)
+
+
+def parse_kcal_range(text: str) -> Tuple[float, float] | None:
+    """'900-1100 ккал' -> (900, 1100); одно число дает диапазон ±10%."""
+    match = _RANGE_RE.search(str(text or ""))
+    if not match:
+        return None
+    low = float(match.group(1).replace(",", "."))
+    if match.group(2) is None:
+        return low * 0.9, low * 1.1
+    return low, float(match.group(2).replace(",", "."))
+
+
+def parse_daily_target(profile: Dict[str, Any], ranges: Dict[str, Tuple[float, float]]) -> Tuple[float, float | None]:
+    """Дневная цель (ккал, белок) из 'total_target_kzhbu'; без нее - сумма середин диапазонов."""
+    numbers = [float(n.replace(",", ".")) for n in _NUMBER_RE.findall(str(profile.get('total_target_kzhbu', '')))]
+    if numbers:
+        return numbers[0], numbers[1] if len(numbers) > 1 else None
+    return sum((low + high) / 2 for low, high in ranges.values()), None
+
+
+# --- 1. БИБЛИОТЕКА (ИНДЕКС КАНДИДАТОВ В ПАМЯТИ) ---
+
+@dataclass
+class SlotIndex:
+    """Блюда одного типа приема пищи, отсортированные по калорийности (для выборки диапазона через searchsorted)."""
+    entries: List[dict]
+    kcal: np.ndarray
+    protein: np.ndarray
+    uses: np.ndarray
+    keys: List[str] = field(default_factory=list)
+    # Нормализованное название -> позиция (названия внутри типа уникальны)
+    positions: Dict[str, int] = field(default_factory=dict)
+
+
+class RecipeLibrary:
+    """
+    Все блюда истории чата с КЖБУ: последняя версия каждого блюда по типу приема пищи.
+    Дозагружается по id (только новые записи), индексы по типам перестраиваются при изменениях.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.max_id = 0
+        self._entries: Dict[Tuple[str, str], dict] = {}
+        self._slots: Dict[str, SlotIndex] | None = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def refresh(self):
+        rows = await get_recipe_library(self.chat_id, after_id=self.max_id)
+        for row in rows:
+            key = (row['meal_type'], normalize_meal_name(row['meal_name']))
+            previous = self._entries.get(key)
+            if previous is not None:
+                row['uses'] += previous['uses']
+            self._entries[key] = row
+            self.max_id = max(self.max_id, row['id'])
+        if rows:
+            self._slots = None
+
+    def slot(self, meal_type: str) -> SlotIndex:
+        if self._slots is None:
+            self._slots = {}
+            for slot_type in MEAL_TYPES:
+                entries = sorted(
+                    (entry for (entry_type, _), entry in self._entries.items() if entry_type == slot_type),
+                    key=lambda entry: entry['kcal']
+                )
+                keys = [normalize_meal_name(e['meal_name']) for e in entries]
+                self._slots[slot_type] = SlotIndex(
+                    entries=entries,
+                    kcal=np.array([e['kcal'] for e in entries], dtype=np.float64),
+                    protein=np.array([e['protein'] or 0.0 for e in entries], dtype=np.float64),
+                    uses=np.array([e['uses'] for e in entries], dtype=np.float64),
+                    keys=keys,
+                    positions={key: position for position, key in enumerate(keys)},
+                )
+        return self._slots[meal_type]
+
+
+# chat_id -> библиотека чата; порядок - для LRU-вытеснения
+_libraries: "OrderedDict[int, RecipeLibrary]" = OrderedDict()
+
+
+def get_library(chat_id: int) -> RecipeLibrary:
+    library = _libraries.get(chat_id)
+    if library is None:
+        library = _libraries[chat_id] = RecipeLibrary(chat_id)
+    _libraries.move_to_end(chat_id)
+    while len(_libraries) > LIBRARY_CACHE_MAX_CHATS:
+        _libraries.popitem(last=False)
+    return library
+
+
+def invalidate_library(chat_id: int | None = None):
+    """Сбрасывает библиотеку чата (или всех чатов) после удаления истории: следующий план загрузит ее заново."""
+    if chat_id is None:
+        _libraries.clear()
+    else:
+        _libraries.pop(chat_id, None)
+
+
+# --- 2. ОПТИМИЗАТОР ---
+
+def _pick_candidates(slot: SlotIndex, allowed: np.ndarray, kcal_range: Tuple[float, float], rng: random.Random) -> np.ndarray:
+    """До K свободных блюд из диапазона калорийности: в первую очередь редкие в истории."""
+    low, high = kcal_range
+    start, stop = np.searchsorted(slot.kcal, [low * (1 - SLOT_RANGE_SLACK), high * (1 + SLOT_RANGE_SLACK)], side="left")
+    positions = np.flatnonzero(allowed[start:stop]) + start
+    if len(positions) <= LIBRARY_CANDIDATES_PER_SLOT:
+        return positions
+    jitter = np.array([rng.random() for _ in range(len(positions))])
+    priority = np.log1p(slot.uses[positions]) + jitter
+    return positions[np.argpartition(priority, LIBRARY_CANDIDATES_PER_SLOT)[:LIBRARY_CANDIDATES_PER_SLOT]]
+
+
+def _best_day(
+    slots: List[SlotIndex], candidates: List[np.ndarray], kcal_target: float, protein_target: float | None,
+    previous_stems: frozenset
+) -> Tuple[int, ...] | None:
+    """
+    Полный перебор комбинаций кандидатов дня на сетке NumPy (K^n, n - число приемов пищи).
+    Возвращает индексы выбранных кандидатов или None, если ни одна комбинация не попала в допуск.
+    """
+    dims = len(slots)
+
+    def along(values: np.ndarray, axis: int) -> np.ndarray:
+        shape = [1] * dims
+        shape[axis] = len(values)
+        return values.reshape(shape)
+
+    stems = [[_name_stems(slot.entries[pos]['meal_name']) for pos in positions] for slot, positions in zip(slots, candidates)]
+    kcal = sum(along(slot.kcal[positions], axis) for axis, (slot, positions) in enumerate(zip(slots, candidates)))
+    deviation = np.abs(kcal - kcal_target) / DAILY_KCAL_TOLERANCE
+    cost = deviation.copy()
+
+    if protein_target:
+        protein = sum(along(slot.protein[positions], axis) for axis, (slot, positions) in enumerate(zip(slots, candidates)))
+        cost = cost + _PROTEIN_WEIGHT * np.abs(protein - protein_target) / (0.1 * protein_target)
+
+    for axis, (slot, positions) in enumerate(zip(slots, candidates)):
+        previous_overlap = np.array([len(s & previous_stems) for s in stems[axis]], dtype=np.float64)
+        cost = cost + along(_USES_WEIGHT * np.log1p(slot.uses[positions]) + _PREVIOUS_DAY_OVERLAP_WEIGHT * previous_overlap, axis)
+
+    # Попарные пересечения основ названий между приемами пищи одного дня
+    for axis_a, axis_b in itertools.combinations(range(dims), 2):
+        overlap = np.array([[len(a & b) for b in stems[axis_b]] for a in stems[axis_a]], dtype=np.float64)
+        shape = [1] * dims
+        shape[axis_a], shape[axis_b] = overlap.shape
+        cost = cost + _SAME_DAY_OVERLAP_WEIGHT * overlap.reshape(shape)
+
+    cost = np.where(deviation <= 1.0, cost, np.inf)
+    best = int(np.argmin(cost))
+    if not np.isfinite(cost.flat[best]):
+        return None
+    return np.unravel_index(best, cost.shape)
+
+
+def plan_from_library(
+    library: RecipeLibrary, profile: Dict[str, Any], dates: List[datetime.date], exclusion_list: List[str],
+    seed: int | None = None, avoided_ids: frozenset = frozenset()
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Собирает план на даты из библиотеки. Возвращает (дни с выбранными записями библиотеки, число закрытых блюд).
+    Блюда из списка исключений (21 день) и уже выбранные в этом плане не повторяются;
+    записи из avoided_ids (с часто встречавшимися за неделю ингредиентами) не выбираются.
+    Прием пищи без кандидатов остается пустым; день, который не сходится по калориям, не включается
+    (и то и другое потом догенерирует ИИ).
+    """
+    rng = random.Random(seed)
+    ranges = {}
+    for meal_type in MEAL_TYPES:
+        kcal_range = parse_kcal_range(profile.get('target_distribution_kzhbu', {}).get(meal_type))
+        if kcal_range is not None:
+            ranges[meal_type] = kcal_range
+    kcal_target, protein_target = parse_daily_target(profile, ranges)
+
+    excluded = {normalize_meal_name(name) for name in exclusion_list}
+    used_names = set(excluded)
+    allowed = {}
+    for meal_type in ranges:
+        slot = library.slot(meal_type)
+        allowed[meal_type] = np.array(
+            [key not in excluded and entry['id'] not in avoided_ids for key, entry in zip(slot.keys, slot.entries)],
+            dtype=bool
+        )
+
+    plan = []
+    covered = 0
+    previous_stems = frozenset()
+    for day_date in dates:
+        day_types, day_slots, day_candidates = [], [], []
+        for meal_type, kcal_range in ranges.items():
+            slot = library.slot(meal_type)
+            candidates = _pick_candidates(slot, allowed[meal_type], kcal_range, rng)
+            if len(candidates):
+                day_types.append(meal_type)
+                day_slots.append(slot)
+                day_candidates.append(candidates)
+        if not day_types:
+            continue
+
+        # Калории приемов пищи без кандидатов ИИ доберет по середине их диапазона
+        missing_kcal = sum((low + high) / 2 for meal_type, (low, high) in ranges.items() if meal_type not in day_types)
+        choice = _best_day(day_slots, day_candidates, kcal_target - missing_kcal, protein_target, previous_stems)
+        if choice is None:
+            continue
+
+        picks = {}
+        for meal_type, slot, positions, idx in zip(day_types, day_slots, day_candidates, choice):
+            position = positions[idx]
+            entry = slot.entries[position]
+            # Одно название не повторяется в плане и в другом приеме пищи
+            if slot.keys[position] in used_names:
+                continue
+            used_names.add(slot.keys[position])
+            for other_type in ranges:
+                other_position = library.slot(other_type).positions.get(slot.keys[position])
+                if other_position is not None:
+                    allowed[other_type][other_position] = False
+            picks[meal_type] = entry
+        covered += len(picks)
+        previous_stems = frozenset().union(*(_name_stems(entry['meal_name']) for entry in picks.values()))
+        plan.append({'date': day_date, 'picks': picks})
+    return plan, covered
+
+
+async def assemble_library_plan(
+    chat_id: int, profile: Dict[str, Any] | None, exclusion_list: List[str], dates: List[datetime.date]
+) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    План недели из истории рецептов этого чата без обращения к ИИ, в формате ответа модели.
+    Возвращает (список дней, доля закрытых библиотекой блюд); пробелы закрывает repair_weekly_plan.
+    """
+    profile = profile or USER_KZHBU
+    library = get_library(chat_id)
+    await library.refresh()
+    # Ингредиентные исключения (load_exclusions): блюда с ними ИИ заменит другими
+    avoided_ids = frozenset(await get_recipe_ids_with_ingredients(chat_id, profile.get('recent_ingredients', [])))
+    plan, covered = plan_from_library(library, profile, dates, exclusion_list, avoided_ids=avoided_ids)
+
+    texts = await get_recipe_texts([entry['id'] for day in plan for entry in day['picks'].values()])
+    weekly_plan = []
+    for day in plan:
+        meals = []
+        for meal_type, entry in day['picks'].items():
+            recipe_full = texts.get(entry['id'])
+            if recipe_full is None:
+                # Запись удалена после загрузки библиотеки - блюдо догенерирует ИИ
+                covered -= 1
+                continue
+            meals.append({
+                'type': meal_type,
+                'meal_name': entry['meal_name'],
+                'total_kzhbu_for_two': format_kzhbu(entry['kcal'], entry['protein'], entry['fat'], entry['carbs']),
+                'weight_m': entry['weight_m'],
+                'weight_w': entry['weight_w'],
+                'recipe_full': recipe_full,
+            })
+        if meals:
+            weekly_plan.append({
+                'day': DAY_NAMES[day['date'].weekday()],
+                'date': day['date'].strftime("%Y-%m-%d"),
+                'meals': meals,
+            })
+
+    total_slots = len(dates) * len(MEAL_TYPES)
+    increment("library_meals_total", covered, source="library")
+    increment("library_meals_total", total_slots - covered, source="llm")
+    print(f"📚 План из библиотеки чата {chat_id} ({len(library)} блюд): закрыто {covered} из {total_slots} блюд без обращения к ИИ.")
+    return weekly_plan, covered / total_slots if total_slots else 0.0
@@ -0,0 +1,218 @@
+import os
+import json
+import asyncio
+import hashlib
+import datetime
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Text, func
+from sqlalchemy.orm import sessionmaker, declarative_base
+
+from db_manager import DATABASE_FILE
+from metrics import instrument_engine
+
+# --- 1. НАСТРОЙКИ КЭША ---
+# Кэш ответов OpenAI хранится в отдельном файле SQLite рядом с recipes.db
+CACHE_DATABASE_FILE = os.path.join(os.path.dirname(DATABASE_FILE), "llm_cache.db")
+# Время жизни записи (в часах) и максимальное число записей (лишние вытесняются по LRU)
+CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+# Глобальный флаг: LLM_CACHE_DISABLED=1 полностью отключает кэш
+CACHE_ENABLED = os.getenv("LLM_CACHE_DISABLED", "0") != "1"
+# Потоки для обращений к файлу кэша из асинхронного кода (см. run_cache_io)
+CACHE_IO_THREADS = int(os.getenv("LLM_CACHE_IO_THREADS", "2"))
+
+CacheBase = declarative_base()
+# Движок и файл кэша создаются при первом обращении к кэшу (CacheSession), а не при импорте модуля
+_cache_sessionmaker = None
+_engine_lock = threading.Lock()
+_io_executor = None
+
+# Счетчики попаданий/промахов за время работы процесса
+_stats_lock = threading.Lock()
+CACHE_STATS = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+# --- 2. МОДЕЛЬ ДАННЫХ (ТАБЛИЦА 'llm_responses') ---
+class CachedResponse(CacheBase):
+    """Ответ модели, адресуемый хэшем параметров запроса."""
+    __tablename__ = 'llm_responses'
+
+    # sha256 от (модель, температура, системное сообщение, промпт)
+    cache_key = Column(String(64), primary_key=True)
+    model = Column(String, nullable=False)
+    # Сырой текст ответа (JSON), ровно как его вернула модель
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    # Для LRU-вытеснения
+    last_accessed_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+    hit_count = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<CachedResponse(model='{self.model}', hits={self.hit_count})>"
+
+
+def _set_cache_pragmas(dbapi_connection, connection_record):
+    """
+    Файлом кэша пользуются одновременно event loop (через run_cache_io) и потоки генерации:
+    WAL - чтение не ждет записи, busy_timeout - ждать блокировку вместо ошибки.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def CacheSession():
+    """Новая сессия кэша; при первом вызове создает движок и таблицу."""
+    global _cache_sessionmaker
+    if _cache_sessionmaker is None:
+        with _engine_lock:
+            if _cache_sessionmaker is None:
+                cache_engine = create_engine(f"sqlite:///{CACHE_DATABASE_FILE}")
+                event.listen(cache_engine, "connect", _set_cache_pragmas)
+                instrument_engine(cache_engine, "llm_cache")
+                CacheBase.metadata.create_all(cache_engine)
+                _cache_sessionmaker = sessionmaker(bind=cache_engine)
+    return _cache_sessionmaker()
+
+
+async def run_cache_io(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию, работающую с файлом кэша (кэш ответов, статистика моделей),
+    в отдельном небольшом пуле потоков: event loop не ждет SQLite, а сами обращения не стоят
+    в очереди пула по умолчанию за долгими синхронными генерациями.
+    """
+    global _io_executor
+    if _io_executor is None:
+        with _engine_lock:
+            if _io_executor is None:
+                _io_executor = ThreadPoolExecutor(max_workers=CACHE_IO_THREADS, thread_name_prefix="llm-cache-io")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args, **kwargs))
+
+
+# --- 3. ФУНКЦИИ КЭША ---
+
+def _count(stat: str, amount: int = 1):
+    with _stats_lock:
+        CACHE_STATS[stat] += amount
+
+
+def make_cache_key(model: str, temperature: float, system_message: str, prompt: str) -> str:
+    """Строит ключ кэша: хэш всех параметров, влияющих на ответ модели."""
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "system": system_message, "prompt": prompt},
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_cached_response(cache_key: str) -> str | None:
+    """Возвращает сохраненный ответ или None (нет записи, запись устарела или кэш выключен)."""
+    if not CACHE_ENABLED:
+        return None
+
+    session = CacheSession()
+    try:
+        entry = session.get(CachedResponse, cache_key)
+        now = datetime.datetime.utcnow()
+
+        if entry is not None and now - entry.created_at > datetime.timedelta(hours=CACHE_TTL_HOURS):
+            session.delete(entry)
+            session.commit()
+            entry = None
+
+        if entry is None:
+            _count("misses")
+            return None
+
+        entry.last_accessed_at = now
+        entry.hit_count += 1
+        content = entry.content
+        session.commit()
+        _count("hits")
+        print(f"⚡ Ответ найден в кэше LLM (попаданий по ключу: {entry.hit_count}).")
+        return content
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Ошибка чтения кэша LLM: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def put_cached_response(cache_key: str, model: str, content: str):
+    """Сохраняет ответ в кэш и вытесняет самые давно использованные записи сверх лимита."""
+    if not CACHE_ENABLED:
+        return
+
+    session = CacheSession()
+    try:
+        now = datetime.datetime.utcnow()
+        session.merge(CachedResponse(
+            cache_key=cache_key,
+            model=model,
+            content=content,
+            created_at=now,
+            last_accessed_at=now,
+            hit_count=0
+        ))
+        session.flush()
+
+        overflow = session.query(func.count(CachedResponse.cache_key)).scalar() - CACHE_MAX_ENTRIES
+        if overflow > 0:
+            oldest_keys = [
+                row[0] for row in session.query(CachedResponse.cache_key)
+                .order_by(CachedResponse.last_accessed_at.asc())
+                .limit(overflow)
+                .all()
+            ]
+            session.query(CachedResponse).filter(
+                CachedResponse.cache_key.in_(oldest_keys)
+            ).delete(synchronize_session=False)
+            _count("evictions", len(oldest_keys))
+
+        session.commit()
+        _count("stores")
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Ошибка записи в кэш LLM: {e}")
+    finally:
+        session.close()
+
+
+def get_cache_stats() -> dict:
+    """Счетчики процесса плюс текущее число записей в кэше."""
+    session = CacheSession()
+    try:
+        entries = session.query(func.count(CachedResponse.cache_key)).scalar()
+    except Exception:
+        entries = None
+    finally:
+        session.close()
+
+    with _stats_lock:
+        stats = dict(CACHE_STATS)
+    stats["entries"] = entries
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 3) if total else 0.0
+    return stats
+
+
+def clear_cache() -> int:
+    """Удаляет все записи кэша. Возвращает число удаленных записей."""
+    session = CacheSession()
+    try:
+        num_deleted = session.query(CachedResponse).delete()
+        session.commit()
+        return num_deleted
+    except Exception as e:
+        session.rollback()
+        print(f"❌ Ошибка очистки кэша LLM: {e}")
+        return 0
+    finally:
+        session.close()
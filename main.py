@@ -1,6 +1,11 @@
 import os
+import sys
+import json
 import datetime
 import asyncio
+import dataclasses
+import functools
+import threading
 import traceback
 from dotenv import load_dotenv
 
@@ -8,7 +13,31 @@ from dotenv import load_dotenv
 load_dotenv() 
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Чат администратора: зарегистрирован всегда, с профилем по умолчанию (USER_KZHBU)
 YOUR_CHAT_ID = os.getenv("YOUR_CHAT_ID")
+# Адрес Bot API (например, http://localhost:8081/bot для локального сервера); по умолчанию - api.telegram.org
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Вебхук: публичный адрес (за ним может стоять балансировщик на несколько воркеров), путь и секрет
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+# Каждый воркер слушает WEBHOOK_PORT + WORKER_INDEX (на одном хосте); всего воркеров - WEBHOOK_WORKERS.
+# Очередь генерации (single-flight, /cancel, справедливость между чатами), кэши сообщений дня и
+# библиотеки блюд живут в памяти процесса, поэтому каждый чат обслуживает ровно один воркер -
+# chat_id % WEBHOOK_WORKERS: чужие обновления пересылаются ему, задания по расписанию и рассылку
+# каждый воркер выполняет только для своих чатов. Уплотнение истории и чистка отметок обновлений - в воркере 0.
+# Лимит GENERATION_MAX_CONCURRENT действует в каждом воркере: на весь бот - в WEBHOOK_WORKERS раз больше.
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", "1"))) if BOT_MODE == "webhook" else 1
+IS_PRIMARY_WORKER = WORKER_INDEX == 0
+# Адрес, по которому воркеры пересылают друг другу обновления чужих чатов
+WEBHOOK_FORWARD_HOST = os.getenv("WEBHOOK_FORWARD_HOST", "127.0.0.1")
+# ALLOW_REGISTRATION=1 - любой чат может зарегистрироваться командой /start
+ALLOW_REGISTRATION = os.getenv("ALLOW_REGISTRATION", "0") == "1"
 
 if YOUR_CHAT_ID:
     try:
@@ -19,118 +48,110 @@ if YOUR_CHAT_ID:
 
 # --- ИМПОРТЫ ЛОГИКИ И БИБЛИОТЕК ---
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
-# APScheduler импортируем, но не используем, пока не будет включена автоматизация
-from apscheduler.schedulers.background import BackgroundScheduler 
-from apscheduler.triggers.cron import CronTrigger
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, ContextTypes, TypeHandler
 
 # Ваша логика:
-from db_manager import init_db, get_exclusion_list, save_recipes, Recipe, Session
-from ai_generator import generate_weekly_plan 
+from db_manager import (
+    init_db, dispose_db, clear_history,
+    get_profile, save_profile, list_profile_chat_ids, parse_kzhbu,
+    get_prepared_plan, mark_prepared_plan_delivered,
+    register_update, purge_processed_updates, search_recipes, compact_history,
+    HISTORY_ARCHIVE_DAYS
+)
+from ai_generator import (
+    generate_weekly_plan, stream_weekly_plan, generate_weekly_plan_parallel, repair_weekly_plan,
+    get_plan_dates, USER_KZHBU, REPAIR_STATS, MEAL_TYPES
+)
+from plan_validator import extract_day_list
+from day_messages import split_message, get_day_messages, invalidate_day_messages, render_recipe_markdown
+from plan_service import (
+    format_day_plan, build_weekly_message, save_plan_recipes, save_weekly_plan, save_streamed_plan, load_exclusions
+)
+from delivery import DeliveryEngine, DELIVERY_GLOBAL_RATE
+from scheduler import ScheduledJob, schedule_jobs, parse_time, WEEKDAYS, SATURDAY, SUNDAY
+from generation_queue import GenerationQueue, QUEUED, ATTACHED, DUPLICATE, GENERATION_MAX_CONCURRENT, report_progress
+# nutrition, portion_optimizer и library_planner (NumPy) импортируются внутри функций генерации:
+# до первой генерации они не нужны, а импорт NumPy заметно удлиняет холодный старт
+from metrics import span, summary as metrics_summary, start_metrics_server, METRICS_PORT
+from llm_cache import get_cache_stats
+from model_router import ROUTER
+
+
+# Режим генерации: "stream" - дни отправляются по мере генерации, "batch" - одним сообщением,
+# "parallel" - каждый день генерируется отдельным асинхронным запросом, параллельно,
+# "library" - план собирается из истории рецептов, ИИ догенерирует только то, что не нашлось
+GENERATION_MODE = os.getenv("GENERATION_MODE", "stream").lower()
+
+# Расписание (время в часовом поясе BOT_TIMEZONE):
+# заблаговременная генерация плана - суббота, отправка плана - воскресенье, напоминание - будни
+SPECULATIVE_GENERATION_TIME = os.getenv("SPECULATIVE_GENERATION_TIME", "03:00")
+WEEKLY_DELIVERY_TIME = os.getenv("WEEKLY_DELIVERY_TIME", "10:00")
+DAILY_REMINDER_TIME = os.getenv("DAILY_REMINDER_TIME", "07:00")
+# Уплотнение истории (архив старых записей и incremental_vacuum) - воскресенье, до отправки плана
+HISTORY_COMPACTION_TIME = os.getenv("HISTORY_COMPACTION_TIME", "04:00")
+
+# Сколько найденных блюд показывает /find
+FIND_RESULTS_LIMIT = 10
 
 
 # --- 2. ГЛАВНЫЕ ФУНКЦИИ БОТА (АСИНХРОННЫЕ) ---
 
-def sync_generation_logic():
+def invalidate_library_cache(chat_id: int | None = None):
     """
-    Синхронная функция для блокирующих операций: Чтение БД, вызов AI, запись в БД.
-    Запускается в отдельном потоке (executor).
+    Сбрасывает библиотеку блюд режима library (чата или всех чатов) - только если модуль
+    уже загружен (импорт ради сброса не нужен).
     """
+    library_planner = sys.modules.get("library_planner")
+    if library_planner is not None:
+        library_planner.invalidate_library(chat_id)
+
+
+async def batch_generation_logic(chat_id: int, profile: dict, use_cache: bool = True):
+    """
+    Пакетная генерация: чтение БД, вызов AI, запись в БД.
+    БД вызывается асинхронно, в отдельном потоке (executor) выполняется только блокирующий вызов OpenAI.
+    """
+    from portion_optimizer import optimize_plan_portions
+
     try:
-        # 1. Получаем список исключений
-        exclusion_list = get_exclusion_list(days=21)
+        # 1. Получаем список исключений (только история этого чата)
+        exclusion_list, profile = await load_exclusions(chat_id, profile)
         
         # 2. Генерируем план (блокирующий вызов)
-        weekly_plan_json = generate_weekly_plan(exclusion_list) 
+        await report_progress("🤖 Составляю план на неделю...")
+        loop = asyncio.get_running_loop()
+        weekly_plan_json = await loop.run_in_executor(
+            None,
+            functools.partial(generate_weekly_plan, exclusion_list, use_cache=use_cache, profile=profile)
+        )
         
         if not weekly_plan_json:
             return None, "❌ Ошибка генерации: ИИ не смог создать план. Проверьте логи консоли."
 
-        # --- КОРРЕКТИРУЕМ ФОРМАТ JSON ОТ ИИ (УНИВЕРСАЛЬНАЯ ПРОВЕРКА) ---
-        if isinstance(weekly_plan_json, dict):
-            extracted_list = None
-            for key in ['plan', 'plans', 'weekly_plan', 'menu', 'recipes']:
-                if key in weekly_plan_json and isinstance(weekly_plan_json[key], list):
-                    extracted_list = weekly_plan_json[key]
-                    print(f"✅ Успешно извлечен список из словаря по стандартному ключу: '{key}'.")
-                    break
-            
-            if extracted_list is None:
-                for value in weekly_plan_json.values():
-                    if isinstance(value, list):
-                        extracted_list = value
-                        print("✅ Успешно извлечен список из словаря по универсальному поиску.")
-                        break
-
-            if extracted_list is not None:
-                weekly_plan_json = extracted_list
-            else:
-                print(f"❌ Ошибка формата: ИИ вернул словарь, но список дней не найден внутри.")
-                return None, "❌ Ошибка формата JSON: ИИ вернул неверный словарь. Проверьте консоль."
-        
-        if not isinstance(weekly_plan_json, list):
-            print(f"❌ ФИНАЛЬНАЯ ОШИБКА формата: Ожидался список, но получен тип {type(weekly_plan_json)}")
-            return None, "❌ ФИНАЛЬНАЯ ОШИБКА формата JSON: Ожидался список. Проверьте консоль."
+        # --- ПРОВЕРКА ПО СХЕМЕ И ТОЧЕЧНЫЙ РЕМОНТ ---
+        weekly_plan_json = extract_day_list(weekly_plan_json)
+        if weekly_plan_json is None:
+            print("❌ Ошибка формата: в ответе ИИ не найден список дней.")
+            return None, "❌ Ошибка формата JSON: ИИ вернул план без списка дней. Проверьте консоль."
+
+        await report_progress("🩹 Проверяю план и подбираю порции...")
+        with span("validate_repair"):
+            weekly_plan_json = await repair_weekly_plan(
+                weekly_plan_json, exclusion_list, use_cache=use_cache, profile=profile, expected_dates=get_plan_dates()
+            )
+        if not weekly_plan_json:
+            return None, "❌ Ошибка генерации: ни один день плана не прошел проверку. Проверьте логи консоли."
+
+        # --- ПОДБОР ПОРЦИЙ ПОД ЦЕЛИ КЖБУ ---
+        with span("portion_optimization"):
+            optimize_plan_portions(weekly_plan_json, profile)
             
         # --- СОХРАНЕНИЕ В БД И ФОРМАТИРОВАНИЕ ---
-        recipes_to_save = []
-        telegram_message = "✨ **Ваш план питания на 5 дней готов!** ✨\n\n"
-        
-        for day_plan in weekly_plan_json:
-            
-            if not isinstance(day_plan, dict):
-                 print(f"❌ Ошибка в структуре: Элемент '{day_plan}' в списке не является словарем.")
-                 continue 
-
-            try:
-                # 1. Форматирование заголовка дня
-                telegram_message += f"🗓️ **{day_plan['day']}** ({day_plan['date']}):\n"
-                meal_date_obj = datetime.datetime.strptime(day_plan['date'], "%Y-%m-%d").date()
-
-                for meal in day_plan['meals']:
-                    
-                    # --- ИЗВЛЕЧЕНИЕ С БЕЗОПАСНЫМИ ЗНАЧЕНИЯМИ ПО УМОЛЧАНИЮ (.get()) ---
-                    kzhbu_info = meal.get('total_kzhbu_for_two', 'КЖБУ: Расчет отсутствует ❌').strip()
-                    weight_m = meal.get('weight_m', 'N/A')
-                    weight_w = meal.get('weight_w', 'N/A')
-                    meal_type = meal.get('type', 'Прием пищи')
-                    meal_name = meal.get('meal_name', 'Неизвестное блюдо')
-                    recipe_full = meal.get('recipe_full', 'Нет полного рецепта')
-                    
-                    if not kzhbu_info or kzhbu_info == 'N/A':
-                        kzhbu_info = "КЖБУ: Расчет отсутствует ❌"
-                    
-                    # 2. Формируем подробный рецепт для сохранения в DB
-                    full_recipe_text = (
-                        f"**Суммарное КЖБУ (на двоих):** {kzhbu_info}\n\n"
-                        f"**--- РЕЦЕПТ ---**\n"
-                        f"{recipe_full}"
-                    )
-                    
-                    # 3. Формируем строку для Telegram-сообщения
-                    meal_line = (
-                        f"   - **{meal_type}:** {meal_name}\n"
-                        f"     (Суммарное КЖБУ: {kzhbu_info})\n" 
-                        f"     _Порции:_ (М: {weight_m}г, Ж: {weight_w}г)\n" 
-                    )
-                    telegram_message += meal_line
-                    # -------------------------------------------------------------------
-                    
-                    # 4. Сохраняем в список для БД
-                    recipes_to_save.append({
-                        'meal_date': meal_date_obj,
-                        'meal_name': meal_name,
-                        'recipe_full': full_recipe_text 
-                    })
-                
-                telegram_message += "\n"
-                
-            except KeyError as e:
-                print(f"❌ Критическая ошибка в ключах JSON: Отсутствует основной ключ {e} (day, date, meals) в элементе дня/блюда.")
-                continue 
-
-        # Сохранение (синхронный вызов)
-        save_recipes(recipes_to_save)
+        with span("format"):
+            telegram_message, recipes_to_save = build_weekly_message(weekly_plan_json)
+
+        # Сохранение (рецепты и план недели для воскресной рассылки)
+        await save_weekly_plan(chat_id, telegram_message, recipes_to_save)
         
         return telegram_message, None
 
@@ -140,185 +161,800 @@ def sync_generation_logic():
         return None, f"❌ КРИТИЧЕСКАЯ ОШИБКА: Произошел сбой при генерации или сохранении. См. консоль."
 
 
-async def generate_and_send_weekly(context: ContextTypes.DEFAULT_TYPE):
+async def library_generation_logic(chat_id: int, profile: dict, use_cache: bool = True):
     """
-    Асинхронный вызов, который запускает синхронную логику в отдельном потоке.
+    Генерация из библиотеки: план собирается из ранее сгенерированных блюд (без токенов),
+    ИИ точечно догенерирует только незакрытые блюда и дни. Если библиотека еще мала - обычная пакетная генерация.
     """
-    print("--- 🚀 АСИНХРОННЫЙ ВЫЗОВ: Запуск еженедельной генерации. ---")
+    from library_planner import assemble_library_plan, LIBRARY_MIN_COVERAGE
+    from portion_optimizer import optimize_plan_portions
 
-    loop = asyncio.get_running_loop() 
-    
-    telegram_message, error_message = await loop.run_in_executor(
-        None, 
-        sync_generation_logic
+    try:
+        exclusion_list, profile = await load_exclusions(chat_id, profile)
+
+        plan_dates = get_plan_dates()
+        await report_progress("📚 Собираю план из библиотеки блюд...")
+        with span("library_assembly"):
+            weekly_plan_json, coverage = await assemble_library_plan(chat_id, profile, exclusion_list, plan_dates)
+        if coverage < LIBRARY_MIN_COVERAGE:
+            print(f"📚 Библиотека закрывает {coverage:.0%} плана - генерируем неделю через ИИ.")
+            return await batch_generation_logic(chat_id, profile, use_cache)
+
+        with span("validate_repair"):
+            weekly_plan_json = await repair_weekly_plan(
+                weekly_plan_json, exclusion_list, use_cache=use_cache, profile=profile, expected_dates=plan_dates
+            )
+        if not weekly_plan_json:
+            return None, "❌ Ошибка генерации: не удалось собрать план из библиотеки. Проверьте логи консоли."
+
+        with span("portion_optimization"):
+            optimize_plan_portions(weekly_plan_json, profile)
+
+        with span("format"):
+            telegram_message, recipes_to_save = build_weekly_message(weekly_plan_json)
+        await save_weekly_plan(chat_id, telegram_message, recipes_to_save)
+        return telegram_message, None
+
+    except Exception:
+        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА СБОРКИ ПЛАНА ИЗ БИБЛИОТЕКИ:\n{traceback.format_exc()}")
+        return None, "❌ КРИТИЧЕСКАЯ ОШИБКА: Произошел сбой при генерации или сохранении. См. консоль."
+
+
+async def stream_generate_and_send(bot, chat_id: int, profile: dict, use_cache: bool = True):
+    """
+    Потоковая генерация: поток OpenAI читается в отдельном потоке (executor),
+    а каждый готовый день сразу сохраняется в БД и отправляется в Telegram.
+    Если поток оборвется, уже полученные дни останутся сохраненными.
+    """
+    from portion_optimizer import optimize_plan_portions
+
+    loop = asyncio.get_running_loop()
+    days_queue: asyncio.Queue = asyncio.Queue()
+    # Генерацию отменили (/cancel): поток OpenAI закрывается, не дочитывая ответ
+    stop_event = threading.Event()
+
+    exclusion_list, profile = await load_exclusions(chat_id, profile)
+    await report_progress("🤖 Составляю план, дни придут по мере готовности...")
+
+    def sync_stream_producer():
+        try:
+            for day_plan in stream_weekly_plan(exclusion_list, use_cache=use_cache, profile=profile):
+                if stop_event.is_set():
+                    break
+                loop.call_soon_threadsafe(days_queue.put_nowait, day_plan)
+        except Exception:
+            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА ПОТОКОВОЙ ГЕНЕРАЦИИ:\n{traceback.format_exc()}")
+        finally:
+            # None - сигнал окончания потока
+            loop.call_soon_threadsafe(days_queue.put_nowait, None)
+
+    producer = loop.run_in_executor(None, sync_stream_producer)
+    plan_dates = get_plan_dates()
+    sent_dates = set()
+    # Сообщения сохраненных дней: из них собирается план недели для воскресной рассылки
+    day_messages = {}
+
+    async def save_and_send(day_plan: dict):
+        with span("portion_optimization"):
+            optimize_plan_portions([day_plan], profile)
+        try:
+            day_message, day_recipes = format_day_plan(day_plan)
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"❌ Ошибка в структуре дня из потока: {e}. День пропущен.")
+            return
+
+        # Сначала сохраняем, чтобы сбой отправки не потерял готовый день
+        await save_plan_recipes(day_recipes, chat_id)
+        sent_dates.add(day_plan['date'])
+        day_messages[day_plan['date']] = day_message
+        await report_progress(f"📦 Готово дней: {len(sent_dates)} из {len(plan_dates)}.")
+
+        try:
+            with span("telegram_send"):
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=day_message,
+                    parse_mode='Markdown'
+                )
+        except Exception as e:
+            print(f"❌ Ошибка отправки дня в Telegram: {e}")
+
+    try:
+        while True:
+            day_plan = await days_queue.get()
+            if day_plan is None:
+                break
+
+            # Сломанные блюда дня чинятся точечно, до отправки
+            with span("validate_repair"):
+                repaired_days = await repair_weekly_plan([day_plan], exclusion_list, use_cache=use_cache, profile=profile)
+            for repaired_day in repaired_days:
+                if repaired_day['date'] not in sent_dates:
+                    await save_and_send(repaired_day)
+    except asyncio.CancelledError:
+        # Уже сохраненные дни остаются в истории, остаток потока не читается
+        stop_event.set()
+        await save_streamed_plan(chat_id, day_messages, complete=False)
+        raise
+
+    await producer
+
+    # Дни, которые поток не вернул (обрыв или непригодный JSON), догенерируются по одному
+    missing_dates = [d for d in plan_dates if d.strftime("%Y-%m-%d") not in sent_dates]
+    if sent_dates and missing_dates:
+        await report_progress(f"🩹 Догенерирую дней: {len(missing_dates)}...")
+        for repaired_day in await repair_weekly_plan([], exclusion_list, use_cache=use_cache, profile=profile, expected_dates=missing_dates):
+            await save_and_send(repaired_day)
+    days_sent = len(sent_dates)
+    await save_streamed_plan(
+        chat_id, day_messages, complete=all(d.strftime("%Y-%m-%d") in sent_dates for d in plan_dates)
     )
 
+    if days_sent:
+        final_text = f"✨ **Ваш план питания готов!** Дней в плане: {days_sent}. ✨"
+        parse_mode = 'Markdown'
+    else:
+        final_text = "❌ Ошибка генерации: ИИ не смог создать план. Проверьте логи консоли."
+        parse_mode = None
+
+    with span("telegram_send"):
+        await bot.send_message(
+            chat_id=chat_id,
+            text=final_text,
+            parse_mode=parse_mode
+        )
+
+
+async def parallel_generate_and_send(bot, chat_id: int, profile: dict, use_cache: bool = True):
+    """
+    Параллельная генерация: запросы по дням идут прямо в event loop через
+    асинхронный клиент OpenAI, без занятия потоков пула по умолчанию.
+    """
+    from portion_optimizer import optimize_plan_portions
+
+    telegram_message, error_message = None, None
+
+    try:
+        exclusion_list, profile = await load_exclusions(chat_id, profile)
+        await report_progress("🤖 Составляю план по дням...")
+        weekly_plan_json = await generate_weekly_plan_parallel(exclusion_list, use_cache=use_cache, profile=profile)
+
+        if not weekly_plan_json:
+            error_message = "❌ Ошибка генерации: ИИ не смог создать план. Проверьте логи консоли."
+        else:
+            with span("portion_optimization"):
+                optimize_plan_portions(weekly_plan_json, profile)
+            with span("format"):
+                telegram_message, recipes_to_save = build_weekly_message(weekly_plan_json)
+            await save_weekly_plan(chat_id, telegram_message, recipes_to_save)
+    except Exception:
+        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА ПАРАЛЛЕЛЬНОЙ ГЕНЕРАЦИИ:\n{traceback.format_exc()}")
+        error_message = "❌ КРИТИЧЕСКАЯ ОШИБКА: Произошел сбой при генерации или сохранении. См. консоль."
+
     final_text = telegram_message if telegram_message else error_message
     parse_mode = 'Markdown' if telegram_message else None
-    
-    if YOUR_CHAT_ID:
-        await context.bot.send_message(
-            chat_id=YOUR_CHAT_ID, 
-            text=final_text, 
+
+    with span("telegram_send"):
+        await bot.send_message(
+            chat_id=chat_id,
+            text=final_text,
             parse_mode=parse_mode
         )
-    print("--- Генерация завершена. ---")
 
 
-async def send_daily_reminder(context: ContextTypes.DEFAULT_TYPE):
+async def generate_and_send_weekly(bot, chat_id: int, use_cache: bool = True):
     """
-    Отправляет меню на текущий день и детали. Используется также командой /today.
+    Генерирует и отправляет недельный план для одного чата по его профилю.
+    use_cache=False заставляет заново обратиться к OpenAI, даже если ответ есть в кэше.
+    Вызывается воркерами очереди генерации (generation_queue).
     """
-    current_date = datetime.date.today() 
-    print(f"--- ⏰ Запрос меню на {current_date}. ---")
+    print(f"--- 🚀 АСИНХРОННЫЙ ВЫЗОВ: Запуск еженедельной генерации для чата {chat_id}. ---")
 
-    def sync_get_recipes():
-        session = Session()
-        try:
-            today_recipes = session.query(Recipe).filter(
-                Recipe.meal_date == current_date
-            ).all()
-            return today_recipes
-        finally:
-            session.close()
+    # Общее время генерации по режимам; фазы внутри замеряются отдельными span
+    with span("generation_total", mode=GENERATION_MODE):
+        profile = await get_profile(chat_id) or USER_KZHBU
 
-    loop = asyncio.get_running_loop()
-    today_recipes = await loop.run_in_executor(None, sync_get_recipes)
+        if GENERATION_MODE == "stream":
+            await stream_generate_and_send(bot, chat_id, profile, use_cache)
+            print("--- Генерация завершена. ---")
+            return
+
+        if GENERATION_MODE == "parallel":
+            await parallel_generate_and_send(bot, chat_id, profile, use_cache)
+            print("--- Генерация завершена. ---")
+            return
+
+        generation_logic = library_generation_logic if GENERATION_MODE == "library" else batch_generation_logic
+        telegram_message, error_message = await generation_logic(chat_id, profile, use_cache)
+
+        final_text = telegram_message if telegram_message else error_message
+        parse_mode = 'Markdown' if telegram_message else None
+        
+        with span("telegram_send"):
+            await bot.send_message(
+                chat_id=chat_id, 
+                text=final_text, 
+                parse_mode=parse_mode
+            )
+        print("--- Генерация завершена. ---")
+
+
+# Общая очередь генерации: воркеры запускаются в post_init приложения
+generation_queue = GenerationQueue(generate_and_send_weekly)
+# Рассылка по расписанию (лимиты Telegram, повторы, outbox): запускается в post_init.
+# Общий лимит Telegram - на бота, поэтому делится между воркерами
+delivery_engine = DeliveryEngine(global_rate=DELIVERY_GLOBAL_RATE / WEBHOOK_WORKERS)
+
+
+async def send_daily_reminder(bot, chat_id: int, notify_missing: bool = True):
+    """
+    Отправляет меню на текущий день и детали. Используется также командой /today.
+    notify_missing=False - не писать в чат, если меню на сегодня нет (для рассылки по расписанию).
+    """
+    current_date = datetime.date.today() 
+    print(f"--- ⏰ Запрос меню на {current_date} для чата {chat_id}. ---")
 
+    # Сообщение подготовлено при генерации: здесь только поиск в кэше и отправка
+    with span("reminder_lookup"):
+        chunks = await get_day_messages(chat_id, current_date)
 
-    if not today_recipes and YOUR_CHAT_ID:
-        await context.bot.send_message(
-            chat_id=YOUR_CHAT_ID,
+    if not chunks:
+        if not notify_missing:
+            return
+        await bot.send_message(
+            chat_id=chat_id,
             text=f"🤔 На сегодня ({current_date.strftime('%d.%m.%Y')}) меню не найдено. Воспользуйтесь /generate_test."
         )
         return
 
-    # 2. Форматирование сообщения 
-    reminder_message = f"🔔 **Ваше меню на сегодня, {current_date.strftime('%d.%m.%Y')}!** 🔔\n\n"
-    
-    for recipe in today_recipes:
-        reminder_message += f"🍽️ **{recipe.meal_name}**\n\n"
-        reminder_message += f"{recipe.recipe_full}\n\n---\n\n" 
-        
-    if YOUR_CHAT_ID:
-        await context.bot.send_message(
-            chat_id=YOUR_CHAT_ID,
-            text=reminder_message,
-            parse_mode='Markdown'
-        )
+    with span("reminder_send"):
+        for chunk in chunks:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=chunk,
+                parse_mode='Markdown'
+            )
     print(f"--- Ежедневное уведомление на {current_date} отправлено. ---")
 
 
-# --- 3. КОМАНДЫ TELEGRAM ---
+# --- 3. ЗАДАНИЯ ПО РАСПИСАНИЮ ---
+
+def chat_worker(chat_id: int) -> int:
+    """Воркер, который обслуживает чат: его обновления, генерации, задания по расписанию и рассылку."""
+    return chat_id % WEBHOOK_WORKERS
+
+
+def owns_chat(chat_id: int) -> bool:
+    return chat_worker(chat_id) == WORKER_INDEX
+
+
+async def scheduled_chat_ids() -> list[int]:
+    """Чаты, которым положена рассылка: все зарегистрированные и чат администратора (только чаты этого воркера)."""
+    chat_ids = await list_profile_chat_ids()
+    if YOUR_CHAT_ID and YOUR_CHAT_ID not in chat_ids:
+        chat_ids.append(YOUR_CHAT_ID)
+    return [chat_id for chat_id in chat_ids if owns_chat(chat_id)]
+
+
+async def speculative_generation_job(bot):
+    """
+    Заблаговременная генерация: план следующей недели составляется, проверяется и сохраняется
+    задолго до отправки (рецепты, сообщения /today и план в prepared_plans готовы сразу).
+    В воскресенье остается только отправить.
+    """
+    week_start = get_plan_dates()[0]
+    semaphore = asyncio.Semaphore(GENERATION_MAX_CONCURRENT)
+
+    async def prepare(chat_id: int):
+        if await get_prepared_plan(chat_id, week_start, include_delivered=True) is not None:
+            return
+        if generation_queue.find(chat_id, week_start) is not None:
+            # План этой недели уже генерируется по запросу чата - второй прогон не нужен
+            return
+        async with semaphore:
+            profile = await resolve_household(chat_id) or USER_KZHBU
+            generation_logic = library_generation_logic if GENERATION_MODE == "library" else batch_generation_logic
+            telegram_message, error_message = await generation_logic(chat_id, profile)
+        if telegram_message:
+            print(f"🔮 План на неделю с {week_start} для чата {chat_id} подготовлен заранее.")
+        else:
+            print(f"⚠️ Заблаговременная генерация для чата {chat_id} не удалась: {error_message}")
+
+    await asyncio.gather(*(prepare(chat_id) for chat_id in await scheduled_chat_ids()))
+
+
+async def weekly_delivery_job(bot):
+    """
+    Воскресная отправка: готовый план из prepared_plans (последний сохраненный план недели -
+    заблаговременный или сгенерированный позже по запросу); если его нет - обычная генерация через очередь.
+    """
+    week_start = get_plan_dates()[0]
+    for chat_id in await scheduled_chat_ids():
+        chunks = await get_prepared_plan(chat_id, week_start)
+        if chunks is None:
+            print(f"⚠️ Для чата {chat_id} нет заранее подготовленного плана: ставим генерацию в очередь.")
+            await generation_queue.submit(chat_id, week_start, bot=bot)
+            continue
+        # Сообщения уже в outbox рассылки - план считается отправленным
+        await delivery_engine.send(chat_id, chunks)
+        await mark_prepared_plan_delivered(chat_id, week_start)
+
+
+async def daily_reminder_job(bot):
+    """Утреннее напоминание в будни: заранее подготовленные сообщения дня уходят через рассылку."""
+    current_date = datetime.date.today()
+    queued = 0
+    for chat_id in await scheduled_chat_ids():
+        chunks = await get_day_messages(chat_id, current_date)
+        if chunks:
+            queued += await delivery_engine.send(chat_id, chunks)
+    print(f"--- ⏰ Напоминания на {current_date} поставлены в рассылку: сообщений {queued}. ---")
+
+
+async def history_compaction_job(bot):
+    """Еженедельное уплотнение БД: старая история уходит в сжатый архив, файл БД перестает расти."""
+    report = await compact_history()
+    # Из горячей таблицы ушли записи - библиотека блюд загружается заново
+    invalidate_library_cache()
+    print(f"--- 🗜️ Уплотнение истории завершено: {report}. ---")
+
+
+# Задания по чатам: каждый воркер выполняет их для своих чатов
+CHAT_SCHEDULED_JOBS = [
+    ScheduledJob("speculative_generation", speculative_generation_job, parse_time(SPECULATIVE_GENERATION_TIME), SATURDAY, catch_up=30),
+    ScheduledJob("weekly_delivery", weekly_delivery_job, parse_time(WEEKLY_DELIVERY_TIME), SUNDAY, catch_up=12),
+    ScheduledJob("daily_reminder", daily_reminder_job, parse_time(DAILY_REMINDER_TIME), WEEKDAYS, catch_up=4),
+]
+SCHEDULED_JOBS = CHAT_SCHEDULED_JOBS + [
+    ScheduledJob("history_compaction", history_compaction_job, parse_time(HISTORY_COMPACTION_TIME), SUNDAY, catch_up=5),
+]
+
+
+def worker_scheduled_jobs() -> list[ScheduledJob]:
+    """Расписание этого воркера. Время последнего запуска хранится по имени - у каждого воркера свое."""
+    if IS_PRIMARY_WORKER:
+        return SCHEDULED_JOBS
+    return [dataclasses.replace(job, name=f"{job.name}@{WORKER_INDEX}") for job in CHAT_SCHEDULED_JOBS]
+
+
+# --- 4. КОМАНДЫ TELEGRAM ---
+
+async def resolve_household(chat_id: int, register: bool = False) -> dict | None:
+    """
+    Возвращает профиль чата. Чат администратора получает профиль по умолчанию автоматически,
+    остальные чаты - только при register=True и включенной регистрации.
+    """
+    profile = await get_profile(chat_id)
+    if profile is not None:
+        return profile
+
+    if chat_id == YOUR_CHAT_ID or (register and ALLOW_REGISTRATION):
+        await save_profile(chat_id, USER_KZHBU)
+        print(f"🏠 Зарегистрирован новый чат {chat_id} с профилем по умолчанию.")
+        return await get_profile(chat_id)
+    return None
+
+
+def household_command(handler):
+    """Декоратор команд: пропускает только зарегистрированные чаты и передает их профиль."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        profile = await resolve_household(update.effective_chat.id)
+        if profile is None:
+            if ALLOW_REGISTRATION:
+                await update.message.reply_text("Этот чат не зарегистрирован. Отправьте /start, чтобы начать.")
+            else:
+                await update.message.reply_text("Эта команда доступна только администратору и только в его чате.")
+            return
+        await handler(update, context, profile)
+    return wrapper
+
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает команду /start."""
+    """Обрабатывает команду /start и регистрирует чат (если регистрация разрешена)."""
     user = update.effective_user
+    profile = await resolve_household(update.effective_chat.id, register=True)
+    status_line = (
+        f"ID этого чата: **{update.effective_chat.id}**. Чат зарегистрирован, профиль: /profile.\n"
+        if profile else
+        "Этот чат не зарегистрирован: бот работает только в чате администратора.\n"
+    )
     await update.message.reply_html(
         f"Привет, {user.mention_html()}! Я бот-планировщик рецептов.\n"
-        f"ID чата для уведомлений: **{YOUR_CHAT_ID}**.\n"
-        f"Доступные команды: /generate_test, /today, /clear_history."
+        f"{status_line}"
+        f"Доступные команды: /generate_test (или /generate_test fresh - без кэша), /cancel, /today, /find, /clear_history, /profile."
     )
 
-async def generate_test_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает команду /generate_test для немедленного запуска генерации."""
-    if not YOUR_CHAT_ID or str(update.effective_chat.id) != str(YOUR_CHAT_ID):
-        await update.message.reply_text("Эта команда доступна только администратору и только в его чате.")
-        return
 
-    await update.message.reply_text("🚀 Запускаю немедленную генерацию меню (это может занять до 20 секунд)...")
+# Поля профиля, которые можно менять через /profile (строки КЖБУ и распределение по приемам пищи)
+PROFILE_KZHBU_KEYS = ("me", "wife", "total_target_kzhbu")
+PROFILE_KEYS = PROFILE_KZHBU_KEYS + ("target_distribution_kzhbu",)
 
-    await generate_and_send_weekly(context)
-    
-    await update.message.reply_text("✅ Запрос на генерацию отправлен. Проверьте сообщения.")
+
+def apply_profile_changes(profile: dict, changes: dict) -> dict:
+    """
+    Новый профиль с изменениями из /profile. ValueError - если среди изменений есть неизвестные
+    поля или значения не того вида (тогда профиль не меняется ни в одном поле).
+    """
+    unknown = sorted(set(changes) - set(PROFILE_KEYS))
+    if unknown:
+        raise ValueError(f"неизвестные поля {', '.join(unknown)}; можно менять: {', '.join(PROFILE_KEYS)}")
+    for key in PROFILE_KZHBU_KEYS:
+        if key in changes and not (isinstance(changes[key], str) and parse_kzhbu(changes[key])['kcal']):
+            raise ValueError(f'{key}: нужна строка с калориями, например "2000 ккал, 150г белка, 60г жиров, 220г углеводов"')
+
+    updated = dict(profile)
+    updated.update({key: value for key, value in changes.items() if key != 'target_distribution_kzhbu'})
+    if 'target_distribution_kzhbu' in changes:
+        distribution = changes['target_distribution_kzhbu']
+        if not isinstance(distribution, dict) or set(distribution) - set(MEAL_TYPES):
+            raise ValueError(f"target_distribution_kzhbu: объект с приемами пищи {', '.join(MEAL_TYPES)}")
+        if not all(isinstance(value, str) and any(char.isdigit() for char in value) for value in distribution.values()):
+            raise ValueError('target_distribution_kzhbu: диапазоны строками, например "900-1100 ккал"')
+        # Можно поменять только часть приемов пищи - остальные остаются прежними
+        updated['target_distribution_kzhbu'] = {**profile.get('target_distribution_kzhbu', {}), **distribution}
+    return updated
+
+
+@household_command
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE, profile: dict) -> None:
+    """
+    Обрабатывает команду /profile: без аргументов показывает профиль чата,
+    с JSON-аргументом обновляет его (например: /profile {"me": "2000 ккал, 150г белка, 60г жиров, 220г углеводов"}).
+    """
+    if context.args:
+        try:
+            changes = json.loads(" ".join(context.args))
+            if not isinstance(changes, dict):
+                raise ValueError("ожидался JSON-объект")
+            profile = apply_profile_changes(profile, changes)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ Не удалось разобрать профиль: {e}")
+            return
+
+        await save_profile(update.effective_chat.id, profile)
+        await update.message.reply_text("✅ Профиль обновлен.")
+
+    await update.message.reply_text(
+        "🏠 Профиль чата:\n" + json.dumps(profile, ensure_ascii=False, indent=2)
+    )
 
 
-async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает команду /today для немедленной отправки меню на текущий день."""
-    if not YOUR_CHAT_ID or str(update.effective_chat.id) != str(YOUR_CHAT_ID):
-        await update.message.reply_text("Эта команда доступна только администратору и только в его чате.")
-        return
+@household_command
+async def generate_test_command(update: Update, context: ContextTypes.DEFAULT_TYPE, profile: dict) -> None:
+    """Обрабатывает команду /generate_test: ставит генерацию для этого чата в очередь."""
+    # "/generate_test fresh" - сгенерировать заново в обход кэша ответов OpenAI
+    use_cache = not (context.args and context.args[0].lower() in ("fresh", "nocache"))
+
+    chat_id = update.effective_chat.id
+    week_start = get_plan_dates()[0]
+    result = await generation_queue.submit(chat_id, week_start, bot=context.bot, use_cache=use_cache)
+    job = generation_queue.find(chat_id, week_start)
 
+    if result == QUEUED:
+        position = generation_queue.position(chat_id)
+        queue_note = f" Перед вами в очереди: {position}." if position else ""
+        status = await update.message.reply_text(
+            f"🚀 Генерация меню поставлена в очередь.{queue_note} Дни придут отдельными сообщениями, "
+            f"ход генерации - в этом сообщении. Отменить: /cancel"
+        )
+        if job is not None:
+            job.status_message_id = status.message_id
+            if job.task is not None:
+                # Задание успело начаться до ответа - показываем его текущий этап
+                await job.set_stage(job.stage, force=True)
+    elif result == ATTACHED:
+        stage = job.stage if job is not None else ""
+        await update.message.reply_text(
+            f"⏳ План на эту неделю уже готовится, повторный запрос присоединен к нему. {stage} Отменить: /cancel"
+        )
+    elif result == DUPLICATE:
+        await update.message.reply_text("⏳ Генерация для этого чата уже ожидает в очереди.")
+    else:
+        await update.message.reply_text("🚦 Очередь генерации переполнена. Попробуйте через несколько минут.")
+
+
+@household_command
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE, profile: dict) -> None:
+    """Обрабатывает команду /cancel: отменяет ожидающую или выполняемую генерацию этого чата."""
+    cancelled = await generation_queue.cancel(update.effective_chat.id)
+    if cancelled:
+        await update.message.reply_text("🛑 Генерация отменена. Уже отправленные дни сохранены в истории.")
+    else:
+        await update.message.reply_text("🤷 Для этого чата сейчас ничего не генерируется.")
+
+
+@household_command
+async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE, profile: dict) -> None:
+    """Обрабатывает команду /today для немедленной отправки меню на текущий день."""
     await update.message.reply_text("🔎 Ищу и отправляю меню на сегодня...")
-    await send_daily_reminder(context)
+    await send_daily_reminder(context.bot, update.effective_chat.id)
     
     
-def sync_clear_history_logic():
-    """Синхронная логика для очистки таблицы Recipe."""
-    session = Session()
+@household_command
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE, profile: dict) -> None:
+    """
+    Обрабатывает команду /find <запрос>: полнотекстовый поиск по истории рецептов чата
+    (например, /find лосось или /find суп с фрикадельками). Лучшее совпадение отправляется целиком.
+    Если запрос - ингредиент ('семга', 'курица'), добавляются рецепты с ним из индекса ингредиентов.
+    """
+    from nutrition import normalize_ingredient
+
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.message.reply_text("🔎 Укажите, что искать: например, /find лосось")
+        return
+
+    with span("recipe_search"):
+        recipes = await search_recipes(
+            update.effective_chat.id, query, limit=FIND_RESULTS_LIMIT, ingredient=normalize_ingredient(query)
+        )
+    if not recipes:
+        await update.message.reply_text(f"🔎 В истории ничего не найдено по запросу «{query}».")
+        return
+
+    found_lines = [
+        f"{idx}. {recipe.meal_name} ({recipe.meal_type or 'блюдо'}, {recipe.meal_date.strftime('%d.%m.%Y')})"
+        for idx, recipe in enumerate(recipes, 1)
+    ]
+    best = recipes[0]
+    blocks = [
+        f"🔎 Найдено по запросу «{query}»:\n" + "\n".join(found_lines),
+        f"🍽️ **{best.meal_name}**\n{render_recipe_markdown(best)}",
+    ]
+    for chunk in split_message(blocks):
+        await update.message.reply_text(chunk, parse_mode='Markdown')
+
+
+async def clear_history_logic(chat_id: int):
+    """Логика очистки истории рецептов одного чата."""
     try:
-        num_deleted = session.query(Recipe).delete()
-        session.commit()
+        num_deleted = await clear_history(chat_id)
+        invalidate_day_messages(chat_id)
+        invalidate_library_cache(chat_id)
         return f"✅ Успешно удалено {num_deleted} записей из истории рецептов. История исключений сброшена!"
     except Exception as e:
-        session.rollback()
         return f"❌ Ошибка при очистке базы данных: {e}"
-    finally:
-        session.close()
-
 
-async def clear_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает команду /clear_history для очистки базы данных рецептов."""
-    if not YOUR_CHAT_ID or str(update.effective_chat.id) != str(YOUR_CHAT_ID):
-        await update.message.reply_text("Эта команда доступна только администратору и только в его чате.")
-        return
 
+@household_command
+async def clear_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE, profile: dict) -> None:
+    """Обрабатывает команду /clear_history для очистки истории рецептов этого чата."""
     await update.message.reply_text("🗑️ Запускаю очистку истории рецептов (может занять несколько секунд)...")
     
-    loop = asyncio.get_running_loop()
-    result_message = await loop.run_in_executor(
-        None, 
-        sync_clear_history_logic
-    )
+    result_message = await clear_history_logic(update.effective_chat.id)
     
     await update.message.reply_text(result_message)
 
 
-# --- 4. ОСНОВНАЯ СИНХРОННАЯ ФУНКЦИЯ ЗАПУСКА ---
+def _format_seconds(value: float | None) -> str:
+    if value is None:
+        return "-"
+    if value == float("inf"):
+        return ">120с"
+    return f"{value * 1000:.0f}мс" if value < 1 else f"{value:.1f}с"
 
-def main() -> None:
-    """Инициализирует БД, запускает планировщик и бота."""
-    
-    if not TELEGRAM_TOKEN or not YOUR_CHAT_ID:
-        print("❌ КРИТИЧЕСКАЯ ОШИБКА: Токен Telegram или ID чата не найден/некорректен.")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает команду /stats (только чат администратора): сводка метрик процесса."""
+    if update.effective_chat.id != YOUR_CHAT_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
         return
 
-    init_db() 
-    
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    
-    # --- БЛОК ПЛАНИРОВЩИКА (ЗАКОММЕНТИРОВАН ДЛЯ РУЧНОГО ТЕСТИРОВАНИЯ) ---
-    # scheduler = BackgroundScheduler()
-    # 
-    # # Генерация: Воскресенье, 10:00
-    # scheduler.add_job(
-    #     generate_and_send_weekly, 
-    #     trigger=CronTrigger(day_of_week='sun', hour='10', minute='0'),
-    #     id='weekly_generation',
-    #     name='Weekly Recipe Generation',
-    #     args=[application] 
-    # )
-    # 
-    # # Напоминание: Будни, 07:00
-    # scheduler.add_job(
-    #     send_daily_reminder, 
-    #     trigger=CronTrigger(day_of_week='mon-fri', hour='7', minute='0'),
-    #     id='daily_reminder',
-    #     name='Daily Meal Reminder',
-    #     args=[application] 
-    # )
-    # 
-    # scheduler.start()
-    # print("Планировщик запущен. Задания установлены.")
-    # ----------------------------------------------------------------------
+    metrics = metrics_summary()
+    lines = ["📊 Статистика бота (с момента запуска)", "", "Фазы (p50 / p95, число замеров):"]
+    for phase, values in sorted(metrics["phases"].items()):
+        lines.append(f"  {phase}: {_format_seconds(values['p50'])} / {_format_seconds(values['p95'])} ({values['count']})")
+
+    slow_queries = sorted(metrics["queries"].items(), key=lambda item: item[1]["p95"] or 0, reverse=True)[:5]
+    if slow_queries:
+        lines += ["", "Самые медленные SQL (p95):"]
+        for query, values in slow_queries:
+            lines.append(f"  {query}: {_format_seconds(values['p95'])} ({values['count']})")
+
+    lines += ["", "OpenAI:"]
+    for model, requests in sorted(metrics["requests"].items()):
+        tokens = metrics["tokens"].get(model, {})
+        lines.append(
+            f"  {model}: запросов {requests}, токенов {tokens.get('prompt', 0)} + {tokens.get('completion', 0)}, "
+            f"${metrics['cost_usd'].get(model, 0):.4f}"
+        )
+
+    router_stats = ROUTER.stats()
+    if router_stats:
+        lines += ["", "Каскад моделей (скользящее окно):"]
+        for kind, models in sorted(router_stats.items()):
+            for model, values in models.items():
+                lines.append(
+                    f"  {kind} / {model}: вызовов {values['calls']}, {_format_seconds(values['latency_s'])}, "
+                    f"отказов {values['failure_rate']:.0%}, ~{values['tokens']} токенов"
+                )
+
+    loop = asyncio.get_running_loop()
+    cache_stats = await loop.run_in_executor(None, get_cache_stats)
+    lines += [
+        "",
+        f"Кэш ответов: {cache_stats}",
+        f"Ремонт планов: {REPAIR_STATS}",
+        f"Очередь генерации: {generation_queue.stats()}",
+    ]
+    lines.append(f"Рассылка: {delivery_engine.stats()}")
+
+    await update.message.reply_text("\n".join(lines))
+
+
+async def compact_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обрабатывает команду /compact (только чат администратора): уплотнение БД прямо сейчас.
+    /compact 90 - архивировать записи старше 90 дней (по умолчанию HISTORY_ARCHIVE_DAYS).
+    """
+    if update.effective_chat.id != YOUR_CHAT_ID:
+        await update.message.reply_text("Эта команда доступна только администратору.")
+        return
+    try:
+        archive_days = int(context.args[0]) if context.args else HISTORY_ARCHIVE_DAYS
+    except ValueError:
+        await update.message.reply_text("❌ Укажите число дней: например, /compact 180")
+        return
+    await update.message.reply_text("🗜️ Уплотняю БД, это может занять несколько минут...")
+    try:
+        report = await compact_history(archive_days)
+    except Exception as e:
+        print(f"❌ Ошибка уплотнения БД:\n{traceback.format_exc()}")
+        await update.message.reply_text(f"❌ Ошибка уплотнения БД: {e}")
+        return
+    invalidate_library_cache()
+    await update.message.reply_text(
+        f"✅ Уплотнение завершено (архив - записи старше {report['archive_days']} дней).\n"
+        f"Текстов перенесено в общую таблицу: {report['moved_bodies']}\n"
+        f"Записей перенесено в архив: {report['archived_rows']}\n"
+        f"Удалено неиспользуемых текстов: {report['deleted_bodies']}\n"
+        f"Размер БД: {report['bytes_before'] / 1024 / 1024:.1f} → {report['bytes_after'] / 1024 / 1024:.1f} МБ "
+        f"(освобождено {report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ)"
+    )
+
+
+_forward_client = None
+
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Самый первый обработчик (несколько воркеров вебхука): обновление чата, который обслуживает
+    другой воркер, пересылается ему как есть и здесь дальше не обрабатывается.
+    Отметку о повторах (deduplicate_update) ставит уже воркер-владелец.
+    """
+    global _forward_client
+    chat = update.effective_chat
+    if chat is None or owns_chat(chat.id):
+        return
+    import httpx
+
+    if _forward_client is None:
+        _forward_client = httpx.AsyncClient(timeout=10)
+    worker = chat_worker(chat.id)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    try:
+        response = await _forward_client.post(
+            f"http://{WEBHOOK_FORWARD_HOST}:{WEBHOOK_PORT + worker}/{WEBHOOK_PATH}",
+            json=update.to_dict(), headers=headers
+        )
+        response.raise_for_status()
+    except Exception as e:
+        print(f"❌ Не удалось переслать обновление {update.update_id} воркеру {worker}: {e}")
+    raise ApplicationHandlerStop
+
+
+async def deduplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Первый обработчик каждого обновления: повторно доставленный update_id
+    (повтор вебхука или обработка другим воркером) дальше не обрабатывается.
+    """
+    if not await register_update(update.update_id):
+        print(f"🔁 Обновление {update.update_id} уже обработано, пропускаем.")
+        raise ApplicationHandlerStop
+
+
+async def purge_processed_updates_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    removed = await purge_processed_updates()
+    if removed:
+        print(f"🧹 Удалено старых отметок обновлений: {removed}.")
+
+
+# --- 5. ОСНОВНАЯ СИНХРОННАЯ ФУНКЦИЯ ЗАПУСКА ---
+
+# Боту нужны только сообщения с командами - остальные типы обновлений Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+
+def register_handlers(application: Application) -> None:
+    """Подключает обработчики команд (и защиту от повторных обновлений) к приложению."""
+    if WEBHOOK_WORKERS > 1:
+        application.add_handler(TypeHandler(Update, route_update), group=-2)
+    application.add_handler(TypeHandler(Update, deduplicate_update), group=-1)
 
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("generate_test", generate_test_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
     application.add_handler(CommandHandler("today", today_command))
+    application.add_handler(CommandHandler("find", find_command))
     application.add_handler(CommandHandler("clear_history", clear_history_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("compact", compact_command))
+
+
+def main() -> None:
+    """Инициализирует БД, запускает расписание и бота."""
     
+    if not TELEGRAM_TOKEN or not (YOUR_CHAT_ID or ALLOW_REGISTRATION):
+        print("❌ КРИТИЧЕСКАЯ ОШИБКА: Токен Telegram или ID чата не найден/некорректен.")
+        return
+
+    if not 0 <= WORKER_INDEX < WEBHOOK_WORKERS:
+        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: WORKER_INDEX={WORKER_INDEX} при WEBHOOK_WORKERS={WEBHOOK_WORKERS}.")
+        return
+
+    # БД и очередь инициализируются внутри event loop бота: пул соединений привязан к нему
+    # Рассылка и задания по чатам - в каждом воркере, но только для его чатов (owns_chat),
+    # иначе outbox и задания выполнятся несколько раз
+    async def post_init(application: Application) -> None:
+        await init_db(default_chat_id=YOUR_CHAT_ID)
+        await generation_queue.start()
+        await delivery_engine.start(application.bot, chat_filter=owns_chat)
+        # Каждый воркер отдает свои метрики на своем порту (METRICS_PORT + WORKER_INDEX)
+        if METRICS_PORT:
+            application.bot_data["metrics_server"] = await start_metrics_server(METRICS_PORT + WORKER_INDEX)
+
+    async def post_shutdown(application: Application) -> None:
+        metrics_server = application.bot_data.get("metrics_server")
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        if _forward_client is not None:
+            await _forward_client.aclose()
+        await delivery_engine.stop()
+        await generation_queue.stop()
+        await dispose_db()
+
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    if TELEGRAM_BASE_URL:
+        # Локальный (тестовый) сервер Bot API вместо api.telegram.org
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    # concurrent_updates: /today обрабатывается сразу, даже пока другие команды ждут БД или очередь
+    application = (
+        builder
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Расписание работает в event loop бота (JobQueue); пропущенные запуски догоняются после старта
+    schedule_jobs(application, worker_scheduled_jobs())
+    if IS_PRIMARY_WORKER and application.job_queue is not None:
+        application.job_queue.run_repeating(purge_processed_updates_job, interval=3600, first=60)
+
+    register_handlers(application)
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            print("❌ КРИТИЧЕСКАЯ ОШИБКА: для BOT_MODE=webhook нужен WEBHOOK_URL.")
+            return
+        port = WEBHOOK_PORT + WORKER_INDEX
+        print(f"Бот запущен в режиме вебхука (воркер {WORKER_INDEX} из {WEBHOOK_WORKERS}, порт {port})...")
+        # Все воркеры регистрируют один и тот же публичный адрес - повторный setWebhook безвреден
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=port,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        return
+
     print("Бот запущен и прослушивает команды...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+import os
+import re
+import time
+import asyncio
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+# --- НАСТРОЙКИ МЕТРИК ---
+# Порт HTTP-эндпоинта /metrics в формате Prometheus (0 - не запускать)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Цена за 1M токенов (вход, выход), USD
+MODEL_PRICES_PER_1M = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+# Метрики пишутся из event loop и из потоков executor (синхронный клиент OpenAI)
+_lock = threading.Lock()
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (как histogram в Prometheus)."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Оценка квантиля по корзинам (верхняя граница корзины, в которую попал квантиль)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return self.buckets[idx] if idx < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+# (имя метрики, метки) -> Histogram; (имя метрики, метки) -> значение счетчика
+_histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+_counters: Dict[Tuple[str, Tuple], float] = {}
+
+_HELP = {
+    "phase_duration_seconds": "Длительность фаз генерации и отправки",
+    "db_query_duration_seconds": "Длительность SQL-запросов",
+    "llm_tokens_total": "Токены OpenAI по моделям и видам",
+    "llm_cost_usd_total": "Оценка стоимости запросов OpenAI, USD",
+    "llm_requests_total": "Запросы к OpenAI",
+    "llm_retries_total": "Повторы запросов OpenAI после временных ошибок",
+    "llm_hedged_requests_total": "Запасные (хедж) запросы OpenAI после превышения p95",
+    "llm_hedge_wins_total": "Хедж-запросы, ответившие раньше основного",
+    "llm_hedge_wasted_total": "Проигравшие хедж-гонку запросы (отменены или выброшены)",
+}
+
+
+def _labels_key(labels: dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def observe(name: str, value: float, **labels):
+    with _lock:
+        key = (name, _labels_key(labels))
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def increment(name: str, amount: float = 1, **labels):
+    with _lock:
+        key = (name, _labels_key(labels))
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def span(phase: str, **labels):
+    """Замер длительности фазы: with span("openai_request"): ... (работает и в async-коде)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("phase_duration_seconds", time.perf_counter() - started, phase=phase, **labels)
+
+
+# --- ТОКЕНЫ И СТОИМОСТЬ ---
+
+def record_usage(model: str, usage) -> None:
+    """Учитывает usage из ответа chat.completions (объект SDK или None для ответов без usage)."""
+    increment("llm_requests_total", model=model)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    increment("llm_tokens_total", prompt_tokens, model=model, kind="prompt")
+    increment("llm_tokens_total", completion_tokens, model=model, kind="completion")
+
+    input_price, output_price = MODEL_PRICES_PER_1M.get(model, (0.0, 0.0))
+    cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    increment("llm_cost_usd_total", cost, model=model)
+
+
+# --- ВРЕМЯ SQL-ЗАПРОСОВ ---
+
+_STATEMENT_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+\"?(\w+)", re.IGNORECASE)
+
+
+def instrument_engine(sync_engine, database: str):
+    """Подписывается на события движка SQLAlchemy и пишет длительность каждого запроса."""
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started_stack = conn.info.get("_query_started")
+        if not started_stack:
+            return
+        elapsed = time.perf_counter() - started_stack.pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        match = _STATEMENT_TABLE_RE.search(statement)
+        observe(
+            "db_query_duration_seconds", elapsed,
+            database=database, operation=operation, table=match.group(1) if match else "-"
+        )
+
+
+# --- ВЫВОД ---
+
+def _format_labels(labels: Tuple, extra: dict | None = None) -> str:
+    items = list(labels) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+
+def render_prometheus() -> str:
+    """Все метрики процесса в текстовом формате Prometheus."""
+    with _lock:
+        histograms = {key: (list(h.counts), h.total, h.count, h.buckets) for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+    for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, {'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> dict:
+    """Короткая сводка для /stats: p50/p95 фаз и SQL по операциям, токены и стоимость по моделям."""
+    with _lock:
+        phases = {}
+        queries = {}
+        for (name, labels), histogram in _histograms.items():
+            label_dict = dict(labels)
+            if name == "phase_duration_seconds":
+                extra = ",".join(f"{k}={v}" for k, v in labels if k != "phase")
+                target, key = phases, label_dict.get("phase", "?") + (f"[{extra}]" if extra else "")
+            elif name == "db_query_duration_seconds":
+                target, key = queries, f"{label_dict.get('operation')} {label_dict.get('table')}"
+            else:
+                continue
+            target[key] = {"count": histogram.count, "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95)}
+
+        tokens, cost, requests = {}, {}, {}
+        for (name, labels), value in _counters.items():
+            label_dict = dict(labels)
+            model = label_dict.get("model", "?")
+            if name == "llm_tokens_total":
+                tokens.setdefault(model, {})[label_dict.get("kind")] = int(value)
+            elif name == "llm_cost_usd_total":
+                cost[model] = value
+            elif name == "llm_requests_total":
+                requests[model] = int(value)
+    return {"phases": phases, "queries": queries, "tokens": tokens, "cost_usd": cost, "requests": requests}
+
+
+# --- HTTP-ЭНДПОИНТ ---
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны - дочитываем до пустой строки
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else "/"
+        if path.startswith("/metrics"):
+            body, status = render_prometheus().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """Запускает эндпоинт /metrics в текущем event loop. Возвращает сервер или None, если порт не задан."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle_metrics_request, host, port)
+    print(f"📈 Метрики Prometheus: http://{host}:{port}/metrics")
+    return server
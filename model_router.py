@@ -0,0 +1,321 @@
+import os
+import time
+import datetime
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Tuple
+
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, func
+
+from db_manager import parse_kzhbu
+from llm_cache import CacheBase, CacheSession, run_cache_io
+from metrics import increment, MODEL_PRICES_PER_1M
+
+# --- НАСТРОЙКИ КАСКАДА МОДЕЛЕЙ ---
+# Модели от самой дешевой и быстрой к самой сильной. Запрос идет в первую модель маршрута
+# и переходит к следующей, только если ответ не прошел проверку
+MODEL_CASCADE = [m.strip() for m in os.getenv("MODEL_CASCADE", "gpt-4o-mini,gpt-4o").split(",") if m.strip()]
+# Скользящее окно статистики: последние N вызовов модели для каждого вида запроса
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+# Пока замеров меньше, модель из маршрута не исключается
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "10"))
+# Каждый N-й запрос идет с начала каскада, даже если дешевая модель сейчас пропускается:
+# без этого ее статистика не обновится и она не вернется в маршрут
+ROUTER_PROBE_EVERY = int(os.getenv("ROUTER_PROBE_EVERY", "20"))
+# Сколько строк истории вызовов хранить в таблице (на все модели и виды)
+ROUTER_KEEP_ROWS = 5000
+
+# Проверка КЖБУ: допустимое отклонение дневной суммы от цели (доля) по калориям и по белку
+DAILY_KCAL_TOLERANCE = float(os.getenv("ROUTER_KCAL_TOLERANCE", "0.15"))
+DAILY_PROTEIN_TOLERANCE = float(os.getenv("ROUTER_PROTEIN_TOLERANCE", "0.25"))
+# Сколько дней недели может выйти за допуск, не отправляя неделю сильной модели
+MAX_OFF_TARGET_DAYS = int(os.getenv("ROUTER_MAX_OFF_TARGET_DAYS", "1"))
+# Насколько блюдо может выйти за диапазон калорийности своего приема пищи (доля от границы)
+MEAL_RANGE_SLACK = 0.25
+# Столько сломанных блюд дешевле починить точечным ремонтом, чем переходить к сильной модели
+REPAIRABLE_MEALS = 4
+
+
+# --- 1. ИСТОРИЯ ВЫЗОВОВ (ТАБЛИЦА 'model_calls' В ФАЙЛЕ КЭША LLM) ---
+class ModelCall(CacheBase):
+    """Один вызов модели в каскаде: задержка, итог проверки и токены."""
+    __tablename__ = 'model_calls'
+
+    id = Column(Integer, primary_key=True)
+    model = Column(String, nullable=False)
+    # Вид запроса: week, week_stream, day, meal
+    kind = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    latency_seconds = Column(Float, nullable=False)
+    ok = Column(Boolean, nullable=False)
+    # Причина отказа: error (сеть/API), json, validation; None для принятого ответа
+    reason = Column(String)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+
+
+# --- 2. МАРШРУТИЗАЦИЯ ---
+
+class ModelRouter:
+    """
+    Выбирает, с какой модели каскада начинать запрос данного вида, по скользящей статистике:
+    ожидаемая задержка попытки модели i - E(i) = L(i) + f(i) * E(i+1), где L - средняя задержка,
+    f - доля отказов (ответ не прошел проверку или ошибка); ожидаемая стоимость по токенам -
+    так же, C(i) = c(i) + f(i) * C(i+1), где c - средняя стоимость вызова. Модель пропускается, если
+    с ней ожидаемое время дольше или ожидаемая стоимость выше, чем если сразу начать со следующей
+    (например, дешевая модель так часто промахивается, что вместе с повтором выходит дороже сильной).
+    """
+
+    def __init__(self, cascade: List[str]):
+        self.cascade = cascade
+        self._lock = threading.Lock()
+        # (модель, вид) -> deque[(задержка, ok, токены)]
+        self._samples: Dict[Tuple[str, str], deque] = {}
+        self._loaded_kinds = set()
+        self._decisions: Dict[str, int] = {}
+        self._inserts = 0
+
+    def _load(self, kind: str):
+        """Подгружает окно статистики вида запроса из БД (один раз за процесс)."""
+        if kind in self._loaded_kinds:
+            return
+        self._loaded_kinds.add(kind)
+        session = CacheSession()
+        try:
+            for model in self.cascade:
+                rows = (
+                    session.query(ModelCall.latency_seconds, ModelCall.ok, ModelCall.prompt_tokens, ModelCall.completion_tokens)
+                    .filter(ModelCall.model == model, ModelCall.kind == kind)
+                    .order_by(ModelCall.id.desc())
+                    .limit(ROUTER_WINDOW)
+                    .all()
+                )
+                window = self._samples.setdefault((model, kind), deque(maxlen=ROUTER_WINDOW))
+                for latency, ok, prompt_tokens, completion_tokens in reversed(rows):
+                    window.append((latency, ok, prompt_tokens, completion_tokens))
+        except Exception as e:
+            print(f"❌ Ошибка чтения статистики моделей: {e}")
+        finally:
+            session.close()
+
+    def _model_stats(self, model: str, kind: str) -> Dict[str, Any] | None:
+        window = self._samples.get((model, kind))
+        if not window:
+            return None
+        count = len(window)
+        prompt_tokens = sum(sample[2] for sample in window) / count
+        completion_tokens = sum(sample[3] for sample in window) / count
+        input_price, output_price = MODEL_PRICES_PER_1M.get(model, (0.0, 0.0))
+        return {
+            "calls": count,
+            "latency_s": sum(sample[0] for sample in window) / count,
+            "failure_rate": sum(1 for sample in window if not sample[1]) / count,
+            "tokens": round(prompt_tokens + completion_tokens),
+            "cost_usd": (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000,
+        }
+
+    def route(self, kind: str) -> List[str]:
+        """Модели в порядке попыток для запроса вида kind."""
+        with self._lock:
+            self._load(kind)
+            decision = self._decisions[kind] = self._decisions.get(kind, 0) + 1
+            if ROUTER_PROBE_EVERY and decision % ROUTER_PROBE_EVERY == 0:
+                return list(self.cascade)
+
+            # Ожидаемые задержка и стоимость каскада, начиная с каждой модели (с конца к началу);
+            # None - у модели мало замеров, сравнивать не с чем
+            expected: List[Tuple[float, float] | None] = [None] * (len(self.cascade) + 1)
+            for idx in range(len(self.cascade) - 1, -1, -1):
+                stats = self._model_stats(self.cascade[idx], kind)
+                if stats is None or stats["calls"] < ROUTER_MIN_SAMPLES:
+                    continue
+                next_latency, next_cost = expected[idx + 1] or (0.0, 0.0)
+                expected[idx] = (
+                    stats["latency_s"] + stats["failure_rate"] * next_latency,
+                    stats["cost_usd"] + stats["failure_rate"] * next_cost,
+                )
+
+            start = 0
+            while start < len(self.cascade) - 1 and expected[start] is not None and expected[start + 1] is not None \
+                    and (expected[start][0] > expected[start + 1][0] or expected[start][1] > expected[start + 1][1]):
+                start += 1
+        if start:
+            increment("llm_router_skips_total", model=self.cascade[0], kind=kind)
+        return self.cascade[start:]
+
+    def record(self, model: str, kind: str, latency: float, ok: bool, reason: str | None = None, usage=None):
+        """Записывает итог вызова в окно статистики и в БД."""
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        with self._lock:
+            self._samples.setdefault((model, kind), deque(maxlen=ROUTER_WINDOW)).append(
+                (latency, ok, prompt_tokens, completion_tokens)
+            )
+            self._inserts += 1
+            prune = self._inserts % 100 == 0
+        increment("llm_router_calls_total", model=model, kind=kind, outcome="ok" if ok else reason or "fail")
+
+        session = CacheSession()
+        try:
+            session.add(ModelCall(
+                model=model, kind=kind, latency_seconds=latency, ok=ok, reason=reason,
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+            ))
+            session.flush()
+            if prune:
+                max_id = session.query(func.max(ModelCall.id)).scalar() or 0
+                session.query(ModelCall).filter(ModelCall.id <= max_id - ROUTER_KEEP_ROWS).delete(synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"❌ Ошибка записи статистики моделей: {e}")
+        finally:
+            session.close()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Статистика окна по видам запросов и моделям (для /stats и бенчмарка)."""
+        with self._lock:
+            keys = sorted(self._samples)
+            result = {}
+            for model, kind in keys:
+                stats = self._model_stats(model, kind)
+                if stats is not None:
+                    result.setdefault(kind, {})[model] = {
+                        key: round(value, 6) if isinstance(value, float) else value for key, value in stats.items()
+                    }
+        return result
+
+
+ROUTER = ModelRouter(MODEL_CASCADE)
+
+
+# --- 3. ЗАПУСК КАСКАДА ---
+
+def _check(model: str, kind: str, started: float, content: str, usage, parse: Callable[[str], Any],
+           check: Callable[[Any], List[str]]) -> Tuple[Any, bool]:
+    """Разбор и проверка ответа одной модели с записью итога в статистику. Возвращает (данные, принят ли)."""
+    latency = time.perf_counter() - started
+    try:
+        data = parse(content)
+    except ValueError as e:
+        ROUTER.record(model, kind, latency, False, "json", usage)
+        print(f"⚠️ {model} ({kind}): ответ не разобран ({e}), переходим к следующей модели.")
+        return None, False
+    problems = check(data)
+    if problems:
+        ROUTER.record(model, kind, latency, False, "validation", usage)
+        print(f"⚠️ {model} ({kind}): ответ не прошел проверку: {'; '.join(problems[:3])}")
+        return data, False
+    ROUTER.record(model, kind, latency, True, None, usage)
+    return data, True
+
+
+def run_cascade(kind: str, request: Callable[[str], Tuple[str, Any]], parse: Callable[[str], Any],
+                check: Callable[[Any], List[str]]) -> Tuple[str, str, Any, bool] | None:
+    """
+    Синхронный каскад: request(model) -> (текст ответа, usage). Возвращает (модель, текст, данные, принят ли).
+    Если проверку не прошел ни один ответ, возвращается последний разобранный - его чинит точечный ремонт;
+    None - если разобрать не удалось ни один.
+    """
+    fallback = None
+    last_error = None
+    for model in ROUTER.route(kind):
+        started = time.perf_counter()
+        try:
+            content, usage = request(model)
+        except Exception as e:
+            ROUTER.record(model, kind, time.perf_counter() - started, False, "error")
+            print(f"⚠️ {model} ({kind}): ошибка запроса: {e}")
+            last_error = e
+            continue
+        data, accepted = _check(model, kind, started, content, usage, parse, check)
+        if accepted:
+            return model, content, data, True
+        if data is not None:
+            fallback = (model, content, data, False)
+        increment("llm_router_escalations_total", model=model, kind=kind)
+    if fallback is None:
+        print(f"❌ Ни одна модель каскада не дала разборчивого ответа ({kind}). Последняя ошибка: {last_error}")
+    return fallback
+
+
+async def arun_cascade(kind: str, request, parse: Callable[[str], Any],
+                       check: Callable[[Any], List[str]]) -> Tuple[str, str, Any, bool] | None:
+    """
+    Асинхронный run_cascade: request(model) - корутина, возвращающая (текст ответа, usage).
+    Маршрут и запись статистики обращаются к SQLite, поэтому выполняются через run_cache_io.
+    """
+    fallback = None
+    last_error = None
+    for model in await run_cache_io(ROUTER.route, kind):
+        started = time.perf_counter()
+        try:
+            content, usage = await request(model)
+        except Exception as e:
+            await run_cache_io(ROUTER.record, model, kind, time.perf_counter() - started, False, "error")
+            print(f"⚠️ {model} ({kind}): ошибка запроса: {e}")
+            last_error = e
+            continue
+        data, accepted = await run_cache_io(_check, model, kind, started, content, usage, parse, check)
+        if accepted:
+            return model, content, data, True
+        if data is not None:
+            fallback = (model, content, data, False)
+        increment("llm_router_escalations_total", model=model, kind=kind)
+    if fallback is None:
+        print(f"❌ Ни одна модель каскада не дала разборчивого ответа ({kind}). Последняя ошибка: {last_error}")
+    return fallback
+
+
+# --- 4. ПРОВЕРКА КЖБУ ---
+
+def _meal_kcal_protein(meal: Any) -> Tuple[float | None, float | None]:
+    if not isinstance(meal, dict):
+        return None, None
+    kzhbu = parse_kzhbu(str(meal.get('total_kzhbu_for_two', '')))
+    return kzhbu['kcal'], kzhbu['protein']
+
+
+def day_macro_problems(day_plan: Dict[str, Any], profile: Dict[str, Any]) -> List[str]:
+    """Отклонения дневной суммы блюд (на двоих) от total_target_kzhbu профиля сверх допуска."""
+    target = parse_kzhbu(str(profile.get('total_target_kzhbu', '')))
+    if not target['kcal']:
+        return []
+    kcal, protein = 0.0, 0.0
+    for meal in day_plan.get('meals', []):
+        meal_kcal, meal_protein = _meal_kcal_protein(meal)
+        if meal_kcal is None:
+            # Блюдо без КЖБУ - забота проверки схемы и ремонта, а не каскада
+            return []
+        kcal += meal_kcal
+        protein += meal_protein or 0.0
+
+    problems = []
+    date_label = day_plan.get('date', '?')
+    if abs(kcal - target['kcal']) > DAILY_KCAL_TOLERANCE * target['kcal']:
+        problems.append(f"{date_label}: {kcal:.0f} ккал при цели {target['kcal']:.0f}")
+    if target['protein'] and abs(protein - target['protein']) > DAILY_PROTEIN_TOLERANCE * target['protein']:
+        problems.append(f"{date_label}: белок {protein:.0f}г при цели {target['protein']:.0f}г")
+    return problems
+
+
+def plan_macro_problems(plan: List[Dict[str, Any]], profile: Dict[str, Any]) -> List[str]:
+    """Дни недели вне допуска по КЖБУ; пусто, если таких дней не больше MAX_OFF_TARGET_DAYS."""
+    off_target = [day_macro_problems(day_plan, profile) for day_plan in plan if isinstance(day_plan, dict)]
+    off_target = [problems for problems in off_target if problems]
+    if len(off_target) <= MAX_OFF_TARGET_DAYS:
+        return []
+    return [problem for problems in off_target for problem in problems]
+
+
+def meal_macro_problems(meal: Dict[str, Any], meal_type: str, profile: Dict[str, Any]) -> List[str]:
+    """Калорийность блюда вне диапазона своего приема пищи из target_distribution_kzhbu (с запасом)."""
+    from library_planner import parse_kcal_range
+    kcal_range = parse_kcal_range(profile.get('target_distribution_kzhbu', {}).get(meal_type))
+    kcal, _ = _meal_kcal_protein(meal)
+    if kcal_range is None or kcal is None:
+        return []
+    low, high = kcal_range
+    if kcal < low * (1 - MEAL_RANGE_SLACK) or kcal > high * (1 + MEAL_RANGE_SLACK):
+        return [f"{meal_type}: {kcal:.0f} ккал при диапазоне {low:.0f}-{high:.0f}"]
+    return []
@@ -0,0 +1,344 @@
+import re
+import asyncio
+from functools import lru_cache
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+
+from db_manager import parse_kzhbu
+
+# --- 1. ТАБЛИЦА ПИЩЕВОЙ ЦЕННОСТИ ---
+# (ключ, варианты написания, ккал, белки, жиры, углеводы на 100 г, вес 1 шт. в граммах или None)
+# Значения для сырых продуктов, округлены по справочникам (USDA / Скурихин).
+NUTRIENT_TABLE = [
+    ("куриное филе", ["куриное филе", "филе курицы", "филе куриное", "куриная грудка", "грудка куриная", "курица", "куриц"], 113, 23.6, 1.9, 0.4, None),
+    ("куриное бедро", ["куриное бедро", "бедро куриное", "бедра куриные", "куриные бедра"], 185, 16.8, 12.9, 0.0, 120),
+    ("индейка", ["индейка", "филе индейки", "индейки"], 114, 24.0, 1.5, 0.0, None),
+    ("говядина", ["говядина", "говядины", "говяжий фарш", "фарш говяжий"], 187, 18.9, 12.4, 0.0, None),
+    ("свинина", ["свинина", "свинины", "свиная вырезка"], 242, 16.0, 21.6, 0.0, None),
+    ("фарш", ["фарш"], 254, 17.2, 20.0, 0.0, None),
+    ("лосось", ["лосось", "лосося", "семга", "семги", "форель", "форели"], 208, 20.4, 13.4, 0.0, None),
+    ("треска", ["треска", "трески", "минтай", "минтая", "хек", "хека", "белая рыба"], 78, 17.8, 0.7, 0.0, None),
+    ("тунец", ["тунец", "тунца"], 116, 25.5, 1.0, 0.0, None),
+    ("креветки", ["креветки", "креветок", "креветка"], 99, 20.9, 1.7, 0.2, None),
+    ("яйцо", ["яйцо", "яйца", "яиц", "яйцо куриное"], 155, 12.6, 10.6, 1.1, 55),
+    ("яичный белок", ["яичный белок", "яичных белка", "белки яиц"], 52, 10.9, 0.2, 0.7, 33),
+    ("творог 5%", ["творог"], 121, 17.2, 5.0, 1.8, None),
+    ("сыр твердый", ["сыр", "пармезан", "чеддер", "моцарелла"], 356, 24.0, 28.0, 1.5, None),
+    ("сыр фета", ["фета", "брынза"], 264, 14.2, 21.3, 4.1, None),
+    ("молоко", ["молоко", "молока"], 52, 2.9, 2.5, 4.7, None),
+    ("кефир", ["кефир", "кефира"], 51, 3.0, 2.5, 4.0, None),
+    ("йогурт греческий", ["греческий йогурт", "йогурт"], 97, 9.0, 5.0, 3.9, None),
+    ("сметана", ["сметана", "сметаны"], 206, 2.8, 20.0, 3.2, None),
+    ("сливки", ["сливки", "сливок"], 206, 2.5, 20.0, 3.4, None),
+    ("сливочное масло", ["сливочное масло", "масло сливочное"], 748, 0.5, 82.5, 0.8, None),
+    ("оливковое масло", ["оливковое масло", "масло оливковое", "растительное масло", "масло растительное", "подсолнечное масло", "масла", "масло"], 884, 0.0, 100.0, 0.0, None),
+    ("овсяные хлопья", ["овсяные хлопья", "овсянка", "овсяной", "овсяных хлопьев", "геркулес"], 366, 11.9, 7.2, 69.3, None),
+    ("гречка", ["гречка", "гречки", "гречневая крупа", "гречневой"], 313, 12.6, 3.3, 62.1, None),
+    ("рис", ["рис", "риса", "рисовая"], 344, 6.7, 0.7, 78.9, None),
+    ("булгур", ["булгур", "булгура"], 342, 12.3, 1.3, 57.6, None),
+    ("киноа", ["киноа"], 368, 14.1, 6.1, 57.2, None),
+    ("макароны", ["макароны", "макарон", "паста", "пасты", "спагетти", "пенне"], 344, 10.4, 1.1, 69.7, None),
+    ("мука", ["мука", "муки"], 334, 10.3, 1.1, 70.0, None),
+    ("хлеб цельнозерновой", ["хлеб", "хлеба", "тост", "тосты", "тостов"], 247, 13.0, 3.4, 41.0, 30),
+    ("лаваш", ["лаваш", "лаваша", "тортилья", "тортильи"], 277, 9.1, 1.1, 56.0, 60),
+    ("картофель", ["картофель", "картофеля", "картошка", "картошки"], 77, 2.0, 0.1, 17.0, 120),
+    ("батат", ["батат", "батата"], 86, 1.6, 0.1, 20.1, 150),
+    ("фасоль", ["фасоль", "фасоли"], 102, 6.7, 0.3, 17.4, None),
+    ("нут", ["нут", "нута"], 164, 8.9, 2.6, 27.4, None),
+    ("чечевица", ["чечевица", "чечевицы"], 116, 9.0, 0.4, 20.1, None),
+    ("тофу", ["тофу"], 76, 8.1, 4.8, 1.9, None),
+    ("брокколи", ["брокколи"], 34, 2.8, 0.4, 6.6, None),
+    ("цветная капуста", ["цветная капуста", "цветной капусты"], 25, 1.9, 0.3, 5.0, None),
+    ("капуста", ["капуста", "капусты"], 27, 1.8, 0.1, 4.7, None),
+    ("шпинат", ["шпинат", "шпината"], 23, 2.9, 0.4, 3.6, None),
+    ("помидор", ["помидор", "помидоры", "помидоров", "томат", "томаты", "томатов", "черри"], 18, 0.9, 0.2, 3.9, 100),
+    ("огурец", ["огурец", "огурцы", "огурца", "огурцов"], 15, 0.7, 0.1, 3.6, 100),
+    ("перец болгарский", ["болгарский перец", "перец болгарский", "сладкий перец"], 27, 1.0, 0.3, 6.0, 150),
+    ("морковь", ["морковь", "моркови", "морковка"], 41, 0.9, 0.2, 9.6, 80),
+    ("лук", ["лук", "лука", "луковица", "луковицы"], 40, 1.1, 0.1, 9.3, 80),
+    ("чеснок", ["чеснок", "чеснока", "зубчик", "зубчика", "зубчиков"], 149, 6.4, 0.5, 33.1, 5),
+    ("кабачок", ["кабачок", "кабачка", "кабачки", "цукини"], 17, 1.2, 0.3, 3.1, 250),
+    ("баклажан", ["баклажан", "баклажана"], 25, 1.0, 0.2, 5.9, 250),
+    ("грибы", ["грибы", "грибов", "шампиньоны", "шампиньонов"], 22, 3.1, 0.3, 3.3, None),
+    ("стручковая фасоль", ["стручковая фасоль", "стручковой фасоли"], 31, 1.8, 0.2, 7.0, None),
+    ("горошек", ["горошек", "горошка", "зеленый горошек"], 81, 5.4, 0.4, 14.5, None),
+    ("кукуруза", ["кукуруза", "кукурузы"], 86, 3.3, 1.4, 18.7, None),
+    ("салат", ["салат", "салата", "листья салата", "руккола", "рукколы"], 15, 1.4, 0.2, 2.9, None),
+    ("авокадо", ["авокадо"], 160, 2.0, 14.7, 8.5, 150),
+    ("банан", ["банан", "банана", "бананы"], 89, 1.1, 0.3, 22.8, 120),
+    ("яблоко", ["яблоко", "яблока", "яблоки"], 52, 0.3, 0.2, 13.8, 150),
+    ("ягоды", ["ягоды", "ягод", "черника", "черники", "малина", "малины", "клубника", "клубники"], 50, 0.9, 0.4, 11.0, None),
+    ("апельсин", ["апельсин", "апельсина"], 47, 0.9, 0.1, 11.8, 180),
+    ("лимон", ["лимон", "лимона", "лимонный сок"], 29, 1.1, 0.3, 9.3, 100),
+    ("орехи", ["орехи", "орехов", "грецкие орехи", "миндаль", "миндаля", "кешью"], 607, 18.0, 54.0, 16.0, None),
+    ("арахисовая паста", ["арахисовая паста", "арахисовой пасты", "арахисовое масло"], 588, 25.0, 50.0, 20.0, None),
+    ("семена", ["семена чиа", "чиа", "семена льна", "кунжут", "кунжута"], 520, 18.0, 40.0, 30.0, None),
+    ("мед", ["мед", "меда"], 304, 0.3, 0.0, 82.4, None),
+    ("сахар", ["сахар", "сахара"], 387, 0.0, 0.0, 100.0, None),
+    ("соевый соус", ["соевый соус", "соевого соуса"], 53, 8.1, 0.6, 4.9, None),
+    ("томатная паста", ["томатная паста", "томатной пасты"], 82, 4.3, 0.5, 18.9, None),
+    ("хумус", ["хумус", "хумуса"], 166, 7.9, 9.6, 14.3, None),
+    ("протеин", ["протеин", "протеина", "сывороточный протеин"], 380, 75.0, 6.0, 8.0, None),
+]
+
+NUTRIENT_KEYS = [row[0] for row in NUTRIENT_TABLE]
+# Матрица (ингредиенты x 4): ккал, белки, жиры, углеводы на 1 грамм
+NUTRIENT_MATRIX = np.array([row[2:6] for row in NUTRIENT_TABLE], dtype=np.float64) / 100.0
+PIECE_WEIGHTS = [row[6] for row in NUTRIENT_TABLE]
+
+# --- 2. РАЗБОР СТРОК ИНГРЕДИЕНТОВ ---
+
+_STEM_LENGTH = 5
+_WORD_RE = re.compile(r"[a-zа-я]+")
+
+# Единицы измерения -> граммы (жидкости считаем с плотностью ~1 г/мл)
+_UNIT_GRAMS = [
+    (re.compile(r"^кг"), 1000.0),
+    (re.compile(r"^(г|гр|грамм\w*)$"), 1.0),
+    (re.compile(r"^мл"), 1.0),
+    (re.compile(r"^(л|литр\w*)$"), 1000.0),
+    (re.compile(r"^(ст\.?\s*л\.?|столов\w*\s*лож\w*)"), 15.0),
+    (re.compile(r"^(ч\.?\s*л\.?|чайн\w*\s*лож\w*)"), 5.0),
+    (re.compile(r"^стакан"), 200.0),
+    (re.compile(r"^щепот"), 1.0),
+]
+_PIECE_UNIT_RE = re.compile(r"^(шт\.?|штук\w*|зубч\w*|ломт\w*|кусоч\w*)$")
+
+_QUANTITY_RE = re.compile(
+    r"(?P<qty>\d+(?:[.,]\d+)?)(?:\s*[-–]\s*(?P<qty_to>\d+(?:[.,]\d+)?))?\s*"
+    r"(?P<unit>кг|грамм\w*|гр\b|г\b|мл|литр\w*|л\b|ст\.?\s*л\.?|ч\.?\s*л\.?|столов\w*\s*лож\w*|чайн\w*\s*лож\w*|"
+    r"стакан\w*|щепот\w*|шт\.?|штук\w*|зубч\w*|ломт\w*|кусоч\w*)?",
+    re.IGNORECASE
+)
+
+_INGREDIENTS_HEADER_RE = re.compile(r"ингредиент", re.IGNORECASE)
+_STEPS_HEADER_RE = re.compile(r"(приготовлени|шаг|способ)", re.IGNORECASE)
+# Специи и подача без количества не учитываются в доле распознанных строк
+_NEGLIGIBLE_RE = re.compile(r"(по вкусу|для подачи|щепотк|специи|соль)", re.IGNORECASE)
+
+
+def _stems(text: str) -> Tuple[str, ...]:
+    return tuple(word[:_STEM_LENGTH] for word in _WORD_RE.findall(text.lower().replace("ё", "е")))
+
+
+# Индекс вариантов написания: основы слов -> индекс ингредиента (длинные варианты проверяются первыми)
+_ALIAS_INDEX = sorted(
+    ((_stems(alias), idx) for idx, row in enumerate(NUTRIENT_TABLE) for alias in row[1]),
+    key=lambda item: -len(item[0])
+)
+
+
+def resolve_ingredient(name: str) -> int | None:
+    """Индекс ингредиента в NUTRIENT_TABLE по названию или None, если не распознан."""
+    stems = _stems(name)
+    if not stems:
+        return None
+    stem_set = set(stems)
+    for alias_stems, idx in _ALIAS_INDEX:
+        if all(stem in stem_set for stem in alias_stems):
+            return idx
+    return None
+
+
+@lru_cache(maxsize=4096)
+def parse_ingredient_line(line: str) -> Tuple[int | None, float | None]:
+    """
+    Разбирает строку вида '- Куриное филе — 300 г' или '2 яйца'.
+    Возвращает (индекс ингредиента, вес в граммах); None там, где разобрать не удалось.
+    """
+    match = _QUANTITY_RE.search(line)
+    ingredient_idx = resolve_ingredient(_QUANTITY_RE.sub(" ", line) if match else line)
+    if match is None or ingredient_idx is None:
+        return ingredient_idx, None
+
+    quantity = float(match.group("qty").replace(",", "."))
+    if match.group("qty_to"):
+        quantity = (quantity + float(match.group("qty_to").replace(",", "."))) / 2
+    unit = (match.group("unit") or "").lower().strip()
+
+    if not unit or _PIECE_UNIT_RE.match(unit):
+        piece_weight = PIECE_WEIGHTS[ingredient_idx]
+        return ingredient_idx, quantity * piece_weight if piece_weight else None
+    for unit_re, grams in _UNIT_GRAMS:
+        if unit_re.match(unit):
+            return ingredient_idx, quantity * grams
+    return ingredient_idx, None
+
+
+def extract_ingredient_lines(recipe_text: str) -> List[str]:
+    """Строки раздела ингредиентов; без заголовка - все строки, где есть количество с единицей."""
+    lines = [line.strip() for line in recipe_text.splitlines() if line.strip()]
+    start = next((i for i, line in enumerate(lines) if _INGREDIENTS_HEADER_RE.search(line)), None)
+    if start is not None:
+        section = []
+        for line in lines[start + 1:]:
+            if _STEPS_HEADER_RE.search(line) and len(line) < 40:
+                break
+            section.append(line)
+        if section:
+            return section
+        # Ингредиенты в одной строке после заголовка: "Ингредиенты: филе 300 г, рис 150 г"
+        header_tail = lines[start].split(":", 1)[-1]
+        return [part.strip() for part in header_tail.split(",") if part.strip()]
+    return [line for line in lines if _QUANTITY_RE.search(line) and _QUANTITY_RE.search(line).group("unit")]
+
+
+def recipe_ingredient_keys(recipe_text: str) -> List[str]:
+    """Распознанные ингредиенты рецепта (ключи NUTRIENT_TABLE, без повторов) - для индекса ингредиентов."""
+    keys = []
+    for line in extract_ingredient_lines(recipe_text or ""):
+        ingredient_idx, _ = parse_ingredient_line(line)
+        if ingredient_idx is not None and NUTRIENT_KEYS[ingredient_idx] not in keys:
+            keys.append(NUTRIENT_KEYS[ingredient_idx])
+    return keys
+
+
+def normalize_ingredient(name: str) -> str | None:
+    """Ингредиент, написанный пользователем ('курица', 'семга'), в ключ индекса ('куриное филе', 'лосось')."""
+    ingredient_idx = resolve_ingredient(name)
+    return NUTRIENT_KEYS[ingredient_idx] if ingredient_idx is not None else None
+
+
+# --- 3. ВЕКТОРНЫЙ РАСЧЕТ КЖБУ ---
+
+def compute_kzhbu(recipe_texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Считает КЖБУ для набора рецептов за один проход NumPy.
+    Возвращает (матрица n x 4: ккал, белки, жиры, углеводы; доля распознанных строк для каждого рецепта).
+    """
+    meal_indices, ingredient_indices, grams = [], [], []
+    total_lines = np.zeros(len(recipe_texts))
+
+    for meal_idx, recipe_text in enumerate(recipe_texts):
+        for line in extract_ingredient_lines(recipe_text or ""):
+            if _NEGLIGIBLE_RE.search(line):
+                continue
+            total_lines[meal_idx] += 1
+            ingredient_idx, weight = parse_ingredient_line(line)
+            if ingredient_idx is not None and weight is not None:
+                meal_indices.append(meal_idx)
+                ingredient_indices.append(ingredient_idx)
+                grams.append(weight)
+
+    totals = np.zeros((len(recipe_texts), 4))
+    resolved = np.zeros(len(recipe_texts))
+    if meal_indices:
+        meal_idx_arr = np.asarray(meal_indices)
+        contributions = NUTRIENT_MATRIX[np.asarray(ingredient_indices)] * np.asarray(grams)[:, None]
+        np.add.at(totals, meal_idx_arr, contributions)
+        resolved = np.bincount(meal_idx_arr, minlength=len(recipe_texts)).astype(np.float64)
+
+    coverage = np.divide(resolved, total_lines, out=np.zeros_like(resolved), where=total_lines > 0)
+    return totals, coverage
+
+
+# Ниже этой доли распознанных ингредиентов расчет считается ненадежным
+MIN_COVERAGE = 0.7
+# Расхождение заявленной и рассчитанной калорийности, выше которого блюдо помечается
+MAX_KCAL_DEVIATION = 0.2
+
+
+def annotate_plan(weekly_plan: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Добавляет к каждому блюду плана 'computed_kzhbu' (расчет по ингредиентам) и 'kzhbu_coverage'.
+    Возвращает список расхождений: блюда, где заявленные моделью ккал сильно отличаются от расчета.
+    """
+    meals = [meal for day_plan in weekly_plan for meal in day_plan.get('meals', []) if isinstance(meal, dict)]
+    if not meals:
+        return []
+
+    totals, coverage = compute_kzhbu([str(meal.get('recipe_full', '')) for meal in meals])
+    issues = []
+    for meal, row, meal_coverage in zip(meals, totals, coverage):
+        computed = {
+            'kcal': round(float(row[0])), 'protein': round(float(row[1]), 1),
+            'fat': round(float(row[2]), 1), 'carbs': round(float(row[3]), 1),
+        }
+        meal['computed_kzhbu'] = computed
+        meal['kzhbu_coverage'] = round(float(meal_coverage), 2)
+
+        if meal_coverage < MIN_COVERAGE or not computed['kcal']:
+            continue
+        claimed_kcal = parse_kzhbu(str(meal.get('total_kzhbu_for_two', '')))['kcal']
+        if claimed_kcal is None:
+            continue
+        deviation = abs(claimed_kcal - computed['kcal']) / computed['kcal']
+        if deviation > MAX_KCAL_DEVIATION:
+            meal['kzhbu_deviation'] = round(deviation, 2)
+            issues.append({
+                'meal_name': meal.get('meal_name'),
+                'claimed_kcal': claimed_kcal,
+                'computed_kcal': computed['kcal'],
+                'deviation': round(deviation, 2),
+            })
+
+    if issues:
+        print(f"⚠️ Расчет по ингредиентам: у {len(issues)} блюд заявленные ккал расходятся больше чем на {int(MAX_KCAL_DEVIATION * 100)}%.")
+    return issues
+
+
+# --- 4. ПАКЕТНЫЙ ПЕРЕСЧЕТ ИСТОРИИ ---
+
+async def rescore_history(chat_id: int | None = None, batch_size: int = 5000) -> Dict[str, Any]:
+    """
+    Пересчитывает КЖБУ всех рецептов истории по ингредиентам (порциями по batch_size).
+    Возвращает сводку: сколько рецептов, сколько с надежным расчетом, среднее расхождение с сохраненными ккал.
+    """
+    from sqlalchemy import select
+    from db_manager import Session, Recipe
+
+    summary = {'recipes': 0, 'reliable': 0, 'mean_kcal_deviation': None}
+    deviations = []
+    last_id = 0
+
+    async with Session() as session:
+        while True:
+            query = select(Recipe.id, Recipe.kcal, Recipe.recipe_full).where(Recipe.id > last_id)
+            if chat_id is not None:
+                query = query.where(Recipe.chat_id == chat_id)
+            rows = (await session.execute(query.order_by(Recipe.id).limit(batch_size))).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            totals, coverage = compute_kzhbu([row[2] for row in rows])
+            stored_kcal = np.array([row[1] if row[1] is not None else np.nan for row in rows], dtype=np.float64)
+            reliable = (coverage >= MIN_COVERAGE) & (totals[:, 0] > 0)
+            valid = reliable & ~np.isnan(stored_kcal)
+            deviations.append(np.abs(stored_kcal[valid] - totals[valid, 0]) / totals[valid, 0])
+
+            summary['recipes'] += len(rows)
+            summary['reliable'] += int(reliable.sum())
+
+    if deviations:
+        all_deviations = np.concatenate(deviations)
+        if all_deviations.size:
+            summary['mean_kcal_deviation'] = round(float(all_deviations.mean()), 3)
+    return summary
+
+
+# Тестовый запуск: пересчет всей истории из recipes.db
+if __name__ == '__main__':
+    import time
+
+    sample = """Ингредиенты:
+- Куриное филе — 300 г
+- Рис — 150 г
+- Оливковое масло — 1 ст. л.
+- Яйца — 2 шт
+Приготовление:
+1. Отварить рис."""
+    started = time.perf_counter()
+    totals, coverage = compute_kzhbu([sample] * 20)
+    print(f"Неделя (20 блюд): {(time.perf_counter() - started) * 1000:.2f} мс. Первое блюдо: {totals[0].round(1)}, покрытие {coverage[0]:.0%}")
+
+    async def _rescore_all():
+        from db_manager import init_db, dispose_db
+        await init_db()
+        started = time.perf_counter()
+        summary = await rescore_history()
+        print(f"Пересчет истории: {summary} за {time.perf_counter() - started:.2f} с")
+        await dispose_db()
+
+    asyncio.run(_rescore_all())
@@ -0,0 +1,341 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Deque, Tuple
+
+from metrics import increment, record_usage
+
+# --- ТРАНСПОРТ OpenAI: ПУЛ СОЕДИНЕНИЙ, ТАЙМАУТЫ, ПОВТОРЫ И ХЕДЖИРОВАНИЕ ---
+
+# Таймауты, в секундах: установка соединения и весь ответ целиком
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", "180"))
+# Пул keep-alive соединений, общий для всех запросов процесса
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+
+# Повторы при временных ошибках: экспоненциальная задержка с полным джиттером
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "1"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "20"))
+# HTTP-статусы, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+# Хеджирование: если ответ дольше наблюдаемого p95, отправляется второй такой же запрос,
+# берется тот, что пришел первым. Лишний запрос бывает примерно в 5% случаев.
+OPENAI_HEDGING = os.getenv("OPENAI_HEDGING", "1") == "1"
+HEDGE_QUANTILE = float(os.getenv("OPENAI_HEDGE_QUANTILE", "0.95"))
+# До этого числа замеров p95 неизвестен и хеджирование не включается
+HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+# Нижняя граница задержки хеджа: быстрые ответы не дублируем
+HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "1"))
+# Сколько последних замеров хранится для оценки p95 (по каждой паре модель/вид запроса)
+LATENCY_WINDOW = 200
+# Потоки для запасных (хедж) синхронных запросов. Основные запросы идут в своем пуле:
+# иначе при многих одновременных генерациях хедж ждал бы в очереди за теми, с кем должен соревноваться
+OPENAI_HEDGE_THREADS = int(os.getenv("OPENAI_HEDGE_THREADS", "8"))
+
+_pool_lock = threading.Lock()
+_http_client = None
+_async_http_client = None
+# Пулы потоков синхронного хеджирования создаются при первом хедже (см. _executors)
+_primary_executor = None
+_hedge_executor = None
+
+
+def _timeout():
+    import httpx
+    return httpx.Timeout(OPENAI_REQUEST_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+
+
+def _limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+    )
+
+
+def get_http_client():
+    """Общий синхронный httpx-клиент с пулом keep-alive соединений."""
+    global _http_client
+    with _pool_lock:
+        if _http_client is None:
+            from openai import DefaultHttpxClient
+            _http_client = DefaultHttpxClient(timeout=_timeout(), limits=_limits())
+        return _http_client
+
+
+def get_async_http_client():
+    """Общий асинхронный httpx-клиент с пулом keep-alive соединений."""
+    global _async_http_client
+    with _pool_lock:
+        if _async_http_client is None:
+            from openai import DefaultAsyncHttpxClient
+            _async_http_client = DefaultAsyncHttpxClient(timeout=_timeout(), limits=_limits())
+        return _async_http_client
+
+
+def _executors():
+    """
+    (пул основных, пул запасных) потоков синхронного хеджирования. Основных одновременно
+    не больше, чем соединений в пуле httpx (OPENAI_MAX_CONNECTIONS); запасные - в отдельном пуле.
+    """
+    global _primary_executor, _hedge_executor
+    with _pool_lock:
+        if _primary_executor is None:
+            _primary_executor = ThreadPoolExecutor(max_workers=OPENAI_MAX_CONNECTIONS, thread_name_prefix="openai-primary")
+            _hedge_executor = ThreadPoolExecutor(max_workers=OPENAI_HEDGE_THREADS, thread_name_prefix="openai-hedge")
+        return _primary_executor, _hedge_executor
+
+
+def create_clients(api_key: str):
+    """
+    Клиенты OpenAI поверх общих пулов соединений. Встроенные повторы SDK выключены:
+    повторяет запросы complete/acomplete, чтобы задержки и счетчики были в одном месте.
+    """
+    from openai import OpenAI, AsyncOpenAI
+    client = OpenAI(api_key=api_key, http_client=get_http_client(), timeout=_timeout(), max_retries=0)
+    async_client = AsyncOpenAI(api_key=api_key, http_client=get_async_http_client(), timeout=_timeout(), max_retries=0)
+    return client, async_client
+
+
+# --- ОШИБКИ И ЗАДЕРЖКИ ---
+
+def is_transient(exc: BaseException) -> bool:
+    """Временная ошибка (таймаут, обрыв соединения, 429, 5xx) - запрос можно повторить."""
+    import openai
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUSES
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """Задержка перед повтором номер attempt (с нуля): случайная в [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def _retry_after(exc: BaseException) -> float | None:
+    """Задержка из заголовка Retry-After ответа 429/503, если сервер ее прислал."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _next_delay(exc: BaseException, attempt: int, kind: str) -> float | None:
+    """Задержка перед следующим повтором или None, если повторять не нужно."""
+    if attempt >= OPENAI_MAX_RETRIES or not is_transient(exc):
+        return None
+    delay = backoff_delay(attempt)
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, OPENAI_RETRY_MAX_DELAY))
+    increment("llm_retries_total", kind=kind, error=type(exc).__name__)
+    print(f"🔁 OpenAI ({kind}): {type(exc).__name__}, повтор {attempt + 1}/{OPENAI_MAX_RETRIES} через {delay:.1f} с.")
+    return delay
+
+
+# --- НАБЛЮДАЕМЫЕ ЗАДЕРЖКИ ---
+
+class LatencyTracker:
+    """
+    Скользящее окно задержек успешных запросов по модели и виду (неделя, день, блюдо):
+    один и тот же вид запроса идет и в дешевую, и в сильную модель каскада, у них разный p95.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._window = window
+        self._samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, kind: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get((model, kind))
+            if samples is None:
+                samples = self._samples[(model, kind)] = deque(maxlen=self._window)
+            samples.append(seconds)
+
+    def quantile(self, model: str, kind: str, q: float) -> float | None:
+        with self._lock:
+            samples = sorted(self._samples.get((model, kind), ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self, model: str, kind: str) -> float | None:
+        """Через сколько секунд отправлять запасной запрос (None - не хеджировать)."""
+        if not OPENAI_HEDGING:
+            return None
+        p95 = self.quantile(model, kind, HEDGE_QUANTILE)
+        if p95 is None:
+            return None
+        return max(p95, HEDGE_MIN_DELAY)
+
+
+LATENCY = LatencyTracker()
+
+
+def _record_loser(kind: str, model: str, future):
+    """Проигравший хедж-запрос тоже стоит денег - его токены учитываются в стоимости."""
+    increment("llm_hedge_wasted_total", kind=kind)
+    if future.exception() is None:
+        record_usage(model, getattr(future.result(), "usage", None))
+
+
+# --- СИНХРОННЫЕ ЗАПРОСЫ ---
+
+def _hedged_call(create: Callable[..., Any], kind: str, params: Dict[str, Any], hedge: bool):
+    model = params.get("model", "?")
+    delay = LATENCY.hedge_delay(model, kind) if hedge else None
+    if delay is None:
+        started = time.perf_counter()
+        response = create(**params)
+        LATENCY.observe(model, kind, time.perf_counter() - started)
+        return response
+
+    primary_executor, hedge_executor = _executors()
+    started = time.perf_counter()
+    primary = primary_executor.submit(create, **params)
+    try:
+        response = primary.result(timeout=delay)
+        LATENCY.observe(model, kind, time.perf_counter() - started)
+        return response
+    except FutureTimeoutError:
+        pass
+
+    increment("llm_hedged_requests_total", kind=kind)
+    hedge_started = time.perf_counter()
+    hedge = hedge_executor.submit(create, **params)
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                first_error = first_error or future.exception()
+                continue
+            if future is hedge:
+                increment("llm_hedge_wins_total", kind=kind)
+                LATENCY.observe(model, kind, time.perf_counter() - hedge_started)
+            else:
+                LATENCY.observe(model, kind, time.perf_counter() - started)
+            # Синхронный запрос не прервать: проигравший дорабатывает в фоне, его токены учитываются
+            for loser in pending:
+                loser.add_done_callback(lambda f: _record_loser(kind, model, f))
+            return future.result()
+    raise first_error
+
+
+def complete(client, kind: str, hedge: bool = True, **params):
+    """
+    client.chat.completions.create с повторами временных ошибок и хеджированием медленных ответов.
+    kind - вид запроса для метрик и оценки p95 (week, day, meal...); hedge=False - только повторы.
+    """
+    attempt = 0
+    while True:
+        try:
+            return _hedged_call(client.chat.completions.create, kind, params, hedge)
+        except Exception as e:
+            delay = _next_delay(e, attempt, kind)
+            if delay is None:
+                raise
+        attempt += 1
+        time.sleep(delay)
+
+
+def open_stream(client, kind: str, **params):
+    """
+    Потоковый запрос с повторами до получения заголовков ответа. Обрыв посреди потока
+    не повторяется: уже отданные дни остались у вызывающего кода. Хеджирования нет.
+    """
+    attempt = 0
+    while True:
+        try:
+            return client.chat.completions.create(stream=True, **params)
+        except Exception as e:
+            delay = _next_delay(e, attempt, kind)
+            if delay is None:
+                raise
+        attempt += 1
+        time.sleep(delay)
+
+
+# --- АСИНХРОННЫЕ ЗАПРОСЫ ---
+
+async def _ahedged_call(create: Callable[..., Any], kind: str, params: Dict[str, Any], hedge: bool):
+    model = params.get("model", "?")
+    delay = LATENCY.hedge_delay(model, kind) if hedge else None
+    started = time.perf_counter()
+    if delay is None:
+        response = await create(**params)
+        LATENCY.observe(model, kind, time.perf_counter() - started)
+        return response
+
+    primary = asyncio.ensure_future(create(**params))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        response = primary.result()
+        LATENCY.observe(model, kind, time.perf_counter() - started)
+        return response
+
+    increment("llm_hedged_requests_total", kind=kind)
+    hedge_started = time.perf_counter()
+    hedge = asyncio.ensure_future(create(**params))
+    pending = {primary, hedge}
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    first_error = first_error or task.exception()
+                    continue
+                if task is hedge:
+                    increment("llm_hedge_wins_total", kind=kind)
+                    LATENCY.observe(model, kind, time.perf_counter() - hedge_started)
+                else:
+                    LATENCY.observe(model, kind, time.perf_counter() - started)
+                return task.result()
+        raise first_error
+    finally:
+        # Проигравший отменяется: httpx закрывает его соединение, генерация на стороне API обрывается
+        for task in pending:
+            task.cancel()
+            increment("llm_hedge_wasted_total", kind=kind)
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def acomplete(async_client, kind: str, hedge: bool = True, **params):
+    """Асинхронный complete: повторы с джиттером и хедж с отменой проигравшего запроса."""
+    attempt = 0
+    while True:
+        try:
+            return await _ahedged_call(async_client.chat.completions.create, kind, params, hedge)
+        except Exception as e:
+            delay = _next_delay(e, attempt, kind)
+            if delay is None:
+                raise
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+def transport_stats() -> Dict[str, Any]:
+    """p95 по моделям и видам запросов и текущие задержки хеджа (для бенчмарка и /stats)."""
+    with LATENCY._lock:
+        keys = sorted(LATENCY._samples)
+    return {
+        f"{model}/{kind}": {"p95": LATENCY.quantile(model, kind, HEDGE_QUANTILE), "hedge_delay": LATENCY.hedge_delay(model, kind)}
+        for model, kind in keys
+    }
@@ -0,0 +1,178 @@
+import datetime
+
+from db_manager import (
+    save_recipes, parse_kzhbu, get_exclusion_list, get_frequent_ingredients, save_prepared_plan, delete_prepared_plan
+)
+from ai_generator import get_plan_dates
+from day_messages import format_kzhbu, split_message, refresh_day_messages
+from metrics import span
+
+# Общая часть всех путей генерации (очередь бота, заблаговременная и пакетная генерация):
+# исключения для промптов, форматирование плана и сохранение его рецептов.
+# nutrition (NumPy) импортируется внутри функций: до первой генерации он не нужен (холодный старт бота)
+
+# Заголовок сообщения с планом недели
+WEEKLY_PLAN_HEADER = "✨ **Ваш план питания на 5 дней готов!** ✨\n\n"
+
+
+def _to_grams(value) -> int | None:
+    """Вес порции из ответа ИИ в целое число граммов (или None, если это не число)."""
+    try:
+        return int(round(float(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+def format_day_plan(day_plan: dict) -> tuple[str, list]:
+    """
+    Форматирует один день плана: возвращает текст для Telegram и список рецептов для БД.
+    Бросает KeyError, если в дне нет основных ключей (day, date, meals).
+    """
+    # 1. Форматирование заголовка дня
+    day_message = f"🗓️ **{day_plan['day']}** ({day_plan['date']}):\n"
+    meal_date_obj = datetime.datetime.strptime(day_plan['date'], "%Y-%m-%d").date()
+    recipes_to_save = []
+
+    from nutrition import annotate_plan, MIN_COVERAGE
+
+    # Локальный расчет КЖБУ по ингредиентам (если день еще не размечен в build_weekly_message)
+    if any(isinstance(meal, dict) and 'computed_kzhbu' not in meal for meal in day_plan['meals']):
+        annotate_plan([day_plan])
+
+    for meal in day_plan['meals']:
+        
+        # --- ИЗВЛЕЧЕНИЕ С БЕЗОПАСНЫМИ ЗНАЧЕНИЯМИ ПО УМОЛЧАНИЮ (.get()) ---
+        kzhbu = parse_kzhbu(str(meal.get('total_kzhbu_for_two', '')))
+        computed = meal.get('computed_kzhbu')
+        reliable = computed is not None and meal.get('kzhbu_coverage', 0) >= MIN_COVERAGE and computed['kcal'] > 0
+        if kzhbu['kcal'] is None and reliable:
+            # ИИ не указал КЖБУ - сохраняем расчет по ингредиентам
+            kzhbu = dict(computed)
+        weight_m = _to_grams(meal.get('weight_m'))
+        weight_w = _to_grams(meal.get('weight_w'))
+        meal_type = meal.get('type', 'Прием пищи')
+        meal_name = meal.get('meal_name', 'Неизвестное блюдо')
+        recipe_full = meal.get('recipe_full', 'Нет полного рецепта')
+        
+        kzhbu_info = format_kzhbu(kzhbu['kcal'], kzhbu['protein'], kzhbu['fat'], kzhbu['carbs'])
+        
+        # 2. Формируем строку для Telegram-сообщения
+        meal_line = (
+            f"   - **{meal_type}:** {meal_name}\n"
+            f"     (Суммарное КЖБУ: {kzhbu_info})\n" 
+        )
+        if reliable and 'kzhbu_deviation' in meal:
+            meal_line += (
+                f"     ⚠️ _По ингредиентам:_ {format_kzhbu(computed['kcal'], computed['protein'], computed['fat'], computed['carbs'])}\n"
+            )
+        meal_line += f"     _Порции:_ (М: {weight_m or 'N/A'}г, Ж: {weight_w or 'N/A'}г)\n"
+        portion_scale = meal.get('portion_scale')
+        if portion_scale and abs(portion_scale - 1) >= 0.1:
+            meal_line += f"     _Ингредиенты рецепта:_ ×{portion_scale:g}\n"
+        day_message += meal_line
+        # -------------------------------------------------------------------
+        
+        # 3. Сохраняем в список для БД: числа - отдельными колонками, рецепт - чистым текстом
+        recipes_to_save.append({
+            'meal_date': meal_date_obj,
+            'meal_name': meal_name,
+            'meal_type': meal_type,
+            **kzhbu,
+            'weight_m': weight_m,
+            'weight_w': weight_w,
+            'recipe_full': recipe_full
+        })
+
+    return day_message, recipes_to_save
+
+
+def build_weekly_message(weekly_plan_json: list) -> tuple[str, list]:
+    """Собирает общее сообщение на неделю и список рецептов для БД из списка дней."""
+    from nutrition import annotate_plan
+
+    recipes_to_save = []
+    telegram_message = WEEKLY_PLAN_HEADER
+
+    # Один векторный проход расчета КЖБУ на всю неделю (дни, уже размеченные при подборе порций, не пересчитываются)
+    annotate_plan([
+        day_plan for day_plan in weekly_plan_json
+        if isinstance(day_plan, dict) and any(isinstance(meal, dict) and 'computed_kzhbu' not in meal for meal in day_plan.get('meals', []))
+    ])
+    
+    for day_plan in weekly_plan_json:
+        
+        if not isinstance(day_plan, dict):
+             print(f"❌ Ошибка в структуре: Элемент '{day_plan}' в списке не является словарем.")
+             continue 
+
+        try:
+            day_message, day_recipes = format_day_plan(day_plan)
+        except KeyError as e:
+            print(f"❌ Критическая ошибка в ключах JSON: Отсутствует основной ключ {e} (day, date, meals) в элементе дня/блюда.")
+            continue 
+
+        telegram_message += day_message + "\n"
+        recipes_to_save.extend(day_recipes)
+
+    return telegram_message, recipes_to_save
+
+
+async def save_plan_recipes(recipes_to_save: list, chat_id: int) -> bool:
+    """Сохраняет рецепты и сразу готовит сообщения /today для их дат (старый кэш этих дат сбрасывается)."""
+    with span("save_recipes"):
+        saved = await save_recipes(recipes_to_save, chat_id=chat_id)
+    if saved:
+        with span("render_day_messages"):
+            await refresh_day_messages(chat_id, [recipe['meal_date'] for recipe in recipes_to_save])
+    return saved
+
+
+def plan_week_start(meal_dates: list) -> datetime.date:
+    """Понедельник недели плана (ключ prepared_plans) по датам его блюд."""
+    first_date = min(meal_dates)
+    return first_date - datetime.timedelta(days=first_date.weekday())
+
+
+async def save_weekly_plan(chat_id: int, telegram_message: str, recipes_to_save: list) -> bool:
+    """
+    Сохраняет план недели целиком: рецепты (история, /today) и сообщение плана в prepared_plans.
+    Так воскресная рассылка отправляет последний сохраненный план недели, каким бы путем генерации
+    он ни был получен, а не более ранний заблаговременный.
+    """
+    if not recipes_to_save or not await save_plan_recipes(recipes_to_save, chat_id):
+        return False
+    week_start = plan_week_start([recipe['meal_date'] for recipe in recipes_to_save])
+    return await save_prepared_plan(chat_id, week_start, split_message([telegram_message]))
+
+
+async def save_streamed_plan(chat_id: int, day_messages: dict, complete: bool):
+    """
+    План недели после потоковой генерации (рецепты дней уже сохранены по мере готовности).
+    day_messages - {дата 'YYYY-MM-DD': сообщение дня}. Если поток прерван (complete=False), в истории
+    недели остались и старые, и новые дни - прежний план ей не соответствует и удаляется:
+    в воскресенье неделя будет сгенерирована заново.
+    """
+    if not day_messages:
+        return
+    meal_dates = [datetime.date.fromisoformat(day) for day in day_messages]
+    if not complete:
+        await delete_prepared_plan(chat_id, plan_week_start(meal_dates))
+        return
+    telegram_message = WEEKLY_PLAN_HEADER + "".join(day_messages[day] + "\n" for day in sorted(day_messages))
+    await save_prepared_plan(chat_id, plan_week_start(meal_dates), split_message([telegram_message]))
+
+
+async def load_exclusions(chat_id: int, profile: dict) -> tuple[list, dict]:
+    """
+    Исключения для промптов чата: названия блюд за 3 недели и ингредиенты, которые часто
+    встречались за последнюю неделю (добавляются в копию профиля как 'recent_ingredients').
+    Окна заканчиваются перед первым днем плана: уже сохраненные блюда планируемой недели
+    не меняют промпт, и повтор генерации попадает в кэш ответов.
+    """
+    plan_start = get_plan_dates()[0]
+    with span("exclusion_query"):
+        exclusion_list = await get_exclusion_list(days=21, chat_id=chat_id, before=plan_start)
+        recent_ingredients = await get_frequent_ingredients(chat_id, before=plan_start)
+    if recent_ingredients:
+        profile = {**profile, 'recent_ingredients': recent_ingredients}
+    return exclusion_list, profile
@@ -0,0 +1,184 @@
+import datetime
+from typing import Any, Callable, Dict, List
+
+# --- 1. КОМПИЛЯЦИЯ СХЕМЫ ---
+# Схема разбирается один раз при импорте в дерево функций-проверок, поэтому проверка плана -
+# это просто вызов функций без повторного обхода словаря схемы.
+
+Validator = Callable[[Any, str], List[str]]
+
+
+def _is_integer(value: Any) -> bool:
+    # Модель иногда присылает вес строкой ("350") или дробным числом (350.0) - это не повод для перегенерации
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return True
+    if isinstance(value, float):
+        return value.is_integer()
+    if isinstance(value, str):
+        try:
+            return float(value.strip()).is_integer()
+        except ValueError:
+            return False
+    return False
+
+
+_TYPE_CHECKS = {
+    "object": lambda value: isinstance(value, dict),
+    "array": lambda value: isinstance(value, list),
+    # Пустая строка в обязательном поле (например, пустой рецепт) так же бесполезна, как отсутствие поля
+    "string": lambda value: isinstance(value, str) and bool(value.strip()),
+    "integer": _is_integer,
+}
+
+
+def compile_schema(schema: Dict[str, Any]) -> Validator:
+    """
+    Превращает JSON-схему (поддерживаются type, properties, required, items) в функцию
+    validator(value, path) -> список ошибок вида "path: описание".
+    """
+    type_check = _TYPE_CHECKS.get(schema.get("type"))
+    expected_type = schema.get("type")
+    required = list(schema.get("required", []))
+    property_validators = {
+        name: compile_schema(subschema) for name, subschema in schema.get("properties", {}).items()
+    }
+    items_validator = compile_schema(schema["items"]) if "items" in schema else None
+
+    def validate(value: Any, path: str = "$") -> List[str]:
+        if type_check is not None and not type_check(value):
+            return [f"{path}: ожидался тип {expected_type}"]
+        errors = []
+        if isinstance(value, dict):
+            for name in required:
+                if name not in value:
+                    errors.append(f"{path}.{name}: отсутствует")
+            for name, property_validator in property_validators.items():
+                if name in value:
+                    errors.extend(property_validator(value[name], f"{path}.{name}"))
+        elif isinstance(value, list) and items_validator is not None:
+            for idx, item in enumerate(value):
+                errors.extend(items_validator(item, f"{path}[{idx}]"))
+        return errors
+
+    return validate
+
+
+# --- 2. ПРОВЕРКА ПЛАНА ---
+
+def extract_day_list(data: Any) -> List[Any] | None:
+    """Достает список дней из ответа модели: сам список или первый список внутри словаря-обертки."""
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        if "meals" in data:
+            # Модель вернула один день вместо списка
+            return [data]
+        for key in ['plan', 'plans', 'weekly_plan', 'menu', 'days']:
+            if isinstance(data.get(key), list):
+                return data[key]
+        for value in data.values():
+            found = extract_day_list(value) if isinstance(value, (list, dict)) else None
+            if found is not None:
+                return found
+    return None
+
+
+class PlanValidator:
+    """
+    Проверяет план по JSON_SCHEMA с точностью до дня и блюда.
+
+    Результат validate() - отчет о том, что именно нужно перегенерировать:
+      missing_dates  - ожидаемые даты, для которых дня в плане нет или день непригоден целиком;
+      invalid_meals  - (индекс дня, индекс блюда, тип приема пищи, ошибки) для сломанных блюд;
+      missing_meals  - (индекс дня, тип приема пищи) для отсутствующих приемов пищи.
+    """
+
+    def __init__(self, schema: Dict[str, Any], meal_types: List[str], day_names: List[str]):
+        day_schema = schema["items"]
+        meal_schema = day_schema["properties"]["meals"]["items"]
+        self._meal_validator = compile_schema(meal_schema)
+        self._meal_types = meal_types
+        self._day_names = day_names
+
+    def validate(self, plan: List[Any], expected_dates: List[datetime.date] | None = None) -> Dict[str, Any]:
+        """
+        Проверяет план и на месте исправляет то, что не требует модели (день недели по дате).
+        Дни с неверной датой получают свободную ожидаемую дату; непригодные дни (не словарь, нет списка блюд)
+        удаляются из плана, и их даты попадают в missing_dates.
+        """
+        report = {"missing_dates": [], "invalid_meals": [], "missing_meals": [], "errors": []}
+        expected = {d.strftime("%Y-%m-%d"): d for d in (expected_dates or [])}
+        seen_dates = set()
+
+        valid_days, misdated_days = [], []
+        for day_idx, day_plan in enumerate(plan):
+            path = f"$[{day_idx}]"
+            if not isinstance(day_plan, dict) or not isinstance(day_plan.get("meals"), list):
+                report["errors"].append(f"{path}: день непригоден (нет списка блюд)")
+                continue
+            day_date = self._parse_date(day_plan.get("date"))
+            date_key = day_date.strftime("%Y-%m-%d") if day_date else None
+            if date_key is None or date_key in seen_dates or (expected and date_key not in expected):
+                misdated_days.append(day_plan)
+                continue
+            seen_dates.add(date_key)
+            valid_days.append((day_date, day_plan))
+
+        # Дни с неверной или повторной датой занимают свободные ожидаемые даты по порядку
+        free_dates = [d for key, d in sorted(expected.items()) if key not in seen_dates]
+        for day_plan in misdated_days:
+            if not free_dates:
+                report["errors"].append(f"$: лишний день с датой {day_plan.get('date')!r}")
+                continue
+            day_date = free_dates.pop(0)
+            seen_dates.add(day_date.strftime("%Y-%m-%d"))
+            valid_days.append((day_date, day_plan))
+
+        for day_date, day_plan in valid_days:
+            day_plan["date"] = day_date.strftime("%Y-%m-%d")
+            day_plan["day"] = self._day_names[day_date.weekday()]
+
+        plan[:] = [day_plan for _, day_plan in sorted(valid_days, key=lambda item: item[0])]
+        report["missing_dates"] = free_dates
+
+        for day_idx, day_plan in enumerate(plan):
+            # Проход 1: тип каждого блюда; тип определяем по позиции, если модель его потеряла или исказила.
+            # Повторный тип в одном дне отбрасываем - вместо него будет догенерирован недостающий
+            meals_by_type = {}
+            for meal_idx, meal in enumerate(day_plan["meals"]):
+                meal_type = meal.get("type") if isinstance(meal, dict) else None
+                if meal_type not in self._meal_types:
+                    meal_type = self._meal_types[meal_idx] if meal_idx < len(self._meal_types) else None
+                    if isinstance(meal, dict) and meal_type is not None:
+                        meal["type"] = meal_type
+                if meal_type is None or meal_type in meals_by_type:
+                    report["errors"].append(f"$[{day_idx}].meals[{meal_idx}]: лишнее блюдо")
+                    continue
+                meals_by_type[meal_type] = meal
+            day_plan["meals"] = [meals_by_type[t] for t in self._meal_types if t in meals_by_type]
+
+            # Проход 2: проверка каждого блюда по схеме
+            for meal_idx, meal_type in enumerate(t for t in self._meal_types if t in meals_by_type):
+                meal_errors = self._meal_validator(meals_by_type[meal_type], f"$[{day_idx}].meals[{meal_idx}]")
+                if meal_errors:
+                    report["invalid_meals"].append((day_idx, meal_idx, meal_type, meal_errors))
+                    report["errors"].extend(meal_errors)
+            for meal_type in self._meal_types:
+                if meal_type not in meals_by_type:
+                    report["missing_meals"].append((day_idx, meal_type))
+                    report["errors"].append(f"$[{day_idx}].meals: нет приема пищи '{meal_type}'")
+
+        return report
+
+    @staticmethod
+    def _parse_date(value: Any) -> datetime.date | None:
+        try:
+            return datetime.datetime.strptime(str(value).strip(), "%Y-%m-%d").date()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def is_clean(report: Dict[str, Any]) -> bool:
+        return not (report["missing_dates"] or report["invalid_meals"] or report["missing_meals"])
@@ -0,0 +1,159 @@
+import re
+import itertools
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from db_manager import parse_kzhbu
+from day_messages import format_kzhbu
+from nutrition import annotate_plan, MIN_COVERAGE
+
+# --- НАСТРОЙКИ ПОДБОРА ПОРЦИЙ ---
+# Порция может меняться относительно предложенной ИИ в этих пределах (доля от исходного веса)
+PORTION_MIN_SCALE = 0.5
+PORTION_MAX_SCALE = 1.6
+# Абсолютные пределы порции в граммах
+PORTION_MIN_GRAMS = 50
+PORTION_MAX_GRAMS = 900
+# Веса относительных отклонений: ккал, белки, жиры, углеводы
+MACRO_WEIGHTS = np.array([2.0, 1.5, 1.0, 1.0])
+# Штраф за отход от порций ИИ: делает задачу однозначной и не дает порциям "разъезжаться"
+STABILITY_WEIGHT = 0.05
+
+# Кто из профиля какую порцию получает: ключ цели в профиле -> поле веса порции
+PERSON_PORTIONS = (("me", "weight_m"), ("wife", "weight_w"))
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def parse_macro_targets(text: str | None) -> np.ndarray | None:
+    """'2204 ккал, 165г белка, 61г жиров, 248г углеводов' -> [2204, 165, 61, 248]."""
+    numbers = [float(n.replace(",", ".")) for n in _NUMBER_RE.findall(str(text or ""))]
+    if len(numbers) < 4 or numbers[0] <= 0:
+        return None
+    return np.array(numbers[:4])
+
+
+def bounded_lstsq(A: np.ndarray, b: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray | None:
+    """
+    min ||A x - b||^2 при lower <= x <= upper.
+    Для малого числа переменных (блюда одного дня) точное решение перебором активных ограничений:
+    каждая переменная на нижней границе, на верхней или свободна; свободные - обычный МНК.
+    """
+    n = A.shape[1]
+    best_x, best_cost = None, np.inf
+    for state in itertools.product((0, 1, 2), repeat=n):
+        x = np.where(np.array(state) == 1, upper, lower).astype(np.float64)
+        free = np.array([s == 2 for s in state])
+        if free.any():
+            rhs = b - A[:, ~free] @ x[~free]
+            solution, *_ = np.linalg.lstsq(A[:, free], rhs, rcond=None)
+            if np.any(solution < lower[free] - 1e-9) or np.any(solution > upper[free] + 1e-9):
+                continue
+            x[free] = solution
+        cost = float(np.sum((A @ x - b) ** 2))
+        if cost < best_cost - 1e-12:
+            best_x, best_cost = x, cost
+    return best_x
+
+
+def _meal_macros(meal: Dict[str, Any]) -> np.ndarray | None:
+    """КЖБУ блюда на двоих: из ответа ИИ, а если его нет - надежный расчет по ингредиентам."""
+    kzhbu = parse_kzhbu(str(meal.get('total_kzhbu_for_two', '')))
+    values = [kzhbu['kcal'], kzhbu['protein'], kzhbu['fat'], kzhbu['carbs']]
+    computed = meal.get('computed_kzhbu')
+    if values[0] is None and computed is not None and meal.get('kzhbu_coverage', 0) >= MIN_COVERAGE:
+        values = [computed['kcal'], computed['protein'], computed['fat'], computed['carbs']]
+    if values[0] is None or values[0] <= 0:
+        return None
+    return np.array([value or 0.0 for value in values], dtype=np.float64)
+
+
+def _grams(value) -> float | None:
+    try:
+        grams = float(value)
+    except (TypeError, ValueError):
+        return None
+    return grams if grams > 0 else None
+
+
+def optimize_day_portions(day_plan: Dict[str, Any], targets: List[Tuple[str, np.ndarray]]) -> Dict[str, float] | None:
+    """
+    Подбирает порции каждого человека на один день (блюда дня меняются только по весу).
+    Плотность блюда (КЖБУ на грамм) = КЖБУ на двоих / (weight_m + weight_w).
+    Меняет weight_*, total_kzhbu_for_two (и computed_kzhbu) блюд; возвращает отклонение ккал по людям.
+    """
+    meals = [meal for meal in day_plan.get('meals', []) if isinstance(meal, dict)]
+    usable = []
+    for meal in meals:
+        macros = _meal_macros(meal)
+        weights = {field: _grams(meal.get(field)) for _, field in PERSON_PORTIONS}
+        if macros is None or any(value is None for value in weights.values()):
+            continue
+        usable.append((meal, macros / sum(weights.values()), weights))
+    if not usable:
+        return None
+
+    density = np.array([per_gram for _, per_gram, _ in usable]).T  # 4 x n
+    new_weights = [dict(weights) for _, _, weights in usable]
+    kcal_deviation = {}
+    for target_key, target in targets:
+        field = dict(PERSON_PORTIONS)[target_key]
+        original = np.array([weights[field] for _, _, weights in usable])
+        lower = np.maximum(original * PORTION_MIN_SCALE, PORTION_MIN_GRAMS)
+        upper = np.maximum(np.minimum(original * PORTION_MAX_SCALE, PORTION_MAX_GRAMS), lower)
+
+        # Относительные отклонения по КЖБУ плюс слабая привязка к исходным порциям
+        macro_rows = density * (MACRO_WEIGHTS / target)[:, None]
+        stability_rows = np.diag(np.sqrt(STABILITY_WEIGHT) / original)
+        A = np.vstack([macro_rows, stability_rows])
+        b = np.concatenate([MACRO_WEIGHTS, np.full(len(original), np.sqrt(STABILITY_WEIGHT))])
+
+        solution = bounded_lstsq(A, b, lower, upper)
+        if solution is None:
+            continue
+        solution = np.round(solution / 5) * 5
+        for meal_weights, grams in zip(new_weights, solution):
+            meal_weights[field] = grams
+        kcal_deviation[target_key] = float(density[0] @ solution - target[0])
+
+    for (meal, per_gram, weights), meal_weights in zip(usable, new_weights):
+        scale = sum(meal_weights.values()) / sum(weights.values())
+        for field, grams in meal_weights.items():
+            meal[field] = int(grams)
+        totals = per_gram * sum(meal_weights.values())
+        meal['total_kzhbu_for_two'] = format_kzhbu(*(round(float(value)) for value in totals))
+        # Ингредиенты рецепта рассчитаны на исходный вес блюда: при готовке их нужно умножить на scale
+        meal['portion_scale'] = round(scale, 2)
+        if meal.get('computed_kzhbu'):
+            meal['computed_kzhbu'] = {key: round(value * scale, 1) for key, value in meal['computed_kzhbu'].items()}
+    return kcal_deviation
+
+
+def optimize_plan_portions(weekly_plan: List[Dict[str, Any]], profile: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Подбирает порции (weight_m / weight_w) на все дни плана под цели КЖБУ людей из профиля
+    (МНК с ограничениями, NumPy). План меняется на месте и возвращается.
+    """
+    targets = []
+    for target_key, _ in PERSON_PORTIONS:
+        target = parse_macro_targets(profile.get(target_key))
+        if target is not None:
+            targets.append((target_key, target))
+    if not targets:
+        return weekly_plan
+
+    days = [day_plan for day_plan in weekly_plan if isinstance(day_plan, dict)]
+    # КЖБУ по ингредиентам нужен там, где ИИ не указал калорийность
+    annotate_plan([day_plan for day_plan in days if any(
+        isinstance(meal, dict) and 'computed_kzhbu' not in meal for meal in day_plan.get('meals', [])
+    )])
+
+    deviations = []
+    for day_plan in days:
+        deviation = optimize_day_portions(day_plan, targets)
+        if deviation:
+            deviations.append(max(abs(value) for value in deviation.values()))
+    if deviations:
+        print(f"🎯 Порции подобраны на {len(deviations)} дн.: максимальное отклонение по калориям {max(deviations):.0f} ккал на человека.")
+    return weekly_plan
@@ -0,0 +1,102 @@
+import os
+import re
+from typing import List
+
+# --- НАСТРОЙКИ СЖАТИЯ ПРОМПТА ---
+# Сколько токенов можно потратить на список исключенных блюд
+EXCLUSION_TOKEN_BUDGET = int(os.getenv("EXCLUSION_TOKEN_BUDGET", "300"))
+# Порог сходства (Жаккар по основам слов), начиная с которого названия считаются одним блюдом
+SIMILARITY_THRESHOLD = float(os.getenv("EXCLUSION_SIMILARITY_THRESHOLD", "0.75"))
+# Длина "основы" слова: грубый стемминг для русского ("шпинатом" и "шпинат" -> "шпина")
+STEM_LENGTH = 5
+
+# Предлоги и союзы, которые не влияют на суть блюда ("с"/"со", "в", "и" ...)
+_STOPWORDS = {"с", "со", "в", "во", "на", "и", "под", "из", "по", "для", "к", "ко", "от", "а", "или"}
+_WORD_RE = re.compile(r"[a-zа-я0-9]+")
+
+# Токенизатор модели, если установлен tiktoken; иначе - оценка по длине строки.
+# Загружается при первом подсчете: get_encoding читает (а в новом контейнере - скачивает) словарь BPE
+_ENCODING = None
+_ENCODING_LOADED = False
+
+
+def _get_encoding():
+    global _ENCODING, _ENCODING_LOADED
+    if not _ENCODING_LOADED:
+        try:
+            import tiktoken
+            _ENCODING = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _ENCODING = None
+        _ENCODING_LOADED = True
+    return _ENCODING
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте (точно через tiktoken или приблизительно: ~3 символа на токен)."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return max(1, len(text) // 3)
+
+
+def canonical_stems(name: str) -> frozenset:
+    """Набор основ слов названия без предлогов, регистра и буквы 'ё'."""
+    words = _WORD_RE.findall(name.lower().replace("ё", "е"))
+    return frozenset(word[:STEM_LENGTH] for word in words if word not in _STOPWORDS)
+
+
+def _similarity(a: frozenset, b: frozenset) -> float:
+    """Коэффициент Жаккара; вложенные наборы из 2+ основ ("Курица терияки" в "Курица в соусе терияки") считаются совпадением."""
+    if not a or not b:
+        return 0.0
+    if min(len(a), len(b)) >= 2 and (a <= b or b <= a):
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def cluster_names(names: List[str]) -> List[List[str]]:
+    """
+    Группирует почти одинаковые названия ("Омлет со шпинатом" и "Омлет с шпинатом").
+    Порядок кластеров и порядок внутри них повторяет порядок входного списка.
+    """
+    clusters: List[List[str]] = []
+    representatives: List[frozenset] = []
+    exact_index = {}
+
+    for name in names:
+        stems = canonical_stems(name)
+        cluster_idx = exact_index.get(stems)
+        if cluster_idx is None:
+            for idx, rep_stems in enumerate(representatives):
+                if _similarity(stems, rep_stems) >= SIMILARITY_THRESHOLD:
+                    cluster_idx = idx
+                    break
+        if cluster_idx is None:
+            cluster_idx = len(clusters)
+            clusters.append([])
+            representatives.append(stems)
+        exact_index[stems] = cluster_idx
+        clusters[cluster_idx].append(name)
+    return clusters
+
+
+def compact_exclusion_list(names: List[str], token_budget: int | None = None) -> List[str]:
+    """
+    Сжимает список исключений: по одному названию на кластер близких названий,
+    в порядке свежести (ожидается, что names отсортированы от самых недавних),
+    пока укладываемся в бюджет токенов.
+    """
+    budget = EXCLUSION_TOKEN_BUDGET if token_budget is None else token_budget
+    compacted = []
+    used_tokens = 0
+    for cluster in cluster_names(names):
+        representative = cluster[0]
+        cost = count_tokens(", " + representative)
+        if used_tokens + cost > budget:
+            break
+        compacted.append(representative)
+        used_tokens += cost
+    return compacted
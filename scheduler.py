@@ -0,0 +1,103 @@
+import os
+import datetime
+import traceback
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Tuple
+from zoneinfo import ZoneInfo
+
+from telegram.ext import Application, ContextTypes, JobQueue
+
+from db_manager import get_job_last_run, mark_job_run
+
+# --- НАСТРОЙКИ ПЛАНИРОВЩИКА ---
+# Часовой пояс расписания
+BOT_TIMEZONE = ZoneInfo(os.getenv("BOT_TIMEZONE", "Europe/Moscow"))
+# Задержка догоняющего запуска после старта бота (секунды), чтобы не тормозить сам запуск
+CATCH_UP_DELAY_SECONDS = 10
+
+# Дни недели в нумерации datetime.weekday() (0 - понедельник)
+WEEKDAYS = (0, 1, 2, 3, 4)
+SATURDAY = (5,)
+SUNDAY = (6,)
+
+
+def parse_time(value: str) -> datetime.time:
+    """Время 'ЧЧ:ММ' в часовом поясе бота."""
+    hour, minute = value.split(":")
+    return datetime.time(int(hour), int(minute), tzinfo=BOT_TIMEZONE)
+
+
+@dataclass
+class ScheduledJob:
+    """
+    Задание по расписанию: callback(bot) выполняется в указанные дни в указанное время.
+    Если бот был выключен в момент запуска, задание выполняется после старта,
+    но только если с пропущенного запуска прошло не больше catch_up часов.
+    """
+    name: str
+    callback: Callable[..., Awaitable[None]]
+    time: datetime.time
+    days: Tuple[int, ...]
+    catch_up: float
+
+    def last_due(self, now: datetime.datetime) -> datetime.datetime:
+        """Последний момент запуска по расписанию, не позже now (в часовом поясе бота)."""
+        now = now.astimezone(BOT_TIMEZONE)
+        for days_back in range(8):
+            day = now.date() - datetime.timedelta(days=days_back)
+            due = datetime.datetime.combine(day, self.time.replace(tzinfo=None), tzinfo=BOT_TIMEZONE)
+            if day.weekday() in self.days and due <= now:
+                return due
+        raise ValueError(f"У задания {self.name} нет дней запуска.")
+
+
+async def _run_job(job: ScheduledJob, bot):
+    """Выполняет задание и запоминает время запуска (даже при ошибке - чтобы не повторять сбойный запуск в цикле)."""
+    print(f"--- ⏰ Задание '{job.name}' запущено. ---")
+    try:
+        await job.callback(bot)
+    except Exception:
+        print(f"❌ Ошибка задания '{job.name}':\n{traceback.format_exc()}")
+    finally:
+        await mark_job_run(job.name)
+
+
+def schedule_jobs(application: Application, jobs: List[ScheduledJob]):
+    """
+    Регистрирует задания в JobQueue приложения (event loop бота, без отдельных потоков)
+    и ставит однократную проверку пропущенных запусков.
+    """
+    job_queue: JobQueue = application.job_queue
+    if job_queue is None:
+        print("❌ JobQueue недоступна: установите python-telegram-bot[job-queue]. Расписание не запущено.")
+        return
+
+    for job in jobs:
+        async def callback(context: ContextTypes.DEFAULT_TYPE, job=job):
+            await _run_job(job, context.bot)
+
+        # В PTB дни недели нумеруются с воскресенья (0 - воскресенье)
+        ptb_days = tuple((day + 1) % 7 for day in job.days)
+        job_queue.run_daily(callback, time=job.time, days=ptb_days, name=job.name)
+        print(f"⏰ Задание '{job.name}' запланировано на {job.time.strftime('%H:%M')} ({BOT_TIMEZONE}).")
+
+    async def catch_up(context: ContextTypes.DEFAULT_TYPE):
+        await catch_up_missed_jobs(context.bot, jobs)
+
+    job_queue.run_once(catch_up, when=CATCH_UP_DELAY_SECONDS, name="catch_up")
+
+
+async def catch_up_missed_jobs(bot, jobs: List[ScheduledJob]):
+    """Запускает задания, чей последний запуск по расписанию пришелся на время, когда бот был выключен."""
+    now = datetime.datetime.now(BOT_TIMEZONE)
+    for job in jobs:
+        due = job.last_due(now)
+        last_run = await get_job_last_run(job.name)
+        last_run = last_run.replace(tzinfo=datetime.timezone.utc) if last_run else None
+
+        if last_run is not None and last_run >= due:
+            continue
+        if now - due > datetime.timedelta(hours=job.catch_up):
+            continue
+        print(f"⏰ Пропущенный запуск '{job.name}' ({due.strftime('%d.%m %H:%M')}): выполняем сейчас.")
+        await _run_job(job, bot)
@@ -0,0 +1,375 @@
+import re
+import json
+import time
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+# --- ЛОКАЛЬНЫЕ ЗАГЛУШКИ OpenAI И TELEGRAM BOT API ---
+# Используются бенчмарками (benchmark.py): все запросы идут на 127.0.0.1, без сети и без ключей.
+
+DAY_NAMES = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+MEAL_TYPES = ["Завтрак", "Обед", "Перекус", "Ужин"]
+# Калорийность блюд заглушки на двоих: в диапазонах приемов пищи USER_KZHBU, в сумме ~3900 ккал
+MEAL_KCAL = {"Завтрак": 1000, "Обед": 1300, "Перекус": 450, "Ужин": 1150}
+# Во сколько раз "промахивается" ответ слабой модели (weak_model)
+OFF_TARGET_FACTOR = 0.4
+
+# Режимы ответа заглушки OpenAI
+VALID = "valid"
+MALFORMED_JSON = "malformed_json"
+BROKEN_MEAL = "broken_meal"
+
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_MEAL_TYPE_RE = re.compile(r'типа "([^"]+)"')
+
+
+class _StubServer:
+    """Общая часть: HTTP-сервер в фоновом потоке на свободном порту."""
+
+    handler_class = BaseHTTPRequestHandler
+
+    def __init__(self):
+        self.requests = 0
+        self._lock = threading.Lock()
+        handler = type("Handler", (self.handler_class,), {"stub": self})
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _count(self) -> int:
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> dict:
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        content_type = self.headers.get("Content-Type", "")
+        if "json" in content_type:
+            return json.loads(body or b"{}")
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _send(self, status: int, payload: bytes, content_type: str = "application/json"):
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент уже закрыл соединение (бот остановлен посреди длинного опроса, отмененный хедж-запрос)
+            pass
+
+
+# --- 1. ЗАГЛУШКА OpenAI (chat.completions) ---
+
+class _OpenAIHandler(_JsonHandler):
+
+    def do_POST(self):
+        stub: StubOpenAIServer = self.stub
+        if self.path.endswith("/files"):
+            self._send_json(stub.create_file(self._read_multipart()))
+            return
+        if self.path.endswith("/batches"):
+            self._send_json(stub.create_batch(self._read_body()))
+            return
+
+        request = self._read_body()
+        number = stub._count()
+        if stub.fail_every and number % stub.fail_every == 0:
+            self._send(503, json.dumps({"error": {"message": "stub overloaded", "type": "server_error"}}).encode())
+            return
+        latency = stub.model_latency.get(request.get("model"), stub.latency)
+        if stub.slow_every and number % stub.slow_every == 0:
+            time.sleep(stub.slow_latency)
+        elif latency:
+            time.sleep(latency)
+
+        prompt = request["messages"][-1]["content"]
+        content = stub.make_content(prompt, stub.is_off_target(request["model"]))
+        prompt_tokens = len(prompt) // 3
+        completion_tokens = len(content) // 3
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(content), stub.stream_chunk_size):
+                self._write_event({
+                    "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"],
+                    "choices": [{"index": 0, "delta": {"content": content[i:i + stub.stream_chunk_size]}, "finish_reason": None}],
+                })
+            self._write_event({
+                "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"],
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            })
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self._write_event({
+                    "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"],
+                    "choices": [],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens},
+                })
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+            return
+
+        self._send_json(stub.completion(request["model"], prompt, content))
+
+    def do_GET(self):
+        stub: StubOpenAIServer = self.stub
+        parts = self.path.rstrip("/").split("/")
+        if parts[-2] == "batches":
+            batch = stub.get_batch(parts[-1])
+            self._send_json(batch) if batch else self._send(404, b"{}")
+        elif parts[-1] == "content" and parts[-3] == "files":
+            content = stub.files.get(parts[-2], {}).get("content")
+            self._send(200, content, "application/octet-stream") if content is not None else self._send(404, b"{}")
+        else:
+            self._send(404, b"{}")
+
+    def _send_json(self, payload: dict):
+        self._send(200, json.dumps(payload, ensure_ascii=False).encode())
+
+    def _read_multipart(self) -> dict:
+        """Загрузка файла (multipart/form-data): поля формы и содержимое файла."""
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        boundary = self.headers.get("Content-Type", "").split("boundary=")[-1].strip('"').encode()
+        fields = {}
+        for part in body.split(b"--" + boundary):
+            if b"\r\n\r\n" not in part:
+                continue
+            headers, value = part.split(b"\r\n\r\n", 1)
+            name = re.search(rb'name="([^"]+)"', headers)
+            if name:
+                fields[name.group(1).decode()] = value[:-2] if value.endswith(b"\r\n") else value
+        return fields
+
+    def _write_event(self, payload: dict):
+        self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode())
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+class StubOpenAIServer(_StubServer):
+    """
+    Локальный chat.completions: отвечает планом на даты из промпта (неделя, день или одно блюдо).
+    Поддерживает и Batch API (files, batches): пакет выполняется в фоновом потоке.
+    latency - задержка ответа в секундах; mode - VALID, MALFORMED_JSON (обрезанный JSON)
+    или BROKEN_MEAL (в недельном плане у одного блюда нет рецепта).
+    slow_every=N - каждый N-й запрос отвечает за slow_latency секунд (хвост задержек),
+    fail_every=N - каждый N-й запрос получает 503.
+    weak_model, weak_every=N - каждый N-й ответ этой модели мимо целей КЖБУ (см. OFF_TARGET_FACTOR);
+    model_latency - своя задержка для отдельных моделей ({"gpt-4o": 0.6}).
+    """
+
+    handler_class = _OpenAIHandler
+
+    def __init__(self, latency: float = 0.0, mode: str = VALID, stream_chunk_size: int = 64,
+                 slow_every: int = 0, slow_latency: float = 0.0, fail_every: int = 0,
+                 weak_model: str | None = None, weak_every: int = 0, model_latency: dict | None = None):
+        super().__init__()
+        self.latency = latency
+        self.mode = mode
+        self.slow_every = slow_every
+        self.slow_latency = slow_latency
+        self.fail_every = fail_every
+        self.weak_model = weak_model
+        self.weak_every = weak_every
+        self.model_latency = dict(model_latency or {})
+        self._weak_requests = itertools.count(1)
+        self.stream_chunk_size = stream_chunk_size
+        self._names = itertools.count(1)
+
+        # Batch API: загруженные файлы и пакеты заданий
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count(1)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def completion(self, model: str, prompt: str, content: str) -> dict:
+        prompt_tokens = len(prompt) // 3
+        completion_tokens = len(content) // 3
+        return {
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    # --- Batch API: пакет обрабатывается в фоне, за время latency на весь пакет ---
+
+    def create_file(self, fields: dict) -> dict:
+        file_id = f"file-{next(self._ids)}"
+        content = fields.get("file", b"")
+        self.files[file_id] = {"content": content, "purpose": fields.get("purpose", b"batch").decode()}
+        return {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl", "purpose": self.files[file_id]["purpose"], "status": "processed",
+        }
+
+    def create_batch(self, request: dict) -> dict:
+        batch_id = f"batch-{next(self._ids)}"
+        lines = [json.loads(line) for line in self.files[request["input_file_id"]]["content"].decode().splitlines() if line.strip()]
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"], "completion_window": request["completion_window"],
+            "status": "in_progress", "created_at": int(time.time()), "output_file_id": None,
+            "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+        }
+        threading.Thread(target=self._run_batch, args=(batch_id, lines), daemon=True).start()
+        return dict(self.batches[batch_id])
+
+    def _run_batch(self, batch_id: str, lines: list):
+        if self.latency:
+            time.sleep(self.latency)
+        output = []
+        for line in lines:
+            self._count()
+            prompt = line["body"]["messages"][-1]["content"]
+            body = self.completion(line["body"]["model"], prompt, self.make_content(prompt))
+            output.append(json.dumps({
+                "id": f"batch_req_{next(self._ids)}", "custom_id": line["custom_id"],
+                "response": {"status_code": 200, "request_id": "stub", "body": body}, "error": None,
+            }, ensure_ascii=False))
+        file_id = f"file-{next(self._ids)}"
+        self.files[file_id] = {"content": ("\n".join(output) + "\n").encode(), "purpose": "batch_output"}
+        with self._lock:
+            batch = self.batches[batch_id]
+            batch.update(status="completed", output_file_id=file_id)
+            batch["request_counts"]["completed"] = len(lines)
+
+    def get_batch(self, batch_id: str) -> dict | None:
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            return json.loads(json.dumps(batch)) if batch else None
+
+    def is_off_target(self, model: str) -> bool:
+        if not self.weak_every or model != self.weak_model:
+            return False
+        return next(self._weak_requests) % self.weak_every == 0
+
+    def _meal(self, meal_type: str, off_target: bool = False) -> dict:
+        number = next(self._names)
+        kcal = int(MEAL_KCAL.get(meal_type, 1000) * (OFF_TARGET_FACTOR if off_target else 1))
+        return {
+            "type": meal_type,
+            "meal_name": f"Блюдо {number}",
+            "total_kzhbu_for_two": f"Ккал: {kcal}, Б: {kcal * 3 // 40}г, Ж: {kcal * 3 // 100}г, У: {kcal * 11 // 100}г",
+            "weight_m": 400,
+            "weight_w": 300,
+            "recipe_full": (
+                "Ингредиенты:\n- Куриное филе — 300 г\n- Рис — 150 г\n- Оливковое масло — 1 ст. л.\n"
+                "- Брокколи — 200 г\nПриготовление:\n1. Отварить рис.\n2. Обжарить филе.\n3. Подать с брокколи."
+            ),
+        }
+
+    def _day(self, day_date: str, off_target: bool = False) -> dict:
+        weekday = time.strptime(day_date, "%Y-%m-%d").tm_wday
+        return {"day": DAY_NAMES[weekday], "date": day_date, "meals": [self._meal(t, off_target) for t in MEAL_TYPES]}
+
+    def make_content(self, prompt: str, off_target: bool = False) -> str:
+        if "ОДНО блюдо" in prompt:
+            match = _MEAL_TYPE_RE.search(prompt)
+            data = self._meal(match.group(1) if match else MEAL_TYPES[0], off_target)
+        elif "ОДИН день" in prompt:
+            data = self._day(_DATE_RE.findall(prompt)[0], off_target)
+        else:
+            dates = list(dict.fromkeys(_DATE_RE.findall(prompt)))
+            days = [self._day(d, off_target) for d in dates]
+            if self.mode == BROKEN_MEAL and days:
+                del days[0]["meals"][1]["recipe_full"]
+            data = {"plan": days}
+
+        content = json.dumps(data, ensure_ascii=False)
+        if self.mode == MALFORMED_JSON and "ОДНО блюдо" not in prompt and "ОДИН день" not in prompt:
+            content = content[: len(content) // 2]
+        return content
+
+
+# --- 2. ЗАГЛУШКА TELEGRAM BOT API ---
+
+class _BotAPIHandler(_JsonHandler):
+
+    def do_POST(self):
+        stub: StubBotAPIServer = self.stub
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        params = self._read_body()
+        number = stub._count()
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if stub.flood_every and number % stub.flood_every == 0:
+            self._send(429, json.dumps({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }).encode())
+            return
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method == "getUpdates":
+            # Момент первого опроса - конец холодного старта бота (см. benchmark.py)
+            with stub._lock:
+                if stub.first_poll_at is None:
+                    stub.first_poll_at = time.perf_counter()
+            # Длинный опрос без обновлений
+            time.sleep(min(float(params.get("timeout") or 0), 0.2))
+            result = []
+        elif method in ("sendMessage", "editMessageText"):
+            with stub._lock:
+                stub.sent_messages.append((int(params.get("chat_id", 0)), params.get("text", "")))
+            result = {
+                "message_id": number, "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        self._send(200, json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode())
+
+
+class StubBotAPIServer(_StubServer):
+    """
+    Локальный Bot API: getMe, sendMessage (сообщения сохраняются в sent_messages), getUpdates
+    (пустой ответ, время первого опроса - в first_poll_at), прочие методы - ok.
+    flood_every=N - каждый N-й запрос получает 429 RetryAfter.
+    """
+
+    handler_class = _BotAPIHandler
+
+    def __init__(self, latency: float = 0.0, flood_every: int = 0):
+        super().__init__()
+        self.latency = latency
+        self.flood_every = flood_every
+        self.sent_messages = []
+        self.first_poll_at = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
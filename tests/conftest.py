@@ -0,0 +1,33 @@
+# Общие настройки тестов: модули читают окружение при импорте, поэтому оно задается до них.
+# Все базы (recipes.db, llm_cache.db) - во временном каталоге, сети нет: ключ OpenAI фиктивный.
+import os
+import sys
+import asyncio
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="recipe-bot-tests-")
+os.environ["DATABASE_FILE"] = os.path.join(_workdir, "recipes.db")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("TELEGRAM_TOKEN", "0:test")
+
+
+@pytest.fixture
+def run_db():
+    """Выполняет корутину (фабрику) в новом event loop на пустой истории рецептов."""
+    import db_manager
+
+    def run(coro_factory):
+        async def scenario():
+            await db_manager.init_db()
+            await db_manager.clear_history()
+            try:
+                return await coro_factory()
+            finally:
+                await db_manager.dispose_db()
+        return asyncio.run(scenario())
+    return run
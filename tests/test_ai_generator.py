@@ -0,0 +1,44 @@
+import json
+import asyncio
+
+import pytest
+
+import ai_generator
+import llm_cache
+from ai_generator import DayStreamParser, MODEL_CASCADE, TEMPERATURE, SYSTEM_MESSAGE
+
+WEEK = {"plan": [
+    {"day": "Понедельник", "date": "2026-10-19", "meals": [
+        {"type": "Обед", "meal_name": 'Суп {с} "клецками" \\ по-домашнему', "recipe_full": "1. Варить [20 мин]."}
+    ]},
+    {"day": "Вторник", "date": "2026-10-20", "meals": [
+        {"type": "Ужин", "meal_name": "Рыба", "recipe_full": "Запечь } и подать {"}
+    ]},
+]}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64])
+def test_stream_parser_returns_each_day_once_on_split_chunks(chunk_size):
+    text = json.dumps(WEEK, ensure_ascii=False)
+    parser = DayStreamParser()
+    days = []
+    for start in range(0, len(text), chunk_size):
+        days.extend(parser.feed(text[start:start + chunk_size]))
+    assert days == WEEK["plan"]
+
+
+def test_cached_response_is_served_without_openai(monkeypatch):
+    prompt = "промпт дня для теста кэша"
+    cached = {"meals": [{"type": "Обед", "meal_name": "Плов"}]}
+    # Ответ сильной модели каскада тоже подходит: промпт тот же
+    key = llm_cache.make_cache_key(MODEL_CASCADE[-1], TEMPERATURE, SYSTEM_MESSAGE, prompt)
+    assert key != llm_cache.make_cache_key(MODEL_CASCADE[-1], TEMPERATURE, SYSTEM_MESSAGE, prompt + " ")
+    llm_cache.put_cached_response(key, MODEL_CASCADE[-1], json.dumps(cached, ensure_ascii=False))
+
+    def no_client():
+        raise AssertionError("при попадании в кэш OpenAI не вызывается")
+
+    monkeypatch.setattr(ai_generator, "get_async_client", no_client)
+    hits_before = llm_cache.CACHE_STATS["hits"]
+    assert asyncio.run(ai_generator._request_json_async(prompt)) == cached
+    assert llm_cache.CACHE_STATS["hits"] == hits_before + 1
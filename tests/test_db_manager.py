@@ -0,0 +1,83 @@
+import datetime
+
+import db_manager
+
+CHAT_ID = 1001
+PLAN_START = datetime.date(2026, 10, 19)
+
+
+def _recipe(meal_date: datetime.date, meal_name: str, meal_type: str = "Обед") -> dict:
+    return {
+        'meal_date': meal_date, 'meal_name': meal_name, 'meal_type': meal_type, 'kcal': 1000,
+        'protein': 75, 'fat': 30, 'carbs': 110, 'weight_m': 400, 'weight_w': 300,
+        'recipe_full': f"Ингредиенты:\n- Рис — 150 г\n{meal_name}",
+    }
+
+
+def test_exclusions_stop_before_plan_week(run_db):
+    async def scenario():
+        await db_manager.save_recipes([
+            _recipe(PLAN_START - datetime.timedelta(days=3), "Борщ"),
+            _recipe(PLAN_START, "Плов"),
+        ], CHAT_ID)
+        return await db_manager.get_exclusion_list(days=21, chat_id=CHAT_ID, before=PLAN_START)
+
+    assert run_db(scenario) == ["Борщ"]
+
+
+def test_find_by_ingredient_uses_ingredient_index(run_db):
+    from nutrition import normalize_ingredient
+
+    salmon = {**_recipe(PLAN_START, "Рыба на пару"), 'recipe_full': "Ингредиенты:\n- Форель — 300 г"}
+
+    async def scenario():
+        await db_manager.save_recipes([salmon, _recipe(PLAN_START, "Плов", "Ужин")], CHAT_ID)
+        await db_manager.save_recipes([salmon], CHAT_ID + 1)
+        found = await db_manager.search_recipes(CHAT_ID, "семга", ingredient=normalize_ingredient("семга"))
+        ids = await db_manager.get_recipe_ids_with_ingredients(CHAT_ID, ["лосось"])
+        return found, ids
+
+    found, ids = run_db(scenario)
+    assert [recipe.meal_name for recipe in found] == ["Рыба на пару"]
+    assert ids == {found[0].id}
+
+
+def test_save_recipes_replaces_same_day_and_meal(run_db):
+    async def scenario():
+        await db_manager.save_recipes([_recipe(PLAN_START, "Плов"), _recipe(PLAN_START, "Сырники", "Завтрак")], CHAT_ID)
+        # Повторная генерация дня: обед заменяется, завтрак остается, другой чат не затронут
+        await db_manager.save_recipes([_recipe(PLAN_START, "Рагу")], CHAT_ID)
+        await db_manager.save_recipes([_recipe(PLAN_START, "Борщ")], CHAT_ID + 1)
+        return await db_manager.get_recipes_for_date(PLAN_START, CHAT_ID)
+
+    assert sorted(recipe.meal_name for recipe in run_db(scenario)) == ["Рагу", "Сырники"]
+
+
+def test_recipe_library_is_per_chat(run_db):
+    async def scenario():
+        await db_manager.save_recipes([_recipe(PLAN_START, "Плов")], CHAT_ID)
+        await db_manager.save_recipes([_recipe(PLAN_START, "Рагу")], CHAT_ID + 1)
+        return await db_manager.get_recipe_library(CHAT_ID)
+
+    assert [entry['meal_name'] for entry in run_db(scenario)] == ["Плов"]
+
+
+def test_compaction_returns_pages_without_full_vacuum(run_db):
+    old_day = datetime.date.today() - datetime.timedelta(days=db_manager.HISTORY_ARCHIVE_DAYS + 30)
+
+    async def scenario():
+        await db_manager.save_recipes([
+            {**_recipe(old_day + datetime.timedelta(days=i), f"Блюдо {i}"), 'recipe_full': f"Блюдо {i}\n" + "шаг\n" * 2000}
+            for i in range(20)
+        ], CHAT_ID)
+        report = await db_manager.compact_history()
+        async with db_manager.get_engine().connect() as connection:
+            auto_vacuum = (await connection.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+            free_pages = (await connection.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        return report, auto_vacuum, free_pages
+
+    report, auto_vacuum, free_pages = run_db(scenario)
+    assert report['archived_rows'] == 20
+    assert report['reclaimed_bytes'] > 0
+    assert auto_vacuum == 2
+    assert free_pages == 0
@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram.error import NetworkError
+
+import delivery
+import db_manager
+from delivery import DeliveryEngine
+
+
+class FlakyBot:
+    """Бот, у которого первые failures отправок падают с сетевой ошибкой."""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError("connection reset")
+        self.sent.append((chat_id, text))
+
+
+async def _deliver(bot, texts, max_attempts=5):
+    engine = DeliveryEngine(workers=2, global_rate=1000, global_burst=100, chat_rate=1000, chat_burst=100,
+                            max_attempts=max_attempts)
+    await engine.start(bot)
+    try:
+        await engine.send(1, texts)
+        await asyncio.wait_for(engine.join(), 5)
+    finally:
+        await engine.stop()
+    return engine.stats(), await db_manager.get_pending_outbox()
+
+
+def test_outbox_message_is_retried_after_network_error(run_db, monkeypatch):
+    monkeypatch.setattr(delivery, "DELIVERY_BACKOFF_SECONDS", 0)
+    bot = FlakyBot(failures=2)
+
+    stats, pending = run_db(lambda: _deliver(bot, ["первое", "второе"]))
+
+    # Сообщения чата уходят по порядку, несмотря на повторы первого
+    assert bot.sent == [(1, "первое"), (1, "второе")]
+    assert stats["retries"] == 2 and stats["sent"] == 2 and stats["failed"] == 0
+    assert pending == []
+
+
+def test_outbox_message_fails_after_max_attempts(run_db, monkeypatch):
+    monkeypatch.setattr(delivery, "DELIVERY_BACKOFF_SECONDS", 0)
+    bot = FlakyBot(failures=10)
+
+    stats, pending = run_db(lambda: _deliver(bot, ["сообщение"], max_attempts=3))
+
+    assert bot.sent == []
+    assert stats["retries"] == 2 and stats["failed"] == 1
+    # Окончательно неотправленное не восстанавливается при следующем запуске
+    assert pending == []
@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+
+from generation_queue import GenerationQueue, QUEUED, ATTACHED, DUPLICATE
+
+WEEK = datetime.date(2026, 10, 19)
+NEXT_WEEK = WEEK + datetime.timedelta(days=7)
+
+
+def test_submit_attach_and_cancel():
+    async def scenario():
+        started, calls, cancelled = asyncio.Event(), [], []
+
+        async def handler(chat_id, **kwargs):
+            calls.append((chat_id, kwargs['week']))
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(chat_id)
+                raise
+
+        queue = GenerationQueue(handler, workers=2, max_concurrent=2)
+        await queue.start()
+        try:
+            results = [await queue.submit(1, WEEK, week=WEEK)]
+            await started.wait()
+            # Та же неделя присоединяется к выполняемому заданию, следующая ждет своей очереди
+            results.append(await queue.submit(1, WEEK, week=WEEK))
+            results.append(await queue.submit(1, NEXT_WEEK, week=NEXT_WEEK))
+            results.append(await queue.submit(1, NEXT_WEEK + datetime.timedelta(days=7), week=None))
+            requests = queue.find(1, WEEK).requests
+
+            cancelled_jobs = await queue.cancel(1)
+            await asyncio.wait_for(queue.join(), 5)
+            return results, requests, cancelled_jobs, calls, cancelled, queue.stats()
+        finally:
+            await queue.stop()
+
+    results, requests, cancelled_jobs, calls, cancelled, stats = asyncio.run(scenario())
+    assert results == [QUEUED, ATTACHED, QUEUED, DUPLICATE]
+    assert requests == 2
+    assert cancelled_jobs == 2
+    # Ожидавшее задание снято до запуска, выполнявшееся - прервано
+    assert calls == [(1, WEEK)]
+    assert cancelled == [1]
+    assert stats['pending'] == 0 and stats['running'] == 0
+
+
+def test_cancelled_week_can_be_submitted_again():
+    async def scenario():
+        busy, release, done = asyncio.Event(), asyncio.Event(), []
+
+        async def handler(chat_id, **kwargs):
+            if chat_id == 1:
+                busy.set()
+                await release.wait()
+            done.append(chat_id)
+
+        queue = GenerationQueue(handler, workers=1, max_concurrent=1)
+        await queue.start()
+        try:
+            # Единственный воркер занят чатом 1: задание чата 2 ждет в очереди и отменяется
+            await queue.submit(1, WEEK)
+            await busy.wait()
+            await queue.submit(2, WEEK)
+            cancelled_jobs = await queue.cancel(2)
+            result = await queue.submit(2, WEEK)
+            release.set()
+            await asyncio.wait_for(queue.join(), 5)
+            return cancelled_jobs, result, done
+        finally:
+            await queue.stop()
+
+    cancelled_jobs, result, done = asyncio.run(scenario())
+    assert cancelled_jobs == 1
+    assert result == QUEUED
+    assert done == [1, 2]
@@ -0,0 +1,58 @@
+from collections import deque
+
+from model_router import MAX_OFF_TARGET_DAYS, ModelRouter, plan_macro_problems
+
+PROFILE = {"total_target_kzhbu": "3907 Ккал, 293г Белка, 108г Жиров, 440г Углеводов"}
+
+
+def _day(date: str, kcal: int, protein: int) -> dict:
+    meal = {"total_kzhbu_for_two": f"{kcal // 4} Ккал, {protein // 4}г Белка, 27г Жиров, 110г Углеводов"}
+    return {"date": date, "meals": [dict(meal) for _ in range(4)]}
+
+
+def _week(bad_days: int) -> list:
+    return [
+        _day(f"2026-10-{19 + i:02d}", 2000 if i < bad_days else 3908, 150 if i < bad_days else 292)
+        for i in range(7)
+    ]
+
+
+def test_on_target_week_passes():
+    assert plan_macro_problems(_week(0), PROFILE) == []
+
+
+def test_one_off_target_day_does_not_escalate():
+    assert MAX_OFF_TARGET_DAYS == 1
+    assert plan_macro_problems(_week(1), PROFILE) == []
+
+
+def test_two_off_target_days_escalate():
+    problems = plan_macro_problems(_week(2), PROFILE)
+    assert any("2026-10-19" in problem for problem in problems)
+    assert any("2026-10-20" in problem for problem in problems)
+
+
+def test_short_plan_allows_one_bad_day():
+    assert plan_macro_problems(_week(1)[:5], PROFILE) == []
+
+
+def _router(cheap_failure_rate: float, cheap_tokens: int) -> ModelRouter:
+    """Окно статистики: дешевая модель быстрая (50 мс), но промахивается; сильная - 1 с, без промахов."""
+    router = ModelRouter(["gpt-4o-mini", "gpt-4o"])
+    router._loaded_kinds.add("week")
+    cheap = router._samples[("gpt-4o-mini", "week")] = deque()
+    strong = router._samples[("gpt-4o", "week")] = deque()
+    for i in range(20):
+        cheap.append((0.05, i >= 20 * cheap_failure_rate, cheap_tokens, cheap_tokens))
+        strong.append((1.0, True, 1000, 1000))
+    return router
+
+
+def test_router_keeps_cheap_model_that_saves_time_and_money():
+    # Промах в 90%: по времени дешевая модель еще выгодна (0.05 + 0.9 * 1.0 < 1.0), по стоимости - тоже
+    assert _router(0.9, 1000).route("week") == ["gpt-4o-mini", "gpt-4o"]
+
+
+def test_router_skips_cheap_model_whose_retries_cost_more():
+    # Те же промахи, но дешевая модель тратит в 3 раза больше токенов: вместе с повтором она дороже сильной
+    assert _router(0.9, 3000).route("week") == ["gpt-4o"]
@@ -0,0 +1,35 @@
+import time
+
+import openai_transport
+from openai_transport import LatencyTracker, HEDGE_MIN_SAMPLES
+
+
+def test_latency_is_tracked_per_model_and_kind():
+    tracker = LatencyTracker()
+    for _ in range(HEDGE_MIN_SAMPLES):
+        tracker.observe("gpt-4o-mini", "day", 1.0)
+        tracker.observe("gpt-4o", "day", 5.0)
+    assert tracker.quantile("gpt-4o-mini", "day", 0.95) == 1.0
+    assert tracker.quantile("gpt-4o", "day", 0.95) == 5.0
+    assert tracker.quantile("gpt-4o", "meal", 0.95) is None
+
+
+def test_sync_hedge_beats_slow_primary(monkeypatch):
+    tracker = LatencyTracker()
+    for _ in range(HEDGE_MIN_SAMPLES):
+        tracker.observe("m", "day", 0.01)
+    monkeypatch.setattr(openai_transport, "LATENCY", tracker)
+    monkeypatch.setattr(openai_transport, "HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(openai_transport, "OPENAI_HEDGING", True)
+    calls = []
+
+    def create(**params):
+        calls.append(params)
+        # Первый (основной) запрос зависает, запасной отвечает сразу
+        time.sleep(1.0 if len(calls) == 1 else 0)
+        return "ok"
+
+    started = time.perf_counter()
+    assert openai_transport._hedged_call(create, "day", {"model": "m"}, hedge=True) == "ok"
+    assert time.perf_counter() - started < 0.5
+    assert len(calls) == 2
@@ -0,0 +1,32 @@
+import itertools
+
+import numpy as np
+
+from portion_optimizer import bounded_lstsq
+
+
+def _cost(A, b, x):
+    return float(np.sum((A @ x - b) ** 2))
+
+
+def test_interior_optimum_matches_least_squares():
+    A = np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    b = np.array([1.0, 1.0, 2.0])
+    x = bounded_lstsq(A, b, np.array([0.5, 0.5]), np.array([1.5, 1.5]))
+    np.testing.assert_allclose(x, [1.0, 1.0], atol=1e-9)
+
+
+def test_solution_respects_bounds_and_is_optimal():
+    rng = np.random.default_rng(7)
+    A = rng.uniform(0.5, 3.0, size=(4, 3))
+    # Цель достижима только при x = 2 по всем переменным - вне допустимого диапазона
+    b = A @ np.full(3, 2.0)
+    lower, upper = np.full(3, 0.7), np.full(3, 1.3)
+
+    x = bounded_lstsq(A, b, lower, upper)
+
+    assert np.all(x >= lower - 1e-9) and np.all(x <= upper + 1e-9)
+    # Ни одна точка сетки внутри границ не лучше найденного решения
+    grid = np.linspace(0.7, 1.3, 13)
+    best_grid = min(_cost(A, b, np.array(point)) for point in itertools.product(grid, repeat=3))
+    assert _cost(A, b, x) <= best_grid + 1e-9
@@ -0,0 +1,62 @@
+import db_manager
+import main
+from ai_generator import get_plan_dates, USER_KZHBU
+
+CHAT_ID = 1001
+
+
+def _weekly_plan(dish: str) -> list:
+    return [
+        {'day': 'День', 'date': day.strftime("%Y-%m-%d"), 'meals': [{
+            'type': 'Обед', 'meal_name': f"{dish} {day.day}", 'total_kzhbu_for_two': "1000 ккал, 75г белка, 30г жиров, 110г углеводов",
+            'weight_m': 400, 'weight_w': 300, 'recipe_full': "Ингредиенты:\n- Рис — 150 г",
+        }]}
+        for day in get_plan_dates()
+    ]
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.sent.append(text)
+
+
+class FakeDelivery:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, chat_id, texts, parse_mode='Markdown'):
+        self.sent.extend(texts)
+        return len(texts)
+
+
+def test_sunday_delivery_sends_plan_regenerated_after_speculative_run(run_db, monkeypatch):
+    plans = iter([_weekly_plan("Плов"), _weekly_plan("Рагу")])
+
+    async def keep_plan(plan, *args, **kwargs):
+        return plan
+
+    monkeypatch.setattr(main, "generate_weekly_plan", lambda *args, **kwargs: next(plans))
+    monkeypatch.setattr(main, "repair_weekly_plan", keep_plan)
+    monkeypatch.setattr(main, "GENERATION_MODE", "batch")
+    delivery = FakeDelivery()
+    monkeypatch.setattr(main, "delivery_engine", delivery)
+
+    async def scenario():
+        bot = FakeBot()
+        await db_manager.save_profile(CHAT_ID, USER_KZHBU)
+        # Суббота: план готовится заранее; затем чат сам перегенерирует неделю (/generate_test)
+        await main.speculative_generation_job(bot)
+        await main.generate_and_send_weekly(bot, CHAT_ID, use_cache=False)
+        # Воскресенье: отправляется план недели из prepared_plans
+        await main.weekly_delivery_job(bot)
+        history = await db_manager.get_recipes_for_date(get_plan_dates()[0], CHAT_ID)
+        return bot.sent, [recipe.meal_name for recipe in history]
+
+    direct, history = run_db(scenario)
+    delivered = "".join(delivery.sent)
+    assert "Рагу" in delivered and "Плов" not in delivered
+    assert delivered == direct[-1].strip()
+    assert all(name.startswith("Рагу") for name in history)
@@ -0,0 +1,29 @@
+import pytest
+
+from ai_generator import USER_KZHBU
+from main import apply_profile_changes
+
+
+def test_valid_changes_are_merged():
+    updated = apply_profile_changes(USER_KZHBU, {
+        "me": "2000 ккал, 150г белка, 60г жиров, 220г углеводов",
+        "target_distribution_kzhbu": {"Перекус": "300-400 ккал"},
+    })
+    assert updated["me"].startswith("2000")
+    assert updated["target_distribution_kzhbu"]["Перекус"] == "300-400 ккал"
+    assert updated["target_distribution_kzhbu"]["Обед"] == USER_KZHBU["target_distribution_kzhbu"]["Обед"]
+
+
+@pytest.mark.parametrize("changes", [
+    {"people": "two"},
+    {"people": 3},
+    {"me": 2000},
+    {"wife": "много"},
+    {"target_distribution_kzhbu": {"Полдник": "300 ккал"}},
+    {"target_distribution_kzhbu": "900 ккал"},
+])
+def test_invalid_changes_are_rejected_without_side_effects(changes):
+    profile = dict(USER_KZHBU)
+    with pytest.raises(ValueError):
+        apply_profile_changes(profile, changes)
+    assert profile == USER_KZHBU